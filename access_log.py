@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import logging
+import re
+import time
+from contextvars import ContextVar
+from typing import Any
+from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+
+# Taken from the client when it sends a usable one, so its logs and ours
+# share an id; returned on every response.
+REQUEST_ID_HEADER = "x-request-id"
+_HEADER_NAME = REQUEST_ID_HEADER.encode("latin-1")
+_REQUEST_ID_PATTERN = re.compile(r"[\w.:-]{1,128}")
+
+_request_id: ContextVar[str | None] = ContextVar("copilot_api_request_id", default=None)
+
+
+def current_request_id() -> str:
+    return _request_id.get() or str(uuid4())
+
+
+def active_request_id() -> str | None:
+    # None outside a request, e.g. for startup and background task logs.
+    return _request_id.get()
+
+
+def _incoming_request_id(scope: dict[str, Any]) -> str:
+    for name, value in scope.get("headers") or ():
+        if name == _HEADER_NAME:
+            text = value.decode("latin-1")
+            if _REQUEST_ID_PATTERN.fullmatch(text):
+                return text
+            break
+    return str(uuid4())
+
+
+class AccessLogMiddleware:
+    # Plain ASGI rather than @app.middleware("http"): that wraps every
+    # response body in an extra task and queue, and returns before a
+    # stream has finished. Wrapping send only adds a type check per chunk,
+    # and the log line is written when the last chunk has gone out.
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = _incoming_request_id(scope)
+        _request_id.set(request_id)
+        header = (_HEADER_NAME, request_id.encode("latin-1"))
+        started = time.perf_counter()
+        status = 500
+        headers_at: float | None = None
+        logged = False
+
+        def log() -> None:
+            nonlocal logged
+            logged = True
+            ended = time.perf_counter()
+            duration_ms = int((ended - started) * 1000)
+            headers_ms = int(((headers_at or ended) - started) * 1000)
+            logger.info(
+                "%s %s -> %s (%sms, headers %sms) requestId=%s",
+                scope["method"],
+                scope["path"],
+                status,
+                duration_ms,
+                headers_ms,
+                request_id,
+                extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": duration_ms,
+                    "headers_ms": headers_ms,
+                },
+            )
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            nonlocal status, headers_at
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers_at = time.perf_counter()
+                message["headers"] = [*message.get("headers", ()), header]
+                await send(message)
+                return
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                log()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Errors and clients that left mid-stream never send a last chunk.
+            if not logged:
+                log()
@@ -23,9 +23,16 @@ def standard_headers() -> dict[str, str]:
 
 
 def copilot_base_url(state: RuntimeState) -> str:
+    if state.upstream_url:
+        return state.upstream_url.rstrip("/")
     return f"https://api.{state.account_type}.githubcopilot.com"
 
 
+def copilot_token_url(state: RuntimeState) -> str:
+    base_url = state.upstream_url.rstrip("/") if state.upstream_url else GITHUB_API_BASE_URL
+    return f"{base_url}/copilot_internal/v2/token"
+
+
 def copilot_headers(state: RuntimeState, vision: bool = False) -> dict[str, str]:
     headers: dict[str, str] = {
         "Authorization": f"Bearer {state.copilot_token}",
@@ -0,0 +1,594 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import fcntl
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Iterator
+from uuid import uuid4
+
+import httpx
+
+from errors import HTTPError, parse_json_text
+from paths import BATCHES_DIR
+from rate_limit import check_rate_limit
+from services.anthropic.converters import (
+    build_openai_payload,
+    convert_anthropic_to_openai_messages,
+    convert_openai_to_anthropic_response,
+)
+from services.copilot.create_chat_completions import create_chat_completions
+from state import state
+from tokenizer import get_token_count
+from usage import estimate_output_tokens, record_usage, upstream_usage
+
+logger = logging.getLogger(__name__)
+
+BATCH_KINDS = ("openai", "anthropic")
+BATCH_ENDPOINTS = ("/v1/chat/completions", "/chat/completions")
+BATCH_MAX_REQUESTS = 100_000
+# Attempts per request for 5xx responses and timeouts. Rate limits only
+# pause the batch; a request fails once it has been rate limited this long.
+BATCH_MAX_ATTEMPTS = 5
+BATCH_RATE_LIMIT_MAX_SECONDS = 6 * 3600.0
+BATCH_BACKOFF_MAX_SECONDS = 60.0
+# The runner rewrites batch.json at most this often while it has news.
+BATCH_SAVE_INTERVAL_SECONDS = 1.0
+
+_ID_PREFIXES = {"openai": "batch_", "anthropic": "msgbatch_"}
+
+# Running batches in this process, by id.
+_runners: dict[str, _Runner] = {}
+_semaphore: asyncio.Semaphore | None = None
+# Upstream quota is shared by every batch: after a 429, all of them wait
+# until this monotonic time, backing off further while 429s continue.
+_paused_until = 0.0
+_backoff_seconds = 0.0
+
+
+def _bad_request(message: str) -> HTTPError:
+    return HTTPError(
+        message=message,
+        status_code=400,
+        response_text=json.dumps({"message": message}),
+    )
+
+
+def _not_found(batch_id: str) -> HTTPError:
+    message = f"Batch {batch_id} not found"
+    return HTTPError(
+        message=message,
+        status_code=404,
+        response_text=json.dumps({"message": message}),
+    )
+
+
+def _rfc3339(timestamp: float | None) -> str | None:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+@dataclass
+class Batch:
+    id: str
+    kind: str
+    client: str
+    created_at: float
+    # in_progress, cancelling, cancelled or completed
+    status: str = "in_progress"
+    ended_at: float | None = None
+    cancel_initiated_at: float | None = None
+    metadata: dict[str, Any] | None = None
+    total: int = 0
+    succeeded: int = 0
+    errored: int = 0
+    canceled: int = 0
+
+    @property
+    def directory(self) -> Path:
+        return BATCHES_DIR / self.id
+
+    @property
+    def results_path(self) -> Path:
+        return self.directory / "results.jsonl"
+
+    @property
+    def ended(self) -> bool:
+        return self.status in {"cancelled", "completed"}
+
+    def save(self) -> None:
+        path = self.directory / "batch.json"
+        temporary = path.with_suffix(".tmp")
+        temporary.write_text(json.dumps(asdict(self)), encoding="utf-8")
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, batch_id: str) -> Batch | None:
+        path = BATCHES_DIR / batch_id / "batch.json"
+        if "/" in batch_id or not path.is_file():
+            return None
+        return cls(**json.loads(path.read_text(encoding="utf-8")))
+
+    def openai_object(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": "/v1/chat/completions",
+            "status": self.status,
+            "created_at": int(self.created_at),
+            "in_progress_at": int(self.created_at),
+            "completed_at": int(self.ended_at) if self.status == "completed" else None,
+            "cancelling_at": (
+                int(self.cancel_initiated_at) if self.cancel_initiated_at else None
+            ),
+            "cancelled_at": int(self.ended_at) if self.status == "cancelled" else None,
+            "request_counts": {
+                "total": self.total,
+                "completed": self.succeeded,
+                "failed": self.errored,
+            },
+            "metadata": self.metadata,
+            "output_url": f"/v1/batches/{self.id}/output",
+        }
+
+    def anthropic_object(self) -> dict[str, Any]:
+        processing_status = {
+            "in_progress": "in_progress",
+            "cancelling": "canceling",
+        }.get(self.status, "ended")
+        done = self.succeeded + self.errored + self.canceled
+        return {
+            "id": self.id,
+            "type": "message_batch",
+            "processing_status": processing_status,
+            "request_counts": {
+                "processing": self.total - done,
+                "succeeded": self.succeeded,
+                "errored": self.errored,
+                "canceled": self.canceled,
+                "expired": 0,
+            },
+            "created_at": _rfc3339(self.created_at),
+            "ended_at": _rfc3339(self.ended_at),
+            "expires_at": None,
+            "archived_at": None,
+            "cancel_initiated_at": _rfc3339(self.cancel_initiated_at),
+            "results_url": (
+                f"/v1/messages/batches/{self.id}/results" if self.ended else None
+            ),
+        }
+
+    def api_object(self) -> dict[str, Any]:
+        return self.openai_object() if self.kind == "openai" else self.anthropic_object()
+
+
+def _parse_items(kind: str, body: bytes) -> Iterator[tuple[str, dict[str, Any]]]:
+    # Yields (custom_id, request) pairs: chat completion bodies from OpenAI
+    # batch input lines, Anthropic messages params from either a
+    # {"requests": [...]} document or JSONL.
+    text = body.decode("utf-8")
+    entries: Any = None
+    if kind == "anthropic":
+        try:
+            document = json.loads(text)
+        except json.JSONDecodeError:
+            document = None
+        if isinstance(document, dict) and "requests" in document:
+            entries = document["requests"]
+            if not isinstance(entries, list):
+                raise _bad_request("requests must be a list")
+
+    if entries is None:
+        entries = []
+        for number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                raise _bad_request(f"Line {number} is not valid JSON") from None
+
+    for number, entry in enumerate(entries, start=1):
+        if not isinstance(entry, dict) or not isinstance(entry.get("custom_id"), str):
+            raise _bad_request(f"Request {number} needs a string custom_id")
+        if kind == "openai":
+            if entry.get("method", "POST") != "POST" or entry.get("url") not in BATCH_ENDPOINTS:
+                raise _bad_request(
+                    f"Request {number} must be a POST to /v1/chat/completions"
+                )
+            request = entry.get("body")
+        else:
+            request = entry.get("params")
+        if not isinstance(request, dict) or not isinstance(request.get("messages"), list):
+            raise _bad_request(f"Request {number} needs a body with messages")
+        yield entry["custom_id"], request
+
+
+def _write_input(batch: Batch, body: bytes) -> None:
+    seen: set[str] = set()
+    batch.directory.mkdir(parents=True)
+    try:
+        with open(batch.directory / "input.jsonl", "w", encoding="utf-8") as output:
+            for custom_id, request in _parse_items(batch.kind, body):
+                if custom_id in seen:
+                    raise _bad_request(f"Duplicate custom_id {custom_id!r}")
+                seen.add(custom_id)
+                if len(seen) > BATCH_MAX_REQUESTS:
+                    raise _bad_request(f"A batch holds at most {BATCH_MAX_REQUESTS} requests")
+                output.write(json.dumps({"custom_id": custom_id, "request": request}) + "\n")
+        if not seen:
+            raise _bad_request("The batch has no requests")
+        batch.total = len(seen)
+        batch.results_path.touch()
+        batch.save()
+    except BaseException:
+        for path in batch.directory.iterdir():
+            path.unlink()
+        batch.directory.rmdir()
+        raise
+
+
+def _result_outcome(kind: str, result: dict[str, Any]) -> str:
+    if kind == "openai":
+        response = result.get("response") or {}
+        ok = result.get("error") is None and response.get("status_code") == 200
+        return "succeeded" if ok else "errored"
+    return (result.get("result") or {}).get("type", "errored")
+
+
+def _read_results(batch: Batch) -> set[str]:
+    # Recounts outcomes from the results file and returns the finished
+    # custom_ids. A line cut short by a crash is dropped so the next append
+    # starts on a fresh line; its request simply runs again.
+    done: set[str] = set()
+    counts = {"succeeded": 0, "errored": 0, "canceled": 0}
+    with open(batch.results_path, "r+b") as results:
+        valid_bytes = 0
+        for line in results:
+            if not line.endswith(b"\n"):
+                break
+            valid_bytes += len(line)
+            result = json.loads(line)
+            done.add(result["custom_id"])
+            counts[_result_outcome(batch.kind, result)] += 1
+        results.truncate(valid_bytes)
+    batch.succeeded = counts["succeeded"]
+    batch.errored = counts["errored"]
+    batch.canceled = counts["canceled"]
+    return done
+
+
+def _pending_items(batch: Batch, done: set[str]) -> Iterator[tuple[str, dict[str, Any]]]:
+    # Read lazily so a large batch is never held in memory at once.
+    with open(batch.directory / "input.jsonl", encoding="utf-8") as lines:
+        for line in lines:
+            item = json.loads(line)
+            if item["custom_id"] not in done:
+                yield item["custom_id"], item["request"]
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(state.batch_concurrency)
+    return _semaphore
+
+
+async def _wait_for_quota() -> None:
+    while (delay := _paused_until - time.monotonic()) > 0:
+        await asyncio.sleep(delay)
+
+
+def _quota_exhausted() -> None:
+    global _paused_until, _backoff_seconds
+
+    _backoff_seconds = min(BATCH_BACKOFF_MAX_SECONDS, max(1.0, _backoff_seconds * 2))
+    _paused_until = max(_paused_until, time.monotonic() + _backoff_seconds)
+    logger.warning("Batch requests rate limited; pausing for %.0fs", _backoff_seconds)
+
+
+def _quota_available() -> None:
+    global _backoff_seconds
+
+    _backoff_seconds = 0.0
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, HTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+class _Runner:
+    def __init__(self, batch: Batch, lock_file: Any):
+        self.batch = batch
+        self.lock_file = lock_file
+        self.task: asyncio.Task[None] | None = None
+        self._results: Any = None
+        self._saved_at = 0.0
+
+    def cancel_requested(self) -> bool:
+        marker = self.batch.directory / "cancel"
+        if not marker.exists():
+            return False
+        if self.batch.status == "in_progress":
+            # Cancelled through another worker process.
+            self.batch.status = "cancelling"
+            self.batch.cancel_initiated_at = marker.stat().st_mtime
+        return True
+
+    async def _call(self, request: dict[str, Any]) -> tuple[dict[str, Any], int]:
+        # Returns the upstream response and the estimated input tokens,
+        # retrying rate limits and transient errors.
+        if self.batch.kind == "openai":
+            payload = {**request, "stream": False}
+            estimated_input = get_token_count(payload["messages"])["input"]
+        else:
+            messages = await asyncio.to_thread(
+                convert_anthropic_to_openai_messages,
+                request.get("messages", []),
+                request.get("system"),
+            )
+            payload = build_openai_payload({**request, "stream": False}, messages)
+            estimated_input = get_token_count(messages)["input"]
+
+        attempt = 0
+        rate_limited_since: float | None = None
+        while True:
+            await _wait_for_quota()
+            started = time.perf_counter()
+            try:
+                async with _get_semaphore():
+                    await check_rate_limit(state)
+                    response = await create_chat_completions(payload)
+            except Exception as error:
+                if isinstance(error, HTTPError) and error.status_code == 429:
+                    now = time.monotonic()
+                    if rate_limited_since is None:
+                        rate_limited_since = now
+                    if now - rate_limited_since >= BATCH_RATE_LIMIT_MAX_SECONDS:
+                        raise
+                    _quota_exhausted()
+                    continue
+                attempt += 1
+                if not _retryable(error) or attempt == BATCH_MAX_ATTEMPTS:
+                    raise
+                await asyncio.sleep(min(BATCH_BACKOFF_MAX_SECONDS, 2.0**attempt))
+                continue
+
+            _quota_available()
+            record_usage(
+                self.batch.client,
+                payload.get("model"),
+                upstream_usage(response),
+                estimated_input,
+                estimate_output_tokens(response),
+                time.perf_counter() - started,
+            )
+            return response, estimated_input
+
+    async def _process(self, custom_id: str, request: dict[str, Any]) -> dict[str, Any]:
+        request_id = str(uuid4())
+        if self.batch.kind == "openai":
+            result: dict[str, Any] = {
+                "id": f"batch_req_{uuid4().hex}",
+                "custom_id": custom_id,
+                "response": None,
+                "error": None,
+            }
+            try:
+                response, _ = await self._call(request)
+                result["response"] = {"status_code": 200, "request_id": request_id, "body": response}
+            except HTTPError as error:
+                result["response"] = {
+                    "status_code": error.status_code,
+                    "request_id": request_id,
+                    "body": {"error": parse_json_text(error.response_text)},
+                }
+            except Exception as error:
+                result["error"] = {"code": "internal_error", "message": str(error)}
+            return result
+
+        try:
+            response, estimated_input = await self._call(request)
+            message = convert_openai_to_anthropic_response(
+                response,
+                str(request.get("model", "")),
+                request_id,
+                estimated_input,
+            )
+            return {"custom_id": custom_id, "result": {"type": "succeeded", "message": message}}
+        except Exception as error:
+            if isinstance(error, HTTPError) and 400 <= error.status_code < 500:
+                error_type = "invalid_request_error"
+            else:
+                error_type = "api_error"
+            return {
+                "custom_id": custom_id,
+                "result": {
+                    "type": "errored",
+                    "error": {"type": "error", "error": {"type": error_type, "message": str(error)}},
+                },
+            }
+
+    def _write_result(self, result: dict[str, Any]) -> None:
+        outcome = _result_outcome(self.batch.kind, result)
+        setattr(self.batch, outcome, getattr(self.batch, outcome) + 1)
+        self._results.write(json.dumps(result) + "\n")
+        self._results.flush()
+        now = time.monotonic()
+        if now - self._saved_at >= BATCH_SAVE_INTERVAL_SECONDS:
+            self._saved_at = now
+            self.batch.save()
+
+    async def _work(self, items: Iterator[tuple[str, dict[str, Any]]]) -> None:
+        # Workers share one iterator, so each request is taken exactly once.
+        # Checked before taking the next one, which is left for the
+        # cancellation to record.
+        while not self.cancel_requested():
+            item = next(items, None)
+            if item is None:
+                return
+            self._write_result(await self._process(*item))
+
+    async def run(self) -> None:
+        batch = self.batch
+        try:
+            done = await asyncio.to_thread(_read_results, batch)
+            items = _pending_items(batch, done)
+            with open(batch.results_path, "a", encoding="utf-8") as self._results:
+                await asyncio.gather(
+                    *(self._work(items) for _ in range(state.batch_concurrency))
+                )
+                if self.cancel_requested():
+                    canceled = 0
+                    for custom_id, _ in items:
+                        canceled += 1
+                        if batch.kind == "anthropic":
+                            self._write_result({"custom_id": custom_id, "result": {"type": "canceled"}})
+                    if batch.kind == "openai":
+                        batch.canceled += canceled
+                    batch.status = "cancelled"
+                else:
+                    batch.status = "completed"
+            batch.ended_at = time.time()
+            batch.save()
+            logger.info(
+                "Batch %s %s: %s succeeded, %s errored, %s canceled",
+                batch.id,
+                batch.status,
+                batch.succeeded,
+                batch.errored,
+                batch.canceled,
+            )
+        except asyncio.CancelledError:
+            # Shutting down: whatever is done stays in results.jsonl and the
+            # rest runs when the server starts again.
+            batch.save()
+            raise
+        except Exception:
+            logger.exception("Batch %s stopped; it resumes on the next start", batch.id)
+        finally:
+            _runners.pop(batch.id, None)
+            self.lock_file.close()
+
+
+def _try_lock(batch: Batch) -> Any:
+    # Only one process runs a batch, also with --workers.
+    lock_file = open(batch.directory / "lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _start(batch: Batch) -> None:
+    lock_file = _try_lock(batch)
+    if lock_file is None:
+        return
+    runner = _Runner(batch, lock_file)
+    _runners[batch.id] = runner
+    # A fresh context, so the batch does not inherit the deadline and timing
+    # of the request that created it.
+    runner.task = asyncio.create_task(runner.run(), context=contextvars.Context())
+
+
+async def create_batch(
+    kind: str,
+    body: bytes,
+    client: str,
+    metadata: dict[str, Any] | None = None,
+) -> Batch:
+    if state.manual_approve:
+        # --manual approves each request; a batch would bypass that.
+        message = "Batches are not available with --manual"
+        raise HTTPError(
+            message=message,
+            status_code=400,
+            response_text=json.dumps({"message": message}),
+        )
+    batch = Batch(
+        id=f"{_ID_PREFIXES[kind]}{uuid4().hex}",
+        kind=kind,
+        client=client,
+        created_at=time.time(),
+        metadata=metadata,
+    )
+    # Parsing and writing a large input file would stall the event loop.
+    await asyncio.to_thread(_write_input, batch, body)
+    logger.info("Batch %s accepted with %s requests", batch.id, batch.total)
+    _start(batch)
+    return batch
+
+
+def get_batch(kind: str, batch_id: str) -> Batch:
+    runner = _runners.get(batch_id)
+    if runner is not None:
+        batch: Batch | None = runner.batch
+    elif batch_id.startswith(_ID_PREFIXES[kind]):
+        batch = Batch.load(batch_id)
+    else:
+        batch = None
+    if batch is None or batch.kind != kind:
+        raise _not_found(batch_id)
+    return batch
+
+
+def list_batches(kind: str, limit: int) -> list[Batch]:
+    batches = []
+    if BATCHES_DIR.is_dir():
+        for directory in BATCHES_DIR.iterdir():
+            runner = _runners.get(directory.name)
+            batch = runner.batch if runner is not None else Batch.load(directory.name)
+            # Skips batches still being written by create_batch.
+            if batch is not None and batch.kind == kind:
+                batches.append(batch)
+    batches.sort(key=lambda batch: batch.created_at, reverse=True)
+    return batches[:limit]
+
+
+def cancel_batch(kind: str, batch_id: str) -> Batch:
+    batch = get_batch(kind, batch_id)
+    if batch.ended or batch.status == "cancelling":
+        return batch
+    # A marker file, so the runner sees it even in another worker process.
+    (batch.directory / "cancel").touch()
+    batch.status = "cancelling"
+    batch.cancel_initiated_at = time.time()
+    batch.save()
+    return batch
+
+
+def batch_results_path(kind: str, batch_id: str) -> Path:
+    return get_batch(kind, batch_id).results_path
+
+
+def resume_batches() -> None:
+    # Picks up batches left unfinished by a previous run.
+    if not BATCHES_DIR.is_dir():
+        return
+    if state.manual_approve:
+        logger.warning("Unfinished batches are not resumed with --manual")
+        return
+    for directory in BATCHES_DIR.iterdir():
+        batch = Batch.load(directory.name)
+        if batch is not None and not batch.ended and batch.id not in _runners:
+            logger.info("Resuming batch %s", batch.id)
+            _start(batch)
+
+
+async def stop_batches() -> None:
+    tasks = [runner.task for runner in _runners.values() if runner.task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+import httpx
+
+from bench_routes import BENCH_ROUTES, BenchRoute
+from copilot_token import setup_copilot_token, stop_copilot_token_refresh
+from model_cache import cache_models
+from services.get_vscode_version import FALLBACK as FALLBACK_VSCODE_VERSION
+from single_flight import NO_DEDUPE_HEADER
+from state import state
+
+if TYPE_CHECKING:
+    from mock_upstream import MockUpstreamConfig
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class RouteResult:
+    name: str
+    concurrency: int
+    duration: float = 0.0
+    errors: int = 0
+    latencies: list[float] = field(default_factory=list)
+    ttfts: list[float] = field(default_factory=list)
+    memory_per_request: float | None = None
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak RSS only, in KiB on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(values: list[float], pct: float) -> float | None:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(pct) - 1]
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _ServerThread:
+    def __init__(self, app: Any, **config: Any):
+        import uvicorn
+
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        # Set when serving on a unix domain socket; clients connect through
+        # it and self.url only names the host.
+        self.uds: str | None = config.get("uds")
+        self._server = uvicorn.Server(
+            uvicorn.Config(
+                app,
+                **{
+                    "host": "127.0.0.1",
+                    "port": self.port,
+                    "log_level": "warning",
+                    "access_log": False,
+                    **config,
+                },
+            )
+        )
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError(f"Server on port {self.port} failed to start")
+            time.sleep(0.01)
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+def _is_first_token(line: str) -> bool:
+    if not line.startswith("data:"):
+        return False
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return False
+    try:
+        event = json.loads(data)
+    except json.JSONDecodeError:
+        return False
+    if event.get("type") == "content_block_delta":
+        return True
+    for choice in event.get("choices") or []:
+        delta = choice.get("delta") or {}
+        if delta.get("content") or delta.get("tool_calls"):
+            return True
+    return False
+
+
+async def _one_request(
+    client: httpx.AsyncClient,
+    route: BenchRoute,
+    result: RouteResult,
+) -> None:
+    started = time.perf_counter()
+    try:
+        if route.stream:
+            async with client.stream("POST", route.path, json=route.payload) as response:
+                if not response.is_success:
+                    await response.aread()
+                    result.errors += 1
+                    return
+                first_token_seen = False
+                async for line in response.aiter_lines():
+                    if not first_token_seen and _is_first_token(line):
+                        first_token_seen = True
+                        result.ttfts.append(time.perf_counter() - started)
+        else:
+            response = await client.post(route.path, json=route.payload)
+            if not response.is_success:
+                result.errors += 1
+                return
+    except httpx.HTTPError:
+        result.errors += 1
+        return
+    result.latencies.append(time.perf_counter() - started)
+
+
+async def _drive_route(
+    base_url: str,
+    name: str,
+    route: BenchRoute,
+    total_requests: int,
+    concurrency: int,
+    uds: str | None = None,
+) -> RouteResult:
+    result = RouteResult(name=name, concurrency=concurrency)
+    remaining = iter(range(total_requests))
+    baseline_rss = _rss_bytes()
+    peak_rss = baseline_rss
+    done = asyncio.Event()
+
+    async def sample_memory() -> None:
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, _rss_bytes())
+            await asyncio.sleep(0.05)
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        for _ in remaining:
+            await _one_request(client, route, result)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    transport = httpx.AsyncHTTPTransport(uds=uds, limits=limits) if uds else None
+    # Every request sends the same payload; without the header concurrent
+    # requests would share one upstream call and the run would measure
+    # deduplication rather than the proxy.
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        timeout=120,
+        limits=limits,
+        transport=transport,
+        headers={NO_DEDUPE_HEADER: "1"},
+    ) as client:
+        sampler = asyncio.create_task(sample_memory())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        result.duration = time.perf_counter() - started
+        done.set()
+        await sampler
+
+    result.memory_per_request = max(0, peak_rss - baseline_rss) / concurrency
+    return result
+
+
+async def _prepare_proxy_state(upstream_url: str) -> None:
+    state.upstream_url = upstream_url
+    state.github_token = "mock-github-token"
+    state.vscode_version = FALLBACK_VSCODE_VERSION
+    await setup_copilot_token()
+    await cache_models()
+
+
+def run_bench(
+    route_names: list[str],
+    total_requests: int,
+    concurrency: int,
+    mock_config: MockUpstreamConfig,
+    server_config: dict[str, Any] | None = None,
+) -> list[RouteResult]:
+    # The proxy under test is the real `server` app, served in-process next
+    # to the mock upstream, so all numbers are relative rather than absolute.
+    from mock_upstream import create_mock_upstream
+    from server import server
+
+    mock = _ServerThread(create_mock_upstream(mock_config))
+    mock.start()
+    proxy: _ServerThread | None = None
+    socket_dir = tempfile.TemporaryDirectory()
+    server_config = dict(server_config or {})
+    if server_config.get("uds") is True:
+        server_config["uds"] = os.path.join(socket_dir.name, "proxy.sock")
+    try:
+        asyncio.run(_prepare_proxy_state(mock.url))
+        proxy = _ServerThread(server, **server_config)
+        proxy.start()
+
+        results = []
+        for name in route_names:
+            logger.info("Benchmarking %s", name)
+            results.append(
+                asyncio.run(
+                    _drive_route(
+                        proxy.url,
+                        name,
+                        BENCH_ROUTES[name],
+                        total_requests,
+                        concurrency,
+                        proxy.uds,
+                    )
+                )
+            )
+        return results
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        mock.stop()
+        stop_copilot_token_refresh()
+        socket_dir.cleanup()
+
+
+def format_results(results: list[RouteResult]) -> str:
+    def ms(value: float | None) -> str:
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    header = (
+        f"{'route':<16} {'ok':>6} {'err':>5} {'req/s':>9} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'ttft p50':>9} {'ttft p99':>9} {'KiB/req':>9}"
+    )
+    lines = [header, "-" * len(header)]
+    for result in results:
+        throughput = len(result.latencies) / result.duration if result.duration else 0
+        memory = (
+            "-"
+            if result.memory_per_request is None
+            else f"{result.memory_per_request / 1024:.1f}"
+        )
+        lines.append(
+            f"{result.name:<16} {len(result.latencies):>6} {result.errors:>5} "
+            f"{throughput:>9.1f} {ms(_percentile(result.latencies, 50)):>9} "
+            f"{ms(_percentile(result.latencies, 99)):>9} "
+            f"{ms(_percentile(result.ttfts, 50)):>9} "
+            f"{ms(_percentile(result.ttfts, 99)):>9} {memory:>9}"
+        )
+    return "\n".join(lines)
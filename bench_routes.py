@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any
+
+# Kept apart from bench so the CLI can list the routes without importing
+# the client stack.
+
+_BENCH_MESSAGES = [
+    {"role": "user", "content": "Summarise the design of a streaming proxy."},
+]
+_BENCH_TOOLS = [
+    {
+        "name": "search",
+        "description": "Search the code base",
+        "input_schema": {
+            "type": "object",
+            "properties": {"query": {"type": "string"}},
+            "required": ["query"],
+        },
+    }
+]
+
+
+@dataclass
+class BenchRoute:
+    path: str
+    payload: dict[str, Any]
+    stream: bool = False
+
+
+BENCH_ROUTES: dict[str, BenchRoute] = {
+    "chat": BenchRoute(
+        "/v1/chat/completions",
+        {"model": "gpt-4o", "messages": _BENCH_MESSAGES},
+    ),
+    "chat-stream": BenchRoute(
+        "/v1/chat/completions",
+        {"model": "gpt-4o", "messages": _BENCH_MESSAGES, "stream": True},
+        stream=True,
+    ),
+    "messages": BenchRoute(
+        "/v1/messages",
+        {
+            "model": "claude-3.7-sonnet",
+            "max_tokens": 1024,
+            "messages": _BENCH_MESSAGES,
+            "tools": _BENCH_TOOLS,
+        },
+    ),
+    "messages-stream": BenchRoute(
+        "/v1/messages",
+        {
+            "model": "claude-3.7-sonnet",
+            "max_tokens": 1024,
+            "messages": _BENCH_MESSAGES,
+            "tools": _BENCH_TOOLS,
+            "stream": True,
+        },
+        stream=True,
+    ),
+    "embeddings": BenchRoute(
+        "/v1/embeddings",
+        {"model": "text-embedding-3-small", "input": ["bench input"] * 8},
+    ),
+}
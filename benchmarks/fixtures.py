@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import base64
+import json
+import random
+from typing import Any
+
+# Deterministic, realistically shaped inputs for the micro-benchmarks.
+
+_rng = random.Random(1234)
+
+_LOREM = (
+    "the proxy converts anthropic messages into openai chat payloads and "
+    "streams server sent events back while tracking tool calls and usage"
+).split()
+
+
+def _text(words: int) -> str:
+    return " ".join(_rng.choice(_LOREM) for _ in range(words))
+
+
+def tool_schemas(count: int = 50) -> list[dict[str, Any]]:
+    tools = []
+    for i in range(count):
+        properties = {
+            f"arg_{j}": {
+                "type": _rng.choice(["string", "integer", "boolean"]),
+                "description": _text(12),
+            }
+            for j in range(8)
+        }
+        properties["options"] = {
+            "type": "object",
+            "properties": {
+                "recursive": {"type": "boolean"},
+                "patterns": {"type": "array", "items": {"type": "string"}},
+            },
+        }
+        tools.append(
+            {
+                "name": f"tool_{i}",
+                "description": _text(60),
+                "input_schema": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": ["arg_0", "arg_1"],
+                },
+            }
+        )
+    return tools
+
+
+def large_base64_image(size_bytes: int = 2 * 1024 * 1024) -> str:
+    return base64.b64encode(_rng.randbytes(size_bytes)).decode("ascii")
+
+
+def agent_history(turns: int = 200, image_every: int = 50) -> list[dict[str, Any]]:
+    # An agent loop: user prompt, assistant text + tool_use, tool_result, ...
+    image = large_base64_image(256 * 1024)
+    messages: list[dict[str, Any]] = [{"role": "user", "content": _text(80)}]
+
+    for turn in range(turns):
+        tool_id = f"toolu_{turn:04d}"
+        messages.append(
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "text", "text": _text(40)},
+                    {
+                        "type": "tool_use",
+                        "id": tool_id,
+                        "name": f"tool_{turn % 50}",
+                        "input": {
+                            "path": f"src/module_{turn}.py",
+                            "pattern": _text(3),
+                            "options": {"recursive": True, "limit": 100},
+                        },
+                    },
+                ],
+            }
+        )
+        result_content: list[dict[str, Any]] = [
+            {"type": "text", "text": _text(400)},
+            {"type": "text", "text": _text(120)},
+        ]
+        user_content: list[dict[str, Any]] = [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": result_content}
+        ]
+        if image_every and turn % image_every == 0:
+            user_content.append(
+                {
+                    "type": "image",
+                    "source": {"type": "base64", "media_type": "image/png", "data": image},
+                }
+            )
+        messages.append({"role": "user", "content": user_content})
+
+    return messages
+
+
+def system_prompt() -> list[dict[str, Any]]:
+    return [{"type": "text", "text": _text(1500)}]
+
+
+def tool_result_content(parts: int = 200) -> list[Any]:
+    content: list[Any] = []
+    for i in range(parts):
+        if i % 4 == 0:
+            content.append({"type": "json", "value": {"line": i, "text": _text(20)}})
+        else:
+            content.append({"type": "text", "text": _text(60)})
+    return content
+
+
+def openai_tool_call_response(calls: int = 20) -> dict[str, Any]:
+    return {
+        "id": "chatcmpl-bench",
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "tool_calls",
+                "message": {
+                    "role": "assistant",
+                    "content": _text(300),
+                    "tool_calls": [
+                        {
+                            "id": f"call_{i}",
+                            "type": "function",
+                            "function": {
+                                "name": f"tool_{i}",
+                                "arguments": json.dumps(
+                                    {"path": f"src/{i}.py", "body": _text(200)}
+                                ),
+                            },
+                        }
+                        for i in range(calls)
+                    ],
+                },
+            }
+        ],
+    }
+
+
+def openai_stream_chunks(text_chunks: int = 500, tool_calls: int = 5, arg_chunks: int = 300) -> list[Any]:
+    chunks: list[Any] = []
+    for _ in range(text_chunks):
+        chunks.append(
+            {"choices": [{"index": 0, "delta": {"content": _rng.choice(_LOREM) + " "}}]}
+        )
+    for call in range(tool_calls):
+        chunks.append(
+            {
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "tool_calls": [
+                                {
+                                    "index": call,
+                                    "id": f"call_{call}",
+                                    "function": {"name": f"tool_{call}", "arguments": ""},
+                                }
+                            ]
+                        },
+                    }
+                ]
+            }
+        )
+        for _ in range(arg_chunks):
+            chunks.append(
+                {
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {
+                                "tool_calls": [
+                                    {"index": call, "function": {"arguments": '"ab", '}}
+                                ]
+                            },
+                        }
+                    ]
+                }
+            )
+    chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]})
+    chunks.append("[DONE]")
+    return chunks
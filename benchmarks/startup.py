@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).with_name("startup_baseline.json")
+DEFAULT_TOLERANCE = 0.25
+
+# name -> Python code run in a fresh interpreter. `import main` is what every
+# CLI command pays before it runs; `start` additionally loads the server.
+COMMANDS = {
+    "cli_help": "import sys, main; sys.argv = ['copilot-api', '--help']; main.run()",
+    "cli_import": "import main",
+    "start_import": "import main, server",
+}
+# Modules the short commands must not load; any of them showing up after
+# `import main` means a heavy import crept back to the top of main.py.
+DEFERRED_MODULES = (
+    "fastapi",
+    "uvicorn",
+    "numpy",
+    "httpx",
+    "server",
+    "mock_upstream",
+    "copilot_token",
+)
+
+
+def _run(code: str) -> float:
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started
+
+
+def measure(code: str, repeats: int) -> dict[str, float]:
+    # Each repeat also times a bare interpreter, so the result is stored
+    # relative to it and stays comparable across machines.
+    _run(code)
+    times = []
+    ratios = []
+    for _ in range(repeats):
+        floor = _run("pass")
+        elapsed = _run(code)
+        times.append(elapsed)
+        ratios.append(elapsed / floor)
+    return {
+        "ms": statistics.median(times) * 1000,
+        "relative_time": statistics.median(ratios),
+    }
+
+
+def deferred_modules_loaded() -> list[str]:
+    code = (
+        "import json, sys, main; "
+        f"print(json.dumps([name for name in {list(DEFERRED_MODULES)!r} if name in sys.modules]))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output)
+
+
+def import_profile(code: str, top: int) -> list[tuple[str, float]]:
+    # Modules by cumulative import time, from -X importtime.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules.append((name.strip(), int(cumulative) / 1000))
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:top]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Startup time of the CLI and the server import path."
+    )
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument(
+        "--profile",
+        choices=sorted(COMMANDS),
+        help="Print the slowest imports of one command instead of timing",
+    )
+    parser.add_argument("--top", type=int, default=25, help="Modules shown by --profile")
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Write the results as the new baseline instead of comparing",
+    )
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        print(f"{'module':<50} {'cumulative ms':>14}")
+        for name, ms in import_profile(COMMANDS[args.profile], args.top):
+            print(f"{name:<50} {ms:>14.1f}")
+        return 0
+
+    baseline: dict[str, dict[str, float]] = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+
+    results: dict[str, dict[str, float]] = {}
+    print(f"{'command':<14} {'ms':>9} {'relative':>9} {'change':>8}")
+    for name, code in COMMANDS.items():
+        result = measure(code, args.repeats)
+        results[name] = result
+        reference = baseline.get(name)
+        change = (
+            f"{(result['relative_time'] / reference['relative_time'] - 1) * 100:+.1f}%"
+            if reference
+            else "-"
+        )
+        print(f"{name:<14} {result['ms']:>9.1f} {result['relative_time']:>9.2f} {change:>8}")
+
+    if args.update_baseline:
+        args.baseline.write_text(
+            json.dumps({**baseline, **results}, indent=2, sort_keys=True) + "\n",
+            encoding="utf-8",
+        )
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    problems = [
+        f"`import main` loads {name}, which should be imported by the commands that use it"
+        for name in deferred_modules_loaded()
+    ]
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference and result["relative_time"] > reference["relative_time"] * (1 + args.tolerance):
+            problems.append(
+                f"{name}: {result['relative_time']:.2f}x interpreter startup vs baseline "
+                f"{reference['relative_time']:.2f}x"
+            )
+    if problems:
+        print("\nRegressions:")
+        for line in problems:
+            print(f"  {line}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+from __future__ import annotations
+
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, AsyncIterator
+
+import httpx
+
+from state import state
+
+logger = logging.getLogger(__name__)
+
+# Only these response headers are stored; everything else may identify the
+# account or carry session state.
+_KEPT_RESPONSE_HEADERS = {"content-type", "retry-after", "x-request-id"}
+_KEPT_RESPONSE_HEADER_PREFIXES = ("x-ratelimit-",)
+_SECRET_BODY_KEYS = {"token", "access_token", "refresh_token"}
+REDACTED = "redacted"
+
+_recorder: CassetteRecorder | None = None
+_replay_index: ReplayIndex | None = None
+_setup_lock = threading.Lock()
+
+
+def _request_key(request: httpx.Request) -> str:
+    return hashlib.sha256(request.content).hexdigest()[:16]
+
+
+def _kept_headers(headers: httpx.Headers) -> dict[str, str]:
+    return {
+        name: value
+        for name, value in headers.items()
+        if name in _KEPT_RESPONSE_HEADERS
+        or name.startswith(_KEPT_RESPONSE_HEADER_PREFIXES)
+    }
+
+
+def _redact(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: (
+                REDACTED
+                if key in _SECRET_BODY_KEYS and isinstance(item, str)
+                else _redact(item)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+
+def redacted_text(text: str) -> str:
+    # Only whole JSON bodies can hold secrets (the token endpoint); SSE
+    # chunks are model output and are kept verbatim.
+    try:
+        document = json.loads(text)
+    except ValueError:
+        return text
+    if not isinstance(document, (dict, list)):
+        return text
+    return json.dumps(_redact(document), separators=(",", ":"))
+
+
+class CassetteRecorder:
+    # Appends one JSON line per exchange. Each process writes its own file,
+    # so --workers never interleaves partial lines.
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory / f"exchanges-{os.getpid()}.jsonl"
+        self._lock = threading.Lock()
+
+    def write(self, exchange: dict[str, Any]) -> None:
+        line = json.dumps(exchange, separators=(",", ":"), ensure_ascii=False) + "\n"
+        with self._lock, self.path.open("a", encoding="utf-8") as cassette:
+            cassette.write(line)
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    def __init__(
+        self,
+        stream: Any,
+        recorder: CassetteRecorder,
+        exchange: dict[str, Any],
+        started: float,
+    ):
+        self._stream = stream
+        self._recorder = recorder
+        self._exchange = exchange
+        self._started = started
+        self._chunks: list[list[Any]] = []
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        last = self._started
+        async for chunk in self._stream:
+            now = time.perf_counter()
+            text = self._decoder.decode(chunk)
+            if text:
+                self._chunks.append([round((now - last) * 1000, 1), text])
+                last = now
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+        if self._exchange.get("stream"):
+            self._exchange["chunks"] = self._chunks
+        else:
+            body = "".join(text for _, text in self._chunks)
+            self._exchange["body"] = redacted_text(body)
+        await asyncio.to_thread(self._recorder.write, self._exchange)
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, recorder: CassetteRecorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # Compressed bodies would be stored as undecodable bytes.
+        request.headers["accept-encoding"] = "identity"
+        started = time.perf_counter()
+        response = await self._inner.handle_async_request(request)
+        content_type = response.headers.get("content-type", "")
+
+        body: Any = None
+        if request.content:
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                body = request.content.decode("utf-8", errors="replace")
+
+        exchange = {
+            "recorded_at": time.time(),
+            "method": request.method,
+            "path": request.url.raw_path.decode("ascii"),
+            "key": _request_key(request),
+            "request": body,
+            "status": response.status_code,
+            "headers": _kept_headers(response.headers),
+            "ttfb_ms": round((time.perf_counter() - started) * 1000, 1),
+            "stream": content_type.startswith("text/event-stream"),
+        }
+        stream = _RecordingStream(
+            response.stream, self._recorder, exchange, time.perf_counter()
+        )
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=stream,
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class ReplayIndex:
+    # Exchanges are matched on method, path and a hash of the request body,
+    # falling back to method and path alone. Matches are served round-robin
+    # so a short recording can drive a long load test.
+
+    def __init__(self, directory: Path):
+        self.exact: dict[tuple[str, str, str], list[dict[str, Any]]] = defaultdict(list)
+        self.by_path: dict[tuple[str, str], list[dict[str, Any]]] = defaultdict(list)
+        self._next: dict[tuple[str, ...], int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+        count = 0
+        for cassette_path in sorted(directory.glob("*.jsonl")):
+            with cassette_path.open(encoding="utf-8") as cassette:
+                for line in cassette:
+                    if not line.strip():
+                        continue
+                    exchange = json.loads(line)
+                    method, request_path = exchange["method"], exchange["path"]
+                    self.exact[(method, request_path, exchange["key"])].append(exchange)
+                    self.by_path[(method, request_path)].append(exchange)
+                    count += 1
+        logger.info("Loaded %s recorded exchanges from %s", count, directory)
+
+    def find(self, request: httpx.Request) -> dict[str, Any] | None:
+        method = request.method
+        path = request.url.raw_path.decode("ascii")
+        exact_key = (method, path, _request_key(request))
+        candidates = self.exact.get(exact_key)
+        key: tuple[str, ...] = exact_key
+        if not candidates:
+            key = (method, path)
+            candidates = self.by_path.get(key)
+        if not candidates:
+            return None
+
+        with self._lock:
+            position = self._next[key]
+            self._next[key] = position + 1
+        return candidates[position % len(candidates)]
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: list[list[Any]], realtime: bool):
+        self._chunks = chunks
+        self._realtime = realtime
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for delay_ms, text in self._chunks:
+            if self._realtime and delay_ms:
+                await asyncio.sleep(delay_ms / 1000)
+            yield text.encode("utf-8")
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    def __init__(self, index: ReplayIndex, realtime: bool):
+        self._index = index
+        self._realtime = realtime
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        exchange = self._index.find(request)
+        if exchange is None:
+            path = request.url.raw_path.decode("ascii")
+            message = f"No recorded exchange for {request.method} {path}"
+            logger.warning(message)
+            return httpx.Response(
+                status_code=404,
+                json={"error": {"message": message, "type": "replay_miss"}},
+                request=request,
+            )
+
+        if self._realtime and exchange.get("ttfb_ms"):
+            await asyncio.sleep(exchange["ttfb_ms"] / 1000)
+
+        chunks = exchange.get("chunks")
+        if chunks is None:
+            chunks = [[0, exchange.get("body") or ""]]
+        return httpx.Response(
+            status_code=exchange["status"],
+            headers=exchange.get("headers") or {},
+            stream=_ReplayStream(chunks, self._realtime),
+            request=request,
+        )
+
+
+def _cassette_transport() -> httpx.AsyncBaseTransport | None:
+    global _recorder, _replay_index
+
+    if state.replay_dir:
+        with _setup_lock:
+            if _replay_index is None:
+                _replay_index = ReplayIndex(Path(state.replay_dir))
+        return ReplayTransport(_replay_index, realtime=state.replay_timing == "original")
+
+    if state.record_dir:
+        with _setup_lock:
+            if _recorder is None:
+                _recorder = CassetteRecorder(Path(state.record_dir))
+        return RecordingTransport(httpx.AsyncHTTPTransport(), _recorder)
+
+    return None
+
+
+def upstream_transport() -> httpx.AsyncBaseTransport | None:
+    # Transport for clients talking to the Copilot API and token endpoint;
+    # None keeps httpx's default network transport.
+    transport = _cassette_transport()
+    if state.debug_captures:
+        # debug_capture builds on the redaction above, so it imports this module.
+        from debug_capture import CaptureTransport
+
+        return CaptureTransport(transport or httpx.AsyncHTTPTransport())
+    return transport
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping
+
+import httpx
+
+from errors import HTTPError
+from metrics import CONCURRENCY_DECREASES, CONCURRENCY_LIMIT, CONCURRENCY_QUEUED
+from request_timing import timed_phase
+from state import state
+from timeouts import check_deadline, deadline_remaining
+
+logger = logging.getLogger(__name__)
+
+# Multiplicative decreases: a 429 halves the limit, rising latency or
+# rate-limit headers running low trim it.
+RATE_LIMITED_DECREASE = 0.5
+CONGESTION_DECREASE = 0.9
+# Latency counts as rising once recent responses are this much slower than
+# the long-run average.
+LATENCY_TOLERANCE = 2.0
+# Fraction of the upstream rate-limit window left that counts as low.
+LOW_HEADROOM = 0.1
+# Longest Retry-After honoured before admitting more requests.
+MAX_RETRY_AFTER_SECONDS = 60.0
+
+_SHORT_WEIGHT = 0.3
+_LONG_WEIGHT = 0.02
+_LATENCY_WARMUP = 10
+
+
+class _Latency:
+    # Short- and long-run moving averages of one kind of response latency.
+    def __init__(self) -> None:
+        self.short = 0.0
+        self.long = 0.0
+        self.samples = 0
+
+    def add(self, seconds: float) -> None:
+        if self.samples == 0:
+            self.short = self.long = seconds
+        else:
+            self.short += _SHORT_WEIGHT * (seconds - self.short)
+            self.long += _LONG_WEIGHT * (seconds - self.long)
+        self.samples += 1
+
+    def rising(self) -> bool:
+        return self.samples >= _LATENCY_WARMUP and self.short > self.long * LATENCY_TOLERANCE
+
+
+def _retry_after(headers: Mapping[str, str]) -> float | None:
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _low_headroom(headers: Mapping[str, str]) -> bool:
+    # OpenAI-style x-ratelimit-{limit,remaining}-{requests,tokens} headers.
+    for resource in ("requests", "tokens"):
+        try:
+            limit = float(headers[f"x-ratelimit-limit-{resource}"])
+            remaining = float(headers[f"x-ratelimit-remaining-{resource}"])
+        except (KeyError, ValueError):
+            continue
+        if limit > 0 and remaining / limit < LOW_HEADROOM:
+            return True
+    return False
+
+
+class UpstreamSlot:
+    # Permission to have one request in flight upstream. Streams hold it
+    # until the stream ends, since they keep upstream busy until then.
+
+    def __init__(self, limiter: AdaptiveLimiter | None, saturated: bool):
+        self.limiter = limiter
+        # The limit was in use when this was granted, so a healthy response
+        # shows upstream can take more.
+        self.saturated = saturated
+        self.started = time.monotonic()
+        self._released = False
+
+    def response(self, kind: str, response: httpx.Response) -> None:
+        # kind separates latencies that are not comparable: time to stream
+        # headers and time to a whole completion.
+        if self.limiter is not None:
+            self.limiter.observe(self, kind, response)
+
+    def timed_out(self) -> None:
+        if self.limiter is not None:
+            self.limiter.decrease(self, CONGESTION_DECREASE, "timeout")
+
+    def release(self) -> None:
+        if not self._released and self.limiter is not None:
+            self._released = True
+            self.limiter.release()
+
+
+class AdaptiveLimiter:
+    # AIMD limit on concurrent upstream requests for one model. Requests
+    # beyond the limit wait in FIFO order instead of adding to an overload.
+    # The limit starts at state.max_concurrency, so a healthy upstream is
+    # never throttled; it only drops on 429s, rising latency, low headroom
+    # or timeouts, and grows back while requests queue and upstream keeps up.
+
+    def __init__(self, model: str):
+        self.model = model
+        self.limit = float(state.max_concurrency)
+        self.inflight = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+        self._latency: dict[str, _Latency] = {}
+        self._decreased_at = 0.0
+        self._blocked_until = 0.0
+        CONCURRENCY_LIMIT.set(int(self.limit), model)
+
+    def _admit(self) -> None:
+        if time.monotonic() < self._blocked_until:
+            return
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+        CONCURRENCY_QUEUED.set(len(self._waiters), self.model)
+
+    async def acquire(self) -> UpstreamSlot:
+        saturated = bool(self._waiters) or self.inflight + 1 >= int(self.limit)
+        if (
+            not self._waiters
+            and self.inflight < int(self.limit)
+            and time.monotonic() >= self._blocked_until
+        ):
+            self.inflight += 1
+            return UpstreamSlot(self, saturated)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        CONCURRENCY_QUEUED.set(len(self._waiters), self.model)
+        wait = state.concurrency_queue_timeout
+        remaining = deadline_remaining()
+        if remaining is not None:
+            wait = min(wait, max(0.0, remaining))
+        try:
+            async with asyncio.timeout(wait):
+                await waiter
+        except BaseException as error:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the wait ended.
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+                CONCURRENCY_QUEUED.set(len(self._waiters), self.model)
+            if not isinstance(error, TimeoutError):
+                raise
+            check_deadline("an upstream slot was free")
+            message = f"Too many concurrent requests for model {self.model}"
+            raise HTTPError(
+                message=message,
+                status_code=429,
+                response_text=json.dumps({"message": message}),
+            ) from None
+        return UpstreamSlot(self, True)
+
+    def release(self) -> None:
+        self.inflight -= 1
+        self._admit()
+
+    def _set_limit(self, limit: float) -> None:
+        self.limit = max(1.0, min(float(state.max_concurrency), limit))
+        CONCURRENCY_LIMIT.set(int(self.limit), self.model)
+
+    def decrease(self, slot: UpstreamSlot, factor: float, reason: str) -> None:
+        # Responses to requests sent before the last decrease reflect the old
+        # limit, so one burst of 429s only halves it once.
+        if slot.started <= self._decreased_at:
+            return
+        self._decreased_at = time.monotonic()
+        self._set_limit(self.limit * factor)
+        CONCURRENCY_DECREASES.inc(self.model, reason)
+        logger.info(
+            "Upstream concurrency for %s lowered to %s (%s)",
+            self.model,
+            int(self.limit),
+            reason,
+        )
+
+    def observe(self, slot: UpstreamSlot, kind: str, response: httpx.Response) -> None:
+        if response.status_code == 429:
+            retry_after = _retry_after(response.headers)
+            if retry_after is not None:
+                delay = min(retry_after, MAX_RETRY_AFTER_SECONDS)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+                asyncio.get_running_loop().call_later(delay, self._admit)
+            self.decrease(slot, RATE_LIMITED_DECREASE, "rate_limited")
+            return
+        if not response.is_success:
+            return
+
+        latency = self._latency.get(kind)
+        if latency is None:
+            latency = self._latency[kind] = _Latency()
+        latency.add(time.monotonic() - slot.started)
+        if latency.rising():
+            self.decrease(slot, CONGESTION_DECREASE, "latency")
+        elif _low_headroom(response.headers):
+            self.decrease(slot, CONGESTION_DECREASE, "headroom")
+        elif slot.saturated:
+            # Additive increase: about one more slot per limit's worth of
+            # healthy responses.
+            previous = int(self.limit)
+            self._set_limit(self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self._admit()
+
+
+_limiters: dict[str, AdaptiveLimiter] = {}
+
+
+@asynccontextmanager
+async def upstream_slot(model: object) -> AsyncIterator[UpstreamSlot]:
+    # Waits for room under the model's limit and holds it for the block.
+    if not state.adaptive_concurrency:
+        yield UpstreamSlot(None, False)
+        return
+    key = str(model)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = AdaptiveLimiter(key)
+    with timed_phase("concurrency_queue"):
+        slot = await limiter.acquire()
+    try:
+        yield slot
+    finally:
+        slot.release()
+
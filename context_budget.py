@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any
+
+from state import state
+from tokenizer import get_token_count
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_STRATEGIES = ("truncate_tool_results", "drop_oldest", "keep_recent")
+TRIMMED_HEADER = "x-copilot-api-context-trimmed"
+
+# The tokenizer estimates ~4 characters per token, which undercounts code
+# and JSON; leave headroom so a fitted request is not rejected anyway.
+BUDGET_FRACTION = 0.9
+# Tool results are never cut below this many estimated tokens.
+TOOL_RESULT_MIN_TOKENS = 256
+_TRUNCATION_NOTE = "\n[... {count} characters truncated by copilot-api ...]\n"
+
+
+def _model_limits(model_id: Any) -> dict[str, Any]:
+    if not state.models or not isinstance(state.models.get("data"), list):
+        return {}
+    for model in state.models["data"]:
+        if isinstance(model, dict) and model.get("id") == model_id:
+            return (model.get("capabilities") or {}).get("limits") or {}
+    return {}
+
+
+def prompt_budget(payload: dict[str, Any]) -> int | None:
+    limits = _model_limits(payload.get("model"))
+    limit = limits.get("max_prompt_tokens")
+    if not limit and limits.get("max_context_window_tokens"):
+        output = payload.get("max_tokens") or limits.get("max_output_tokens") or 0
+        limit = limits["max_context_window_tokens"] - output
+    if not limit or limit <= 0:
+        return None
+    return int(limit * BUDGET_FRACTION)
+
+
+def _message_tokens(message: dict[str, Any]) -> int:
+    count = get_token_count([message])
+    return count["input"] + count["output"]
+
+
+def _turn_starts(messages: list[dict[str, Any]]) -> list[int]:
+    # Tool messages belong to the assistant message that called them and are
+    # dropped together with it, so upstream never sees an orphaned result.
+    return [
+        index
+        for index, message in enumerate(messages)
+        if message.get("role") not in {"system", "tool"}
+    ]
+
+
+def _truncate_tool_results(
+    messages: list[dict[str, Any]], tokens: list[int], excess: int
+) -> tuple[int, int]:
+    candidates = {
+        index
+        for index, message in enumerate(messages)
+        if message.get("role") == "tool"
+        and isinstance(message.get("content"), str)
+        and tokens[index] > TOOL_RESULT_MIN_TOKENS
+    }
+    truncated = 0
+    while excess > 0 and candidates:
+        # Largest first; each result is cut at most once.
+        index = max(candidates, key=lambda i: tokens[i])
+        candidates.remove(index)
+        content = messages[index]["content"]
+        keep_tokens = max(TOOL_RESULT_MIN_TOKENS, tokens[index] - excess)
+        # Keep the head and tail; errors and summaries tend to sit at the end.
+        keep_chars = keep_tokens * 4
+        head = content[: keep_chars * 3 // 4]
+        tail = content[len(content) - keep_chars // 4 :]
+        cut = len(content) - len(head) - len(tail)
+        messages[index] = {
+            **messages[index],
+            "content": head + _TRUNCATION_NOTE.format(count=cut) + tail,
+        }
+        new_tokens = _message_tokens(messages[index])
+        excess -= tokens[index] - new_tokens
+        tokens[index] = new_tokens
+        truncated += 1
+    return truncated, excess
+
+
+def _drop_range(
+    messages: list[dict[str, Any]], tokens: list[int], start: int, end: int
+) -> tuple[int, int]:
+    # Removes non-system messages in [start, end); returns (count, tokens).
+    dropped = 0
+    freed = 0
+    for index in range(end - 1, start - 1, -1):
+        if messages[index].get("role") == "system":
+            continue
+        freed += tokens.pop(index)
+        messages.pop(index)
+        dropped += 1
+    return dropped, freed
+
+
+def _drop_oldest(
+    messages: list[dict[str, Any]], tokens: list[int], excess: int
+) -> tuple[int, int]:
+    dropped = 0
+    while excess > 0:
+        starts = _turn_starts(messages)
+        # The final turn is the one being answered and is always kept.
+        if len(starts) < 2:
+            break
+        count, freed = _drop_range(messages, tokens, starts[0], starts[1])
+        dropped += count
+        excess -= freed
+    return dropped, excess
+
+
+def _keep_recent(
+    messages: list[dict[str, Any]], tokens: list[int], excess: int
+) -> tuple[int, int]:
+    starts = _turn_starts(messages)
+    keep = max(1, state.context_keep_recent)
+    if excess <= 0 or len(starts) <= keep:
+        return 0, excess
+    dropped, freed = _drop_range(messages, tokens, 0, starts[-keep])
+    return dropped, excess - freed
+
+
+def fit_to_context_budget(payload: dict[str, Any]) -> str | None:
+    # Applies state.context_fit strategies in order until the estimated
+    # prompt fits; returns a summary for the response header, or None when
+    # nothing had to change.
+    messages = payload.get("messages")
+    budget = prompt_budget(payload)
+    if not state.context_fit or budget is None or not isinstance(messages, list):
+        return None
+
+    messages = [message for message in messages if isinstance(message, dict)]
+    tokens = [_message_tokens(message) for message in messages]
+    tools = payload.get("tools")
+    tools_json = getattr(tools, "json_bytes", None)
+    if tools_json is None:
+        tools_json = json.dumps(tools) if tools else ""
+    tools_tokens = len(tools_json) // 4
+    before = sum(tokens) + tools_tokens
+    excess = before - budget
+    if excess <= 0:
+        return None
+
+    truncated = 0
+    dropped = 0
+    for strategy in state.context_fit:
+        if excess <= 0:
+            break
+        if strategy == "truncate_tool_results":
+            count, excess = _truncate_tool_results(messages, tokens, excess)
+            truncated += count
+        elif strategy == "drop_oldest":
+            count, excess = _drop_oldest(messages, tokens, excess)
+            dropped += count
+        elif strategy == "keep_recent":
+            count, excess = _keep_recent(messages, tokens, excess)
+            dropped += count
+
+    payload["messages"] = messages
+    after = sum(tokens) + tools_tokens
+    report = [f"estimated_tokens={before}->{after}"]
+    if truncated:
+        report.append(f"truncated_tool_results={truncated}")
+    if dropped:
+        report.append(f"dropped_messages={dropped}")
+    if excess > 0:
+        report.append("over_budget")
+        logger.warning(
+            "Request for %s still exceeds its prompt budget of %s tokens after fitting (%s)",
+            payload.get("model"),
+            budget,
+            after,
+        )
+    summary = ", ".join(report)
+    logger.info("Fitted request for %s to its context budget: %s", payload.get("model"), summary)
+    return summary
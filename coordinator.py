@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import socketserver
+from pathlib import Path
+from threading import Thread
+from typing import Any
+
+from log_pipeline import setup_logging
+from paths import APP_DIR
+from rate_limit import mark_rate_limited_request, reserve_rate_limit_slot
+from state import state
+
+logger = logging.getLogger(__name__)
+
+COORDINATOR_ENV = "COPILOT_API_COORDINATOR"
+LOG_LEVEL_ENV = "COPILOT_API_LOG_LEVEL"
+STATE_SYNC_INTERVAL_SECONDS = 30
+
+# Fields copied from the coordinator into each worker's RuntimeState.
+SHARED_STATE_FIELDS = (
+    "copilot_token",
+    "account_type",
+    "upstream_url",
+    "models",
+    "vscode_version",
+    "rate_limit_wait",
+    "rate_limit_seconds",
+    "admin_enabled",
+    "profile_slow_ms",
+    "record_dir",
+    "replay_dir",
+    "replay_timing",
+    "image_max_size",
+    "image_quality",
+    "semantic_cache",
+    "semantic_cache_size",
+    "semantic_cache_eviction",
+    "semantic_cache_model",
+    "context_fit",
+    "context_keep_recent",
+    "single_flight",
+    "stream_buffer",
+    "stream_heartbeat",
+    "upstream_timeouts",
+    "usage_ledger",
+    "usage_db",
+    "batch_concurrency",
+    "adaptive_concurrency",
+    "max_concurrency",
+    "concurrency_queue_timeout",
+    "debug_captures",
+    "debug_capture_bytes",
+    "log_format",
+    "log_sample",
+)
+
+_server: socketserver.ThreadingUnixStreamServer | None = None
+_server_thread: Thread | None = None
+_sync_task: asyncio.Task[None] | None = None
+
+
+def _state_snapshot() -> dict[str, Any]:
+    return {name: getattr(state, name) for name in SHARED_STATE_FIELDS}
+
+
+def _handle_op(message: dict[str, Any]) -> dict[str, Any]:
+    op = message.get("op")
+
+    if op == "state":
+        return _state_snapshot()
+    if op == "rate_limit_reserve":
+        return {"wait": reserve_rate_limit_slot(state)}
+    if op == "rate_limit_mark":
+        mark_rate_limited_request(state)
+        return {}
+
+    return {"error": f"Unknown coordinator op: {op}"}
+
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = _handle_op(json.loads(line))
+            except Exception as error:
+                logger.exception("Coordinator request failed")
+                reply = {"error": str(error)}
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def start_coordinator(log_level: str) -> str:
+    global _server, _server_thread
+
+    socket_path = APP_DIR / f"coordinator-{os.getpid()}.sock"
+    socket_path.unlink(missing_ok=True)
+
+    _server = socketserver.ThreadingUnixStreamServer(
+        str(socket_path), _CoordinatorHandler
+    )
+    _server.daemon_threads = True
+    socket_path.chmod(0o600)
+
+    _server_thread = Thread(
+        target=_server.serve_forever, daemon=True, name="copilot-api-coordinator"
+    )
+    _server_thread.start()
+
+    # Spawned workers inherit these and attach in the server lifespan.
+    os.environ[COORDINATOR_ENV] = str(socket_path)
+    os.environ[LOG_LEVEL_ENV] = log_level
+    logger.info("Worker coordinator listening on %s", socket_path)
+    return str(socket_path)
+
+
+def stop_coordinator() -> None:
+    global _server, _server_thread
+
+    if _server is None:
+        return
+
+    socket_path = Path(_server.server_address)
+    _server.shutdown()
+    _server.server_close()
+    socket_path.unlink(missing_ok=True)
+    os.environ.pop(COORDINATOR_ENV, None)
+    os.environ.pop(LOG_LEVEL_ENV, None)
+    _server = None
+    _server_thread = None
+
+
+async def request_coordinator(op: str, **fields: Any) -> dict[str, Any]:
+    if not state.coordinator_path:
+        raise RuntimeError("Worker coordinator not configured")
+
+    reader, writer = await asyncio.open_unix_connection(state.coordinator_path)
+    try:
+        writer.write(json.dumps({"op": op, **fields}).encode("utf-8") + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+    reply = json.loads(line)
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply
+
+
+async def sync_worker_state() -> None:
+    snapshot = await request_coordinator("state")
+    for name in SHARED_STATE_FIELDS:
+        setattr(state, name, snapshot.get(name))
+
+
+async def _sync_loop() -> None:
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL_SECONDS)
+        try:
+            await sync_worker_state()
+        except Exception:
+            logger.exception("Failed to sync state from worker coordinator")
+
+
+async def start_worker_sync() -> None:
+    global _sync_task
+
+    coordinator_path = os.environ.get(COORDINATOR_ENV)
+    if not coordinator_path:
+        return
+
+    state.coordinator_path = coordinator_path
+    await sync_worker_state()
+    setup_logging(
+        os.environ.get(LOG_LEVEL_ENV, "INFO"), state.log_format, state.log_sample
+    )
+    _sync_task = asyncio.create_task(_sync_loop())
+    logger.info("Worker %s attached to coordinator %s", os.getpid(), coordinator_path)
+
+
+async def stop_worker_sync() -> None:
+    global _sync_task
+
+    if _sync_task is None:
+        return
+
+    _sync_task.cancel()
+    try:
+        await _sync_task
+    except asyncio.CancelledError:
+        pass
+    _sync_task = None
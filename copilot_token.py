@@ -6,6 +6,7 @@ from datetime import datetime
 from threading import Event, Thread
 
 from errors import HTTPError
+from metrics import TOKEN_REFRESHES
 from paths import GITHUB_TOKEN_PATH
 from services.github.get_copilot_token import get_copilot_token
 from services.github.get_device_code import get_device_code
@@ -79,7 +80,12 @@ async def setup_copilot_token() -> None:
 
     stop_copilot_token_refresh()
 
-    token_payload = await get_copilot_token()
+    try:
+        token_payload = await get_copilot_token()
+    except Exception:
+        TOKEN_REFRESHES.inc("failure")
+        raise
+    TOKEN_REFRESHES.inc("success")
     state.copilot_token = str(token_payload.get("token"))
     _refresh_failure_count = 0
 
@@ -113,6 +119,7 @@ def _start_copilot_token_refresh_loop(initial_refresh_in: int) -> None:
                 state.copilot_token = str(payload.get("token"))
                 refresh_in = int(payload.get("refresh_in", 3600))
                 _refresh_failure_count = 0
+                TOKEN_REFRESHES.inc("success")
                 logger.info(
                     "[%s] Copilot token refreshed successfully", _format_timestamp()
                 )
@@ -122,6 +129,7 @@ def _start_copilot_token_refresh_loop(initial_refresh_in: int) -> None:
                     max(0, refresh_in - 60),
                 )
             except Exception:
+                TOKEN_REFRESHES.inc("failure")
                 _refresh_failure_count += 1
                 logger.exception(
                     "[%s] Failed to refresh Copilot token (attempt %s/%s)",
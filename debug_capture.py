@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import json
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Iterable
+
+import httpx
+
+from access_log import current_request_id
+from cassette import REDACTED, redacted_text
+from errors import HTTPError
+from state import state
+
+# Header values replaced with REDACTED in a capture.
+_SECRET_HEADERS = {"authorization", "proxy-authorization", "cookie", "set-cookie", "x-api-key"}
+# Arrival times kept per body; later chunks are only counted.
+_CHUNK_TIMES_LIMIT = 500
+# Upstream exchanges kept per request, e.g. a model lookup and the completion.
+_UPSTREAM_LIMIT = 8
+
+# Oldest first; trimmed to state.debug_captures as requests arrive.
+_captures: deque[Capture] = deque()
+_current_capture: ContextVar[Capture | None] = ContextVar(
+    "copilot_api_debug_capture", default=None
+)
+
+
+def _headers(headers: Iterable[tuple[str, str]]) -> dict[str, str]:
+    return {
+        name: REDACTED if name.lower() in _SECRET_HEADERS else value
+        for name, value in headers
+    }
+
+
+def _asgi_headers(headers: Iterable[tuple[bytes, bytes]]) -> dict[str, str]:
+    return _headers(
+        (name.decode("latin-1"), value.decode("latin-1")) for name, value in headers
+    )
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+class _Body:
+    # The first state.debug_capture_bytes of a body, plus when each chunk
+    # arrived relative to the start of the request.
+
+    def __init__(self, started: float):
+        self.started = started
+        self.data = bytearray()
+        self.size = 0
+        self.chunks = 0
+        self.chunk_ms: list[float] = []
+        self.max_gap = 0.0
+        self._last: float | None = None
+
+    def add(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        now = time.perf_counter()
+        if self._last is not None:
+            self.max_gap = max(self.max_gap, now - self._last)
+        self._last = now
+        self.chunks += 1
+        if len(self.chunk_ms) < _CHUNK_TIMES_LIMIT:
+            self.chunk_ms.append(_ms(now - self.started))
+        self.size += len(chunk)
+        room = state.debug_capture_bytes - len(self.data)
+        if room > 0:
+            self.data += chunk[:room]
+
+    def to_dict(self, timing: bool = True) -> dict[str, Any]:
+        truncated = self.size > len(self.data)
+        text = self.data.decode("utf-8", errors="replace")
+        result: dict[str, Any] = {
+            # A cut-off JSON document cannot be parsed to redact it; the
+            # bodies that hold secrets (the token exchange) are small.
+            "body": text if truncated else redacted_text(text),
+            "bytes": self.size,
+            "truncated": truncated,
+        }
+        if timing:
+            result["chunks"] = self.chunks
+            result["chunk_ms"] = self.chunk_ms
+            result["max_gap_ms"] = _ms(self.max_gap)
+        return result
+
+
+class _Exchange:
+    def __init__(self, request: httpx.Request, started: float):
+        self.method = request.method
+        self.url = str(request.url)
+        self.request_headers = _headers(request.headers.items())
+        self.request = _Body(started)
+        self.request.add(request.content)
+        self.sent_ms = _ms(time.perf_counter() - started)
+        self.status: int | None = None
+        self.headers: dict[str, str] = {}
+        self.headers_ms: float | None = None
+        self.response = _Body(started)
+        self.error: str | None = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "method": self.method,
+            "url": self.url,
+            "request_headers": self.request_headers,
+            "request": self.request.to_dict(timing=False),
+            "sent_ms": self.sent_ms,
+            "status": self.status,
+            "headers": self.headers,
+            "headers_ms": self.headers_ms,
+            "response": self.response.to_dict(),
+            "error": self.error,
+        }
+
+
+class Capture:
+    def __init__(self, scope: dict[str, Any]):
+        self.id = current_request_id()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.model: str | None = None
+        self.request_headers = _asgi_headers(scope.get("headers") or ())
+        self.request = _Body(self.started)
+        self.status: int | None = None
+        self.headers: dict[str, str] = {}
+        self.headers_ms: float | None = None
+        self.response = _Body(self.started)
+        self.upstream: list[_Exchange] = []
+        self.duration_ms: float | None = None
+        self.error: str | None = None
+
+    def finish(self, scope: dict[str, Any]) -> None:
+        self.duration_ms = _ms(time.perf_counter() - self.started)
+        model = (scope.get("state") or {}).get("model")
+        self.model = str(model) if model is not None else None
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "started_at": self.started_at,
+            "method": self.method,
+            "path": self.path,
+            "model": self.model,
+            "status": self.status,
+            "upstream_status": [exchange.status for exchange in self.upstream],
+            "headers_ms": self.headers_ms,
+            # None while the request is still running.
+            "duration_ms": self.duration_ms,
+            "response_bytes": self.response.size,
+            "error": self.error,
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            **self.summary(),
+            "request_headers": self.request_headers,
+            "request": self.request.to_dict(timing=False),
+            "upstream": [exchange.to_dict() for exchange in self.upstream],
+            "headers": self.headers,
+            "response": self.response.to_dict(),
+        }
+
+
+class DebugCaptureMiddleware:
+    # Records POST requests (the ones that reach the model) while
+    # --debug-captures is set. Entries are added when a request starts, so
+    # a request that is still hanging can be inspected too.
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if (
+            state.debug_captures <= 0
+            or scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"].startswith("/admin/")
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        capture = Capture(scope)
+        _captures.append(capture)
+        while len(_captures) > state.debug_captures:
+            _captures.popleft()
+        _current_capture.set(capture)
+
+        async def receive_wrapper() -> dict[str, Any]:
+            message = await receive()
+            if message["type"] == "http.request":
+                capture.request.add(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                capture.status = message["status"]
+                capture.headers = _asgi_headers(message.get("headers") or ())
+                capture.headers_ms = _ms(time.perf_counter() - capture.started)
+            elif message["type"] == "http.response.body":
+                capture.response.add(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        except BaseException as error:
+            capture.error = repr(error)
+            raise
+        finally:
+            capture.finish(scope)
+
+
+class _CapturedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: Any, body: _Body):
+        self._stream = stream
+        self._body = body
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            self._body.add(chunk)
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+
+class CaptureTransport(httpx.AsyncBaseTransport):
+    # Adds upstream traffic to the capture of the request that caused it.
+    # Work outside a captured request (token refresh, batches) passes through.
+
+    def __init__(self, inner: httpx.AsyncBaseTransport):
+        self._inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        capture = _current_capture.get()
+        if capture is None or len(capture.upstream) >= _UPSTREAM_LIMIT:
+            return await self._inner.handle_async_request(request)
+
+        # Compressed bodies would be captured as undecodable bytes.
+        request.headers["accept-encoding"] = "identity"
+        exchange = _Exchange(request, capture.started)
+        capture.upstream.append(exchange)
+        try:
+            response = await self._inner.handle_async_request(request)
+        except BaseException as error:
+            exchange.error = repr(error)
+            raise
+        exchange.status = response.status_code
+        exchange.headers = _headers(response.headers.items())
+        exchange.headers_ms = _ms(time.perf_counter() - capture.started)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_CapturedStream(response.stream, exchange.response),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+def list_captures() -> list[dict[str, Any]]:
+    return [capture.summary() for capture in reversed(_captures)]
+
+
+def get_capture(capture_id: str) -> dict[str, Any]:
+    # Ids are request ids, which a client may reuse; the newest entry wins.
+    for capture in reversed(_captures):
+        if capture.id == capture_id:
+            return capture.to_dict()
+    message = f"Capture {capture_id} not found"
+    raise HTTPError(
+        message=message,
+        status_code=404,
+        response_text=json.dumps({"message": message}),
+    )
+
+
+def clear_captures() -> int:
+    count = len(_captures)
+    _captures.clear()
+    return count
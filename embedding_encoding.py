@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import array
+import base64
+import json
+import math
+import struct
+import sys
+from typing import Any
+
+from errors import HTTPError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# "base64" matches OpenAI (little-endian float32); "base64_float16" halves it
+# again at roughly three significant digits.
+ENCODING_FORMATS = ("float", "base64", "base64_float16")
+
+
+def _bad_request(message: str) -> HTTPError:
+    return HTTPError(
+        message=message,
+        status_code=400,
+        response_text=json.dumps({"message": message}),
+    )
+
+
+def pop_embedding_options(payload: dict[str, Any]) -> tuple[str, int | None]:
+    # Both options are applied locally, so upstream always returns plain
+    # float lists at full size.
+    encoding_format = payload.pop("encoding_format", None) or "float"
+    if encoding_format not in ENCODING_FORMATS:
+        raise _bad_request(
+            f"encoding_format must be one of {', '.join(ENCODING_FORMATS)}"
+        )
+
+    dimensions = payload.pop("dimensions", None)
+    if dimensions is not None and (
+        isinstance(dimensions, bool) or not isinstance(dimensions, int) or dimensions < 1
+    ):
+        raise _bad_request("dimensions must be a positive integer")
+
+    return encoding_format, dimensions
+
+
+def _encode_numpy(
+    vectors: list[list[float]], encoding_format: str, dimensions: int | None
+) -> list[Any]:
+    matrix = np.asarray(vectors, dtype=np.float64)
+    if dimensions is not None and dimensions < matrix.shape[1]:
+        matrix = matrix[:, :dimensions]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+
+    if encoding_format == "float":
+        return matrix.tolist()
+
+    dtype = "<f2" if encoding_format == "base64_float16" else "<f4"
+    packed = np.ascontiguousarray(matrix.astype(dtype))
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in packed]
+
+
+def _encode_python(
+    vector: list[float], encoding_format: str, dimensions: int | None
+) -> Any:
+    if dimensions is not None and dimensions < len(vector):
+        vector = vector[:dimensions]
+        norm = math.sqrt(math.fsum(value * value for value in vector))
+        if norm:
+            vector = [value / norm for value in vector]
+
+    if encoding_format == "float":
+        return vector
+    if encoding_format == "base64_float16":
+        return base64.b64encode(struct.pack(f"<{len(vector)}e", *vector)).decode("ascii")
+
+    packed = array.array("f", vector)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode("ascii")
+
+
+def encode_embeddings(
+    response: dict[str, Any],
+    encoding_format: str,
+    dimensions: int | None,
+) -> dict[str, Any]:
+    if encoding_format == "float" and dimensions is None:
+        return response
+
+    items = [
+        item
+        for item in response.get("data") or []
+        if isinstance(item, dict) and isinstance(item.get("embedding"), list)
+    ]
+    if not items:
+        return response
+
+    vectors = [item["embedding"] for item in items]
+    if np is not None and len({len(vector) for vector in vectors}) == 1:
+        encoded = _encode_numpy(vectors, encoding_format, dimensions)
+    else:
+        encoded = [
+            _encode_python(vector, encoding_format, dimensions) for vector in vectors
+        ]
+
+    for item, embedding in zip(items, encoded):
+        item["embedding"] = embedding
+    return response
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Mapping
+
+from fastapi.responses import StreamingResponse
+
+from metrics import STREAM_DISCONNECTS, route_label
+from state import state
+
+logger = logging.getLogger(__name__)
+
+# SSE comments are ignored by OpenAI clients; Anthropic clients expect the
+# documented ping event instead.
+OPENAI_HEARTBEAT = ": ping\n\n"
+ANTHROPIC_HEARTBEAT = 'event: ping\ndata: {"type": "ping"}\n\n'
+
+_END = object()
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class EventStreamResponse(StreamingResponse):
+    # A producer task reads the stream into a bounded queue, so a slow
+    # client holds up the upstream read instead of growing memory. The
+    # response watches for the client disconnecting and then cancels the
+    # producer, which closes the upstream request right away rather than on
+    # the next failed write. When nothing arrives for state.stream_heartbeat
+    # seconds, a heartbeat keeps proxies from closing the idle connection.
+
+    def __init__(
+        self,
+        content: AsyncIterator[str],
+        heartbeat: str,
+        headers: Mapping[str, str] | None = None,
+    ):
+        super().__init__(content, media_type="text/event-stream", headers=headers)
+        self.heartbeat = heartbeat.encode("utf-8")
+
+    async def _produce(self, buffer: asyncio.Queue[Any]) -> None:
+        try:
+            async for chunk in self.body_iterator:
+                await buffer.put(chunk)
+        except Exception as error:
+            await buffer.put(_Failed(error))
+        else:
+            await buffer.put(_END)
+
+    async def _write(self, buffer: asyncio.Queue[Any], send: Any) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        interval = state.stream_heartbeat or None
+        while True:
+            try:
+                async with asyncio.timeout(interval):
+                    chunk = await buffer.get()
+            except TimeoutError:
+                await send({"type": "http.response.body", "body": self.heartbeat, "more_body": True})
+                continue
+
+            if chunk is _END:
+                break
+            if isinstance(chunk, _Failed):
+                raise chunk.error
+            if not isinstance(chunk, (bytes, memoryview)):
+                chunk = chunk.encode(self.charset)
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _wait_for_disconnect(self, receive: Any) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        buffer: asyncio.Queue[Any] = asyncio.Queue(maxsize=state.stream_buffer)
+        producer = asyncio.create_task(self._produce(buffer))
+        writer = asyncio.create_task(self._write(buffer, send))
+        disconnect = asyncio.create_task(self._wait_for_disconnect(receive))
+        try:
+            await asyncio.wait({writer, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            if writer.done() and not isinstance(writer.exception(), OSError):
+                writer.result()
+            else:
+                STREAM_DISCONNECTS.inc(route_label(scope))
+                logger.info("Client disconnected from %s; cancelling the upstream stream", scope.get("path"))
+        finally:
+            for task in (producer, writer, disconnect):
+                task.cancel()
+            await asyncio.gather(producer, writer, disconnect, return_exceptions=True)
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+        if self.background is not None:
+            await self.background()
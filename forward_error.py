@@ -38,11 +38,12 @@ def anthropic_error_response(error: Exception) -> JSONResponse:
     logger.exception("Error handling Anthropic request", exc_info=error)
 
     if isinstance(error, HTTPError):
-        etype = (
-            "invalid_request_error"
-            if 400 <= error.status_code < 500
-            else "api_error"
-        )
+        if error.status_code == 504:
+            etype = "timeout_error"
+        elif 400 <= error.status_code < 500:
+            etype = "invalid_request_error"
+        else:
+            etype = "api_error"
         return JSONResponse(
             status_code=error.status_code,
             content={
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import io
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+from state import state
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_SIZE = 64
+
+# sha256 of the original base64 data plus settings -> (media_type, data).
+_cache: OrderedDict[str, tuple[str, str]] = OrderedDict()
+_cache_lock = Lock()
+_pillow_missing_logged = False
+
+
+def _load_pillow():
+    global _pillow_missing_logged
+
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _pillow_missing_logged:
+            logger.warning(
+                "--image-max-size needs Pillow (pip install 'copilot-api-python[images]'); "
+                "images are sent unchanged"
+            )
+            _pillow_missing_logged = True
+        return None
+    return Image
+
+
+def _shrink(media_type: str, data: str, max_size: int, quality: int) -> tuple[str, str]:
+    Image = _load_pillow()
+    if Image is None:
+        return media_type, data
+
+    from PIL import ImageOps
+
+    try:
+        raw = base64.b64decode(data, validate=True)
+        image = Image.open(io.BytesIO(raw))
+        image.load()
+        # The re-encode drops EXIF, so phone photos would arrive rotated.
+        image = ImageOps.exif_transpose(image)
+    except Exception:
+        # Anything Pillow rejects, decompression bombs included, goes
+        # upstream as it came.
+        logger.debug("Could not decode %s image; sending it unchanged", media_type)
+        return media_type, data
+
+    if getattr(image, "is_animated", False):
+        return media_type, data
+
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+
+    # Screenshots rarely need transparency, but keep it when present.
+    output = io.BytesIO()
+    if image.mode in {"RGBA", "LA"} or "transparency" in image.info:
+        image.save(output, format="PNG", optimize=True)
+        new_media_type = "image/png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        new_media_type = "image/jpeg"
+
+    processed = output.getvalue()
+    if len(processed) >= len(raw):
+        return media_type, data
+
+    logger.debug(
+        "Image %sx%s %s %s bytes -> %s %s bytes",
+        image.width,
+        image.height,
+        media_type,
+        len(raw),
+        new_media_type,
+        len(processed),
+    )
+    return new_media_type, base64.b64encode(processed).decode("ascii")
+
+
+def preprocess_image(media_type: str, data: str) -> tuple[str, str]:
+    # Returns the input unchanged when preprocessing is off, Pillow is
+    # missing, or the recompressed image would not be smaller.
+    max_size = state.image_max_size
+    if not max_size or not isinstance(data, str):
+        return media_type, data
+
+    quality = state.image_quality
+    digest = hashlib.sha256(f"{max_size}:{quality}:{media_type}:".encode())
+    digest.update(data.encode("ascii", errors="replace"))
+    key = digest.hexdigest()
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+
+    result = _shrink(media_type, data, max_size, quality)
+
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > IMAGE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
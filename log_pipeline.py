@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import atexit
+import copy
+import json
+import logging
+import queue
+import random
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable
+
+from access_log import active_request_id
+
+LOG_FORMATS = ("text", "json")
+TEXT_FORMAT = "%(levelname)s: %(message)s"
+
+# Attributes every LogRecord has; anything else was passed with extra= and
+# becomes a field of its own in JSON output. Uvicorn passes a copy of each
+# message with terminal colors as color_message.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "request_id",
+    "color_message",
+}
+
+_listener: QueueListener | None = None
+_handler: logging.Handler | None = None
+
+
+class Lazy:
+    # A log argument computed only when a record using it is written, so a
+    # disabled level or a sampled-out line skips the work. The value is kept
+    # for code that needs it as well.
+    __slots__ = ("_func", "_args", "_value", "_done")
+
+    def __init__(self, func: Callable[..., Any], *args: Any):
+        self._func = func
+        self._args = args
+        self._value: Any = None
+        self._done = False
+
+    def get(self) -> Any:
+        if not self._done:
+            self._value = self._func(*self._args)
+            self._done = True
+        return self._value
+
+    def __str__(self) -> str:
+        return str(self.get())
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a fraction of the INFO and DEBUG records of the configured
+    # loggers; warnings and errors always pass.
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        # The longest configured prefix wins: "routes" covers "routes.anthropic".
+        while name not in self.rates:
+            if "." not in name:
+                return 1.0
+            name = name.rpartition(".")[0]
+        return self.rates[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._resolved.get(record.name)
+        if rate is None:
+            rate = self._resolved[record.name] = self._rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class _PreparingQueueHandler(QueueHandler):
+    # Runs on the thread that logged. Arguments are merged into the message
+    # here, while they still hold their values at the time of the call, and
+    # the request id is taken from the caller's context. Everything else,
+    # including the write itself, happens on the listener thread.
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        record.request_id = active_request_id()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        document: dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec="milliseconds")
+            .replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id is not None:
+            document["request_id"] = request_id
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                document[name] = value
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        if record.stack_info:
+            document["stack"] = record.stack_info
+        return json.dumps(document, default=str, ensure_ascii=False)
+
+
+def parse_log_sample(values: list[str]) -> dict[str, float]:
+    # "LOGGER=RATE" entries, e.g. ["httpx=0.1", "uvicorn.access=0"].
+    rates: dict[str, float] = {}
+    for value in values:
+        name, _, rate = value.partition("=")
+        name = name.strip()
+        if not name:
+            raise ValueError(f"Missing logger name in {value!r}")
+        try:
+            parsed = float(rate)
+        except ValueError:
+            raise ValueError(f"Invalid rate in {value!r}") from None
+        if not 0 <= parsed <= 1:
+            raise ValueError(f"Rate in {value!r} must be in [0, 1]")
+        rates[name] = parsed
+    return rates
+
+
+def setup_logging(
+    level: int | str,
+    log_format: str = "text",
+    sample_rates: dict[str, float] | None = None,
+) -> None:
+    # Log calls only put the record on a queue; a listener thread formats
+    # and writes to stderr, so a slow terminal or pipe never blocks the
+    # event loop. Calling this again replaces the previous setup.
+    global _listener, _handler
+
+    stop_logging()
+
+    output = logging.StreamHandler()
+    output.setFormatter(
+        JsonFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    )
+    records: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    _handler = _PreparingQueueHandler(records)
+    if sample_rates:
+        _handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener = QueueListener(records, output)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    # Writes out whatever is still queued.
+    global _listener, _handler
+
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
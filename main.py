@@ -4,18 +4,15 @@ import asyncio
 import logging
 
 import typer
-import uvicorn
-
-from model_cache import cache_models
-from paths import GITHUB_TOKEN_PATH, ensure_paths
-from server import server
-from state import state
-from copilot_token import (
-    setup_copilot_token,
-    setup_github_token,
-    stop_copilot_token_refresh,
-)
-from vscode_version import cache_vscode_version
+
+# Only what option defaults and help texts need is imported here. Each
+# command imports the rest itself, so `auth` and `--help` do not load
+# FastAPI, uvicorn, httpx or NumPy (see `python -m benchmarks.startup`).
+from bench_routes import BENCH_ROUTES
+from context_budget import CONTEXT_STRATEGIES
+from log_pipeline import LOG_FORMATS
+from paths import GITHUB_TOKEN_PATH, USAGE_DB_PATH, ensure_paths
+from serving import HTTP_PARSERS, LOOPS, SERVERS, ServeOptions
 
 app = typer.Typer(
     name="copilot-api",
@@ -29,15 +26,42 @@ app = typer.Typer(
 logger = logging.getLogger(__name__)
 
 
-def _setup_logging(verbose: bool) -> None:
-    level = logging.DEBUG if verbose else logging.INFO
-    logging.basicConfig(level=level, format="%(levelname)s: %(message)s")
+def _setup_logging(
+    verbose: bool,
+    log_format: str = "text",
+    sample_rates: dict[str, float] | None = None,
+) -> None:
+    from log_pipeline import setup_logging
+
+    setup_logging(logging.DEBUG if verbose else logging.INFO, log_format, sample_rates)
     if verbose:
         logger.info("Verbose logging enabled")
 
 
+def _check_serve_options(options: ServeOptions) -> None:
+    for value, choices, hint in (
+        (options.server, SERVERS, "--server"),
+        (options.loop, LOOPS, "--loop"),
+        (options.http, HTTP_PARSERS, "--http"),
+    ):
+        if value not in choices:
+            raise typer.BadParameter(
+                f"Expected one of {', '.join(choices)}", param_hint=hint
+            )
+    if options.server == "hypercorn" and options.http != "auto":
+        raise typer.BadParameter(
+            "hypercorn has its own HTTP parser", param_hint="--http"
+        )
+    missing = options.missing_requirement()
+    if missing:
+        package, option = missing
+        raise typer.BadParameter(
+            f"requires {package}: pip install -e '.[{package}]'", param_hint=option
+        )
+
+
 async def _run_server(
-    port: int,
+    address: str,
     verbose: bool,
     business: bool,
     enterprise: bool,
@@ -45,7 +69,41 @@ async def _run_server(
     rate_limit: int | None,
     wait: bool,
     github_token: str | None,
+    admin: bool,
+    profile_slow_ms: int | None,
+    upstream_url: str | None,
+    record: str | None,
+    replay: str | None,
+    replay_timing: str,
+    image_max_size: int | None,
+    image_quality: int,
+    semantic_cache: dict[str, float],
+    semantic_cache_size: int,
+    semantic_cache_eviction: str,
+    semantic_cache_model: str,
+    context_fit: list[str],
+    context_keep_recent: int,
+    single_flight: bool,
+    stream_buffer: int,
+    stream_heartbeat: float,
+    upstream_timeouts: dict[str, dict[str, float]],
+    usage_ledger: bool,
+    usage_db: str | None,
+    batch_concurrency: int,
+    adaptive_concurrency: bool,
+    max_concurrency: int,
+    concurrency_queue_timeout: float,
+    debug_captures: int,
+    debug_capture_bytes: int,
+    log_format: str,
+    log_sample: dict[str, float],
 ) -> None:
+    from copilot_token import setup_copilot_token, setup_github_token
+    from model_cache import cache_models
+    from services.get_vscode_version import FALLBACK as FALLBACK_VSCODE_VERSION
+    from state import state
+    from vscode_version import cache_vscode_version
+
     # Default to business endpoints unless enterprise is explicitly requested.
     state.account_type = "business"
 
@@ -59,10 +117,53 @@ async def _run_server(
         logger.info("Using business plan GitHub account (default)")
 
     state.manual_approve = manual
+    state.upstream_url = upstream_url
     state.rate_limit_seconds = rate_limit
     state.rate_limit_wait = wait
+    state.admin_enabled = admin
+    state.profile_slow_ms = profile_slow_ms
+    state.record_dir = record
+    state.replay_dir = replay
+    state.replay_timing = replay_timing
+    state.image_max_size = image_max_size
+    state.image_quality = image_quality
+    state.semantic_cache = semantic_cache
+    state.semantic_cache_size = semantic_cache_size
+    state.semantic_cache_eviction = semantic_cache_eviction
+    state.semantic_cache_model = semantic_cache_model
+    state.context_fit = context_fit
+    state.context_keep_recent = context_keep_recent
+    state.single_flight = single_flight
+    state.stream_buffer = stream_buffer
+    state.stream_heartbeat = stream_heartbeat
+    state.upstream_timeouts = upstream_timeouts
+    state.usage_ledger = usage_ledger
+    state.usage_db = usage_db or str(USAGE_DB_PATH)
+    state.batch_concurrency = batch_concurrency
+    state.adaptive_concurrency = adaptive_concurrency
+    state.max_concurrency = max_concurrency
+    state.concurrency_queue_timeout = concurrency_queue_timeout
+    state.debug_captures = debug_captures
+    state.debug_capture_bytes = debug_capture_bytes
+    state.log_format = log_format
+    state.log_sample = log_sample
 
     ensure_paths()
+
+    if replay:
+        # Replays never reach GitHub; the token exchange itself is replayed
+        # from the cassette with its secret redacted.
+        logger.info("Replaying upstream traffic from %s (%s timing)", replay, replay_timing)
+        state.vscode_version = FALLBACK_VSCODE_VERSION
+        state.github_token = "replay"
+        await setup_copilot_token()
+        await cache_models()
+        logger.info("Server started at %s", address)
+        return
+
+    if record:
+        logger.info("Recording upstream traffic to %s", record)
+
     await cache_vscode_version()
 
     if github_token:
@@ -74,13 +175,16 @@ async def _run_server(
     await setup_copilot_token()
     await cache_models()
 
-    server_url = f"http://localhost:{port}"
-    logger.info("Server started at %s", server_url)
+    logger.info("Server started at %s", address)
 
 
 @app.command()
 def start(
     port: int = typer.Option(4141, "--port", "-p", help="Port to listen on"),
+    host: str = typer.Option("0.0.0.0", "--host", help="Address to listen on"),
+    uds: str | None = typer.Option(
+        None, "--uds", help="Listen on this unix domain socket instead of host and port"
+    ),
     verbose: bool = typer.Option(
         False, "--verbose", "-v", help="Enable verbose logging"
     ),
@@ -110,13 +214,282 @@ def start(
             "Provide GitHub token directly (must be generated using the `auth` subcommand)"
         ),
     ),
+    admin: bool = typer.Option(
+        False,
+        "--admin",
+        help="Serve the /admin endpoints (CPU profiling and memory snapshots)",
+    ),
+    profile_slow_ms: int | None = typer.Option(
+        None,
+        "--profile-slow-ms",
+        min=1,
+        help="Write a sampled CPU profile for every request slower than this",
+    ),
+    upstream_url: str | None = typer.Option(
+        None,
+        "--upstream-url",
+        help=(
+            "Send Copilot API and token requests to this base URL instead, "
+            "e.g. a server started with the `mock` subcommand"
+        ),
+    ),
+    record: str | None = typer.Option(
+        None,
+        "--record",
+        help="Append every upstream exchange, secrets removed, to cassettes in this directory",
+    ),
+    replay: str | None = typer.Option(
+        None,
+        "--replay",
+        help="Serve upstream exchanges from cassettes in this directory instead of the network",
+    ),
+    replay_timing: str = typer.Option(
+        "original",
+        "--replay-timing",
+        help="Replay with the recorded timing (original) or as fast as possible (fast)",
+    ),
+    image_max_size: int | None = typer.Option(
+        None,
+        "--image-max-size",
+        min=64,
+        help="Downscale base64 images so their longest side is at most this many pixels",
+    ),
+    image_quality: int = typer.Option(
+        85,
+        "--image-quality",
+        min=1,
+        max=95,
+        help="JPEG quality used when recompressing images",
+    ),
+    semantic_cache: list[str] | None = typer.Option(
+        None,
+        "--semantic-cache",
+        help=(
+            "Serve non-streaming responses for near-duplicate prompts from a cache, "
+            "as ROUTE=THRESHOLD with ROUTE chat or messages; repeatable"
+        ),
+    ),
+    semantic_cache_size: int = typer.Option(
+        1000, "--semantic-cache-size", min=1, help="Maximum cached responses"
+    ),
+    semantic_cache_eviction: str = typer.Option(
+        "lru",
+        "--semantic-cache-eviction",
+        help="Entry evicted when the cache is full: lru or fifo",
+    ),
+    semantic_cache_model: str = typer.Option(
+        "text-embedding-3-small",
+        "--semantic-cache-model",
+        help="Embedding model used for semantic cache lookups",
+    ),
+    context_fit: str | None = typer.Option(
+        None,
+        "--context-fit",
+        help=(
+            "Trim prompts that exceed the model's limit with these strategies, in order: "
+            f"{', '.join(CONTEXT_STRATEGIES)} (comma-separated)"
+        ),
+    ),
+    context_keep_recent: int = typer.Option(
+        10,
+        "--context-keep-recent",
+        min=1,
+        help="Turns kept by the keep_recent strategy",
+    ),
+    single_flight: bool = typer.Option(
+        True,
+        "--single-flight/--no-single-flight",
+        help="Let identical concurrent requests share one upstream call or stream",
+    ),
+    stream_buffer: int = typer.Option(
+        64,
+        "--stream-buffer",
+        min=1,
+        help="Chunks buffered per stream before a slow client holds up the upstream read",
+    ),
+    stream_heartbeat: float = typer.Option(
+        15.0,
+        "--stream-heartbeat",
+        min=0,
+        help="Seconds of stream silence before sending a heartbeat; 0 disables",
+    ),
+    timeout: list[str] | None = typer.Option(
+        None,
+        "--timeout",
+        help=(
+            # Spelled out: timeouts imports httpx. parse_timeouts checks them.
+            "Upstream timeout as KIND=SECONDS or KIND@SCOPE=SECONDS, with KIND one of "
+            "connect, ttfb, idle, total and SCOPE a route (chat, messages, embeddings) "
+            "or model id; 0 disables; repeatable"
+        ),
+    ),
+    usage_ledger: bool = typer.Option(
+        True,
+        "--usage-ledger/--no-usage-ledger",
+        help="Record token and latency totals per client and model",
+    ),
+    usage_db: str | None = typer.Option(
+        None,
+        "--usage-db",
+        help="SQLite file for the usage ledger (default: usage.sqlite3 in the app directory)",
+    ),
+    batch_concurrency: int = typer.Option(
+        4,
+        "--batch-concurrency",
+        min=1,
+        help="Batch API requests sent upstream at once, across all batches",
+    ),
+    adaptive_concurrency: bool = typer.Option(
+        True,
+        "--adaptive-concurrency/--no-adaptive-concurrency",
+        help="Limit concurrent upstream requests per model, adapting to 429s and latency",
+    ),
+    max_concurrency: int = typer.Option(
+        128,
+        "--max-concurrency",
+        min=1,
+        help="Highest adaptive limit on concurrent upstream requests per model",
+    ),
+    concurrency_queue_timeout: float = typer.Option(
+        30.0,
+        "--concurrency-queue-timeout",
+        min=0,
+        help="Seconds a request waits for the concurrency limit before failing with 429",
+    ),
+    debug_captures: int = typer.Option(
+        0,
+        "--debug-captures",
+        min=0,
+        help="Keep the last N requests with their upstream traffic for /admin/captures",
+    ),
+    debug_capture_bytes: int = typer.Option(
+        65536,
+        "--debug-capture-bytes",
+        min=1,
+        help="Bytes kept of each request and response body in a capture",
+    ),
+    log_format: str = typer.Option(
+        "text", "--log-format", help=f"Log output: {', '.join(LOG_FORMATS)}"
+    ),
+    log_sample: list[str] | None = typer.Option(
+        None,
+        "--log-sample",
+        help=(
+            "Keep only a fraction of a logger's INFO and DEBUG lines, as LOGGER=RATE "
+            "with RATE between 0 and 1; repeatable"
+        ),
+    ),
+    server_name: str = typer.Option(
+        "uvicorn", "--server", help=f"ASGI server: {', '.join(SERVERS)}"
+    ),
+    loop: str = typer.Option(
+        "auto",
+        "--loop",
+        help=f"Event loop: {', '.join(LOOPS)}; auto uses uvloop when installed",
+    ),
+    http: str = typer.Option(
+        "auto",
+        "--http",
+        help=f"HTTP parser: {', '.join(HTTP_PARSERS)}; auto uses httptools when installed",
+    ),
+    backlog: int = typer.Option(
+        2048, "--backlog", min=1, help="Connections queued before the server accepts them"
+    ),
+    keepalive: float = typer.Option(
+        5.0, "--keepalive", min=0, help="Seconds an idle keep-alive connection stays open"
+    ),
+    workers: int = typer.Option(
+        1,
+        "--workers",
+        min=1,
+        help=(
+            "Number of worker processes; workers share the Copilot token and "
+            "rate limit through a local coordinator"
+        ),
+    ),
 ) -> None:
-    _setup_logging(verbose)
+    from coordinator import start_coordinator, stop_coordinator
+    from copilot_token import stop_copilot_token_refresh
+    from semantic_cache import (
+        EVICTION_POLICIES,
+        parse_semantic_cache_thresholds,
+        semantic_cache_available,
+    )
+    from serving import serve
+    from log_pipeline import parse_log_sample
+    from timeouts import parse_timeouts
+
+    if log_format not in LOG_FORMATS:
+        raise typer.BadParameter(
+            f"Expected one of {', '.join(LOG_FORMATS)}", param_hint="--log-format"
+        )
+    try:
+        log_sample_rates = parse_log_sample(log_sample or [])
+    except ValueError as error:
+        raise typer.BadParameter(str(error), param_hint="--log-sample") from None
+    _setup_logging(verbose, log_format, log_sample_rates)
+
+    if workers > 1 and manual:
+        raise typer.BadParameter(
+            "--manual cannot be combined with --workers", param_hint="--manual"
+        )
+    if record and replay:
+        raise typer.BadParameter(
+            "--record cannot be combined with --replay", param_hint="--record"
+        )
+    if debug_captures and not admin:
+        raise typer.BadParameter(
+            "requires --admin, which serves /admin/captures",
+            param_hint="--debug-captures",
+        )
+    if replay_timing not in {"original", "fast"}:
+        raise typer.BadParameter(
+            "Expected 'original' or 'fast'", param_hint="--replay-timing"
+        )
+    try:
+        semantic_cache_thresholds = parse_semantic_cache_thresholds(semantic_cache or [])
+    except ValueError as error:
+        raise typer.BadParameter(str(error), param_hint="--semantic-cache") from None
+    if semantic_cache_thresholds and not semantic_cache_available():
+        raise typer.BadParameter(
+            "requires NumPy: pip install 'copilot-api-python[semantic-cache]'",
+            param_hint="--semantic-cache",
+        )
+    context_strategies = [
+        name.strip() for name in (context_fit or "").split(",") if name.strip()
+    ]
+    unknown_strategies = [
+        name for name in context_strategies if name not in CONTEXT_STRATEGIES
+    ]
+    if unknown_strategies:
+        raise typer.BadParameter(
+            f"Unknown strategies: {', '.join(unknown_strategies)}",
+            param_hint="--context-fit",
+        )
+    try:
+        upstream_timeouts = parse_timeouts(timeout or [])
+    except ValueError as error:
+        raise typer.BadParameter(str(error), param_hint="--timeout") from None
+    serve_options = ServeOptions(
+        server=server_name,
+        host=host,
+        port=port,
+        uds=uds,
+        loop=loop,
+        http=http,
+        backlog=backlog,
+        keepalive=keepalive,
+    )
+    _check_serve_options(serve_options)
+    if semantic_cache_eviction not in EVICTION_POLICIES:
+        raise typer.BadParameter(
+            "Expected 'lru' or 'fifo'", param_hint="--semantic-cache-eviction"
+        )
 
     try:
         asyncio.run(
             _run_server(
-                port=port,
+                address=serve_options.address(),
                 verbose=verbose,
                 business=business,
                 enterprise=enterprise,
@@ -124,10 +497,41 @@ def start(
                 rate_limit=rate_limit,
                 wait=wait,
                 github_token=github_token,
+                admin=admin,
+                profile_slow_ms=profile_slow_ms,
+                upstream_url=upstream_url,
+                record=record,
+                replay=replay,
+                replay_timing=replay_timing,
+                image_max_size=image_max_size,
+                image_quality=image_quality,
+                semantic_cache=semantic_cache_thresholds,
+                semantic_cache_size=semantic_cache_size,
+                semantic_cache_eviction=semantic_cache_eviction,
+                semantic_cache_model=semantic_cache_model,
+                context_fit=context_strategies,
+                context_keep_recent=context_keep_recent,
+                single_flight=single_flight,
+                stream_buffer=stream_buffer,
+                stream_heartbeat=stream_heartbeat,
+                upstream_timeouts=upstream_timeouts,
+                usage_ledger=usage_ledger,
+                usage_db=usage_db,
+                batch_concurrency=batch_concurrency,
+                adaptive_concurrency=adaptive_concurrency,
+                max_concurrency=max_concurrency,
+                concurrency_queue_timeout=concurrency_queue_timeout,
+                debug_captures=debug_captures,
+                debug_capture_bytes=debug_capture_bytes,
+                log_format=log_format,
+                log_sample=log_sample_rates,
             )
         )
-        uvicorn.run(server, host="0.0.0.0", port=port, log_level="info")
+        if workers > 1:
+            start_coordinator("DEBUG" if verbose else "INFO")
+        serve(serve_options, workers)
     finally:
+        stop_coordinator()
         stop_copilot_token_refresh()
 
 
@@ -137,6 +541,8 @@ def auth(
         False, "--verbose", "-v", help="Enable verbose logging"
     )
 ) -> None:
+    from copilot_token import setup_github_token
+
     _setup_logging(verbose)
 
     async def _run_auth() -> None:
@@ -147,6 +553,110 @@ def auth(
     asyncio.run(_run_auth())
 
 
+@app.command()
+def mock(
+    port: int = typer.Option(4142, "--port", "-p", help="Port to listen on"),
+    latency_ms: float = typer.Option(
+        50, "--latency-ms", help="Delay before each response starts"
+    ),
+    tokens_per_second: float = typer.Option(
+        200, "--tokens-per-second", help="Streaming rate; 0 streams without delay"
+    ),
+    completion_tokens: int = typer.Option(
+        64, "--completion-tokens", help="Tokens generated per completion"
+    ),
+    error_rate: float = typer.Option(
+        0.0, "--error-rate", min=0.0, max=1.0, help="Fraction of failed requests"
+    ),
+    error_status: int = typer.Option(
+        500, "--error-status", help="Status code of injected failures"
+    ),
+) -> None:
+    """Run a local mock of the Copilot API for load tests."""
+    import uvicorn
+
+    from mock_upstream import MockUpstreamConfig, create_mock_upstream
+
+    _setup_logging(False)
+    config = MockUpstreamConfig(
+        latency_ms=latency_ms,
+        tokens_per_second=tokens_per_second,
+        completion_tokens=completion_tokens,
+        error_rate=error_rate,
+        error_status=error_status,
+    )
+    logger.info("Mock Copilot upstream at http://localhost:%s", port)
+    uvicorn.run(create_mock_upstream(config), host="0.0.0.0", port=port, log_level="warning")
+
+
+@app.command()
+def bench(
+    routes: str = typer.Option(
+        ",".join(BENCH_ROUTES),
+        "--routes",
+        help=f"Comma-separated routes to run: {', '.join(BENCH_ROUTES)}",
+    ),
+    requests: int = typer.Option(200, "--requests", "-n", min=1, help="Requests per route"),
+    concurrency: int = typer.Option(
+        20, "--concurrency", "-c", min=1, help="Concurrent requests"
+    ),
+    latency_ms: float = typer.Option(
+        50, "--latency-ms", help="Mock upstream delay before each response"
+    ),
+    tokens_per_second: float = typer.Option(
+        200, "--tokens-per-second", help="Mock upstream streaming rate"
+    ),
+    completion_tokens: int = typer.Option(
+        64, "--completion-tokens", help="Tokens per mock completion"
+    ),
+    error_rate: float = typer.Option(
+        0.0, "--error-rate", min=0.0, max=1.0, help="Fraction of failed upstream requests"
+    ),
+    loop: str = typer.Option(
+        "auto", "--loop", help=f"Proxy event loop: {', '.join(LOOPS)}"
+    ),
+    http: str = typer.Option(
+        "auto", "--http", help=f"Proxy HTTP parser: {', '.join(HTTP_PARSERS)}"
+    ),
+    uds: bool = typer.Option(
+        False, "--uds/--tcp", help="Connect to the proxy over a unix domain socket"
+    ),
+    verbose: bool = typer.Option(
+        False, "--verbose", "-v", help="Enable verbose logging"
+    ),
+) -> None:
+    """Benchmark the server against the bundled mock upstream."""
+    from bench import format_results, run_bench
+    from log_pipeline import setup_logging
+    from mock_upstream import MockUpstreamConfig
+
+    setup_logging(logging.INFO if verbose else logging.WARNING)
+
+    route_names = [name.strip() for name in routes.split(",") if name.strip()]
+    unknown = [name for name in route_names if name not in BENCH_ROUTES]
+    if unknown:
+        raise typer.BadParameter(
+            f"Unknown routes: {', '.join(unknown)}", param_hint="--routes"
+        )
+
+    _check_serve_options(ServeOptions(loop=loop, http=http))
+
+    ensure_paths()
+    results = run_bench(
+        route_names,
+        total_requests=requests,
+        concurrency=concurrency,
+        mock_config=MockUpstreamConfig(
+            latency_ms=latency_ms,
+            tokens_per_second=tokens_per_second,
+            completion_tokens=completion_tokens,
+            error_rate=error_rate,
+        ),
+        server_config={"loop": loop, "http": http, "uds": uds or None},
+    )
+    typer.echo(format_results(results))
+
+
 def run() -> None:
     app()
 
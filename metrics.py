@@ -0,0 +1,344 @@
+from __future__ import annotations
+
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Any, AsyncGenerator
+
+from state import state
+
+# Minimal Prometheus text-format metrics. Updates are a dict lookup and an
+# add under a lock, cheap enough to stay enabled on every request and chunk.
+
+_registry: list[_Metric] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(v)}"
+            for labels, v in items
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = (),
+    ):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values: dict[tuple[str, ...], list[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[labels] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(labels, list(e[0]), e[1], e[2]) for labels, e in self._values.items()]
+
+        lines: list[str] = []
+        bucket_names = self.labelnames + ("le",)
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(bucket_names, labels + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUESTS = Counter(
+    "copilot_api_requests_total",
+    "Requests handled, by route, method and status code.",
+    ("route", "method", "status"),
+)
+REQUEST_DURATION = Histogram(
+    "copilot_api_request_duration_seconds",
+    "Time from request start until the last response byte was sent.",
+    ("route", "model"),
+    LATENCY_BUCKETS,
+)
+REQUEST_SIZE = Histogram(
+    "copilot_api_request_size_bytes",
+    "Request body size.",
+    ("route",),
+    SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "copilot_api_response_size_bytes",
+    "Response body size, including streamed bodies.",
+    ("route",),
+    SIZE_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "copilot_api_time_to_first_token_seconds",
+    "Time from request start until the first streamed content delta.",
+    ("route", "model"),
+    LATENCY_BUCKETS,
+)
+STREAM_TOKENS_PER_SECOND = Histogram(
+    "copilot_api_stream_tokens_per_second",
+    "Estimated output tokens per second after the first token of a stream.",
+    ("route", "model"),
+    (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500),
+)
+INFLIGHT_STREAMS = Gauge(
+    "copilot_api_inflight_streams",
+    "Streaming responses currently being sent.",
+    ("route",),
+)
+UPSTREAM_RESPONSES = Counter(
+    "copilot_api_upstream_responses_total",
+    "Upstream responses, by endpoint and status code.",
+    ("endpoint", "status"),
+)
+RATE_LIMIT_WAITING = Gauge(
+    "copilot_api_rate_limit_waiting",
+    "Requests currently waiting on the rate limit.",
+)
+TOKEN_REFRESHES = Counter(
+    "copilot_api_token_refresh_total",
+    "Copilot token refresh attempts, by outcome.",
+    ("outcome",),
+)
+SINGLE_FLIGHT_DEDUPED = Counter(
+    "copilot_api_single_flight_deduplicated_total",
+    "Requests answered by joining an identical in-flight upstream call.",
+    ("endpoint",),
+)
+CONVERSION_CACHE_MESSAGES = Counter(
+    "copilot_api_conversion_cache_messages_total",
+    "Anthropic messages reused from the conversion cache (hit) or converted (miss).",
+    ("outcome",),
+)
+SEMANTIC_CACHE_LOOKUPS = Counter(
+    "copilot_api_semantic_cache_lookups_total",
+    "Semantic cache lookups, by route and outcome (hit, miss, skipped, error).",
+    ("route", "outcome"),
+)
+UPSTREAM_TIMEOUTS = Counter(
+    "copilot_api_upstream_timeouts_total",
+    "Requests failed by a timeout, by kind (connect, ttfb, idle, total, deadline).",
+    ("kind",),
+)
+STREAM_DISCONNECTS = Counter(
+    "copilot_api_stream_client_disconnects_total",
+    "Streams cancelled because the client disconnected.",
+    ("route",),
+)
+CONCURRENCY_LIMIT = Gauge(
+    "copilot_api_upstream_concurrency_limit",
+    "Adaptive limit on concurrent upstream requests, by model.",
+    ("model",),
+)
+CONCURRENCY_QUEUED = Gauge(
+    "copilot_api_upstream_concurrency_queued",
+    "Requests waiting for the model's upstream concurrency limit.",
+    ("model",),
+)
+CONCURRENCY_DECREASES = Counter(
+    "copilot_api_upstream_concurrency_decreases_total",
+    "Adaptive concurrency limit decreases, by model and reason (rate_limited, latency, headroom, timeout).",
+    ("model", "reason"),
+)
+SEMANTIC_CACHE_ENTRIES = Gauge(
+    "copilot_api_semantic_cache_entries",
+    "Responses currently held in the semantic cache.",
+)
+
+
+def route_label(scope: dict[str, Any]) -> str:
+    # Endpoint names stay low-cardinality and are shared by the /v1 aliases.
+    route = scope.get("route")
+    return getattr(route, "name", None) or "unmatched"
+
+
+def chunk_text_length(chunk: dict[str, Any]) -> int:
+    length = 0
+    for choice in chunk.get("choices") or []:
+        delta = choice.get("delta") or {}
+        content = delta.get("content")
+        if content:
+            length += len(content)
+        for tool_delta in delta.get("tool_calls") or []:
+            arguments = (tool_delta.get("function") or {}).get("arguments")
+            if arguments:
+                length += len(arguments)
+    return length
+
+
+def model_label(model: Any) -> str:
+    # Model names come from the client, so only models upstream lists get a
+    # series of their own; anything else would let a client create any
+    # number of them.
+    if not model:
+        return ""
+    name = str(model)
+    models = (state.models or {}).get("data")
+    if isinstance(models, list) and any(
+        isinstance(entry, dict) and entry.get("id") == name for entry in models
+    ):
+        return name
+    return "other"
+
+
+async def track_stream(
+    stream: AsyncGenerator[dict[str, Any] | str, None],
+    route: str,
+    model: str,
+    started: float,
+) -> AsyncGenerator[dict[str, Any] | str, None]:
+    first_token_at: float | None = None
+    output_chars = 0
+    model = model_label(model)
+
+    INFLIGHT_STREAMS.inc(route)
+    try:
+        async for chunk in stream:
+            if isinstance(chunk, dict):
+                length = chunk_text_length(chunk)
+                if length:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        TIME_TO_FIRST_TOKEN.observe(first_token_at - started, route, model)
+                    output_chars += length
+            yield chunk
+    finally:
+        INFLIGHT_STREAMS.dec(route)
+        if first_token_at is not None:
+            elapsed = time.perf_counter() - first_token_at
+            if elapsed > 0:
+                # Same ~4 characters per token estimate as tokenizer.py.
+                STREAM_TOKENS_PER_SECOND.observe((output_chars / 4) / elapsed, route, model)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        request_bytes = 0
+        response_bytes = 0
+        status = 500
+
+        async def receive_wrapper() -> dict[str, Any]:
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message: dict[str, Any]) -> None:
+            nonlocal response_bytes, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            route = route_label(scope)
+            model = model_label((scope.get("state") or {}).get("model"))
+            REQUESTS.inc(route, scope["method"], str(status))
+            REQUEST_DURATION.observe(time.perf_counter() - started, route, model)
+            REQUEST_SIZE.observe(request_bytes, route)
+            RESPONSE_SIZE.observe(response_bytes, route)
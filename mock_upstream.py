@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator
+from uuid import uuid4
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_MODELS = [
+    {
+        "id": "gpt-4o",
+        "object": "model",
+        "vendor": "mock",
+        "capabilities": {
+            "type": "chat",
+            "limits": {
+                "max_context_window_tokens": 128000,
+                "max_prompt_tokens": 64000,
+                "max_output_tokens": 4096,
+            },
+            "supports": {"tool_calls": True, "streaming": True, "vision": True},
+        },
+    },
+    {
+        "id": "claude-3.7-sonnet",
+        "object": "model",
+        "vendor": "mock",
+        "capabilities": {
+            "type": "chat",
+            "limits": {
+                "max_context_window_tokens": 200000,
+                "max_prompt_tokens": 90000,
+                "max_output_tokens": 8192,
+            },
+            "supports": {"tool_calls": True, "streaming": True, "vision": True},
+        },
+    },
+    {
+        "id": "text-embedding-3-small",
+        "object": "model",
+        "vendor": "mock",
+        "capabilities": {"type": "embeddings", "limits": {"max_inputs": 512}},
+    },
+]
+
+_WORDS = (
+    "the quick brown fox jumps over a lazy dog while the proxy converts "
+    "every chunk into server sent events for its clients"
+).split()
+
+
+@dataclass
+class MockUpstreamConfig:
+    latency_ms: float = 50
+    tokens_per_second: float = 200
+    completion_tokens: int = 64
+    embedding_dimensions: int = 1536
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> dict[str, int]:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _prompt_tokens(payload: dict[str, Any]) -> int:
+    return max(1, len(json.dumps(payload.get("messages", []))) // 4)
+
+
+def _tool_call(payload: dict[str, Any]) -> dict[str, Any] | None:
+    tools = payload.get("tools") or []
+    if not tools:
+        return None
+    name = (tools[0].get("function") or {}).get("name") or "tool"
+    return {
+        "id": f"call_{uuid4().hex[:12]}",
+        "type": "function",
+        "function": {"name": name, "arguments": json.dumps({"query": "mock"})},
+    }
+
+
+def create_mock_upstream(config: MockUpstreamConfig) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random()
+
+    async def _maybe_fail() -> JSONResponse | None:
+        await asyncio.sleep(config.latency_ms / 1000)
+        if config.error_rate and rng.random() < config.error_rate:
+            return JSONResponse(
+                status_code=config.error_status,
+                content={"error": {"message": "Injected mock error", "type": "mock"}},
+            )
+        return None
+
+    async def _stream_chunks(payload: dict[str, Any]) -> AsyncGenerator[str, None]:
+        completion_id = f"chatcmpl-{uuid4().hex}"
+        created = int(time.time())
+        model = payload.get("model")
+        delay = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+
+        def chunk(delta: dict[str, Any], finish_reason: str | None = None) -> str:
+            body = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            return f"data: {json.dumps(body)}\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for i in range(config.completion_tokens):
+            if delay:
+                await asyncio.sleep(delay)
+            yield chunk({"content": _WORDS[i % len(_WORDS)] + " "})
+
+        tool_call = _tool_call(payload)
+        if tool_call is not None:
+            arguments = tool_call["function"]["arguments"]
+            yield chunk(
+                {
+                    "tool_calls": [
+                        {
+                            "index": 0,
+                            "id": tool_call["id"],
+                            "type": "function",
+                            "function": {"name": tool_call["function"]["name"], "arguments": ""},
+                        }
+                    ]
+                }
+            )
+            for start in range(0, len(arguments), 4):
+                yield chunk(
+                    {
+                        "tool_calls": [
+                            {"index": 0, "function": {"arguments": arguments[start : start + 4]}}
+                        ]
+                    }
+                )
+
+        yield chunk({}, "tool_calls" if tool_call else "stop")
+
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": _usage(_prompt_tokens(payload), config.completion_tokens),
+            }
+            yield f"data: {json.dumps(usage_chunk)}\n\n"
+
+        yield "data: [DONE]\n\n"
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        payload = await request.json()
+        error = await _maybe_fail()
+        if error is not None:
+            return error
+
+        if payload.get("stream"):
+            return StreamingResponse(
+                _stream_chunks(payload), media_type="text/event-stream"
+            )
+
+        if config.tokens_per_second > 0:
+            await asyncio.sleep(config.completion_tokens / config.tokens_per_second)
+
+        tool_call = _tool_call(payload)
+        message: dict[str, Any] = {
+            "role": "assistant",
+            "content": " ".join(
+                _WORDS[i % len(_WORDS)] for i in range(config.completion_tokens)
+            ),
+        }
+        if tool_call is not None:
+            message["tool_calls"] = [tool_call]
+
+        return JSONResponse(
+            content={
+                "id": f"chatcmpl-{uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "tool_calls" if tool_call else "stop",
+                    }
+                ],
+                "usage": _usage(_prompt_tokens(payload), config.completion_tokens),
+            }
+        )
+
+    @app.post("/embeddings")
+    async def embeddings(request: Request):
+        payload = await request.json()
+        error = await _maybe_fail()
+        if error is not None:
+            return error
+
+        inputs = payload.get("input")
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+
+        data = []
+        for index, text in enumerate(inputs):
+            seed = hashlib.sha256(str(text).encode("utf-8")).digest()
+            vector_rng = random.Random(seed)
+            data.append(
+                {
+                    "object": "embedding",
+                    "index": index,
+                    "embedding": [
+                        vector_rng.uniform(-1, 1)
+                        for _ in range(config.embedding_dimensions)
+                    ],
+                }
+            )
+
+        tokens = sum(len(str(text)) // 4 + 1 for text in inputs)
+        return JSONResponse(
+            content={
+                "object": "list",
+                "data": data,
+                "model": payload.get("model"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            }
+        )
+
+    @app.get("/models")
+    async def models():
+        return JSONResponse(content={"object": "list", "data": MOCK_MODELS})
+
+    @app.get("/copilot_internal/v2/token")
+    async def copilot_token():
+        now = int(time.time())
+        return JSONResponse(
+            content={
+                "token": f"mock-copilot-token-{uuid4().hex}",
+                "expires_at": now + 1800,
+                "refresh_in": 1500,
+            }
+        )
+
+    return app
@@ -4,6 +4,9 @@ from pathlib import Path
 
 APP_DIR = Path.home() / ".local" / "share" / "copilot-api"
 GITHUB_TOKEN_PATH = APP_DIR / "github_token"
+PROFILES_DIR = APP_DIR / "profiles"
+USAGE_DB_PATH = APP_DIR / "usage.sqlite3"
+BATCHES_DIR = APP_DIR / "batches"
 
 
 def ensure_paths() -> None:
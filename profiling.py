@@ -0,0 +1,313 @@
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from errors import HTTPError
+from paths import PROFILES_DIR
+from state import state
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 0.005
+SLOW_REQUEST_SAMPLE_INTERVAL_SECONDS = 0.01
+SLOW_REQUEST_WINDOW_SECONDS = 300
+MAX_PROFILE_SECONDS = 300
+
+_cpu_profile_lock = asyncio.Lock()
+_slow_request_sampler: StackSampler | None = None
+_last_memory_snapshot: tracemalloc.Snapshot | None = None
+# Snapshots run in a worker thread; one at a time, so each is compared to
+# the one before it.
+_memory_snapshot_lock = threading.Lock()
+
+
+def _profile_path(kind: str, suffix: str) -> Path:
+    PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    return PROFILES_DIR / f"{kind}-{stamp}.{suffix}"
+
+
+class StackSampler:
+    # Periodically samples the Python stack of one thread (normally the
+    # event loop thread) from a background thread.
+
+    def __init__(
+        self,
+        thread_id: int,
+        interval: float,
+        max_samples: int | None = None,
+    ):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames: list[tuple[str, str, int]] = []
+        self.samples: deque[tuple[float, tuple[int, ...]]] = deque(maxlen=max_samples)
+        self._frame_ids: dict[tuple[str, str, int], int] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="copilot-api-sampler"
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack: list[int] = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_name, code.co_filename, code.co_firstlineno)
+                frame_id = self._frame_ids.get(key)
+                if frame_id is None:
+                    with self._lock:
+                        frame_id = len(self.frames)
+                        self.frames.append(key)
+                        self._frame_ids[key] = frame_id
+                stack.append(frame_id)
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                with self._lock:
+                    self.samples.append((time.perf_counter(), tuple(stack)))
+
+    def write_speedscope(
+        self,
+        path: Path,
+        name: str,
+        start: float | None = None,
+        end: float | None = None,
+    ) -> int:
+        with self._lock:
+            frames = list(self.frames)
+            samples = [
+                stack
+                for at, stack in self.samples
+                if (start is None or at >= start) and (end is None or at <= end)
+            ]
+
+        document = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "copilot-api",
+            "name": name,
+            "shared": {
+                "frames": [
+                    {"name": fn, "file": filename, "line": line}
+                    for fn, filename, line in frames
+                ]
+            },
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": len(samples) * self.interval,
+                    "samples": [list(stack) for stack in samples],
+                    "weights": [self.interval] * len(samples),
+                }
+            ],
+        }
+        path.write_text(json.dumps(document), encoding="utf-8")
+        return len(samples)
+
+
+async def capture_cpu_profile(seconds: float, output_format: str) -> dict[str, Any]:
+    seconds = max(0.1, min(seconds, MAX_PROFILE_SECONDS))
+
+    if _cpu_profile_lock.locked():
+        raise HTTPError(
+            message="A CPU profile is already running",
+            status_code=409,
+            response_text=json.dumps({"message": "A CPU profile is already running"}),
+        )
+
+    async with _cpu_profile_lock:
+        if output_format == "pstats":
+            # cProfile only traces the thread it is enabled on, which here is
+            # the event loop thread serving every request.
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+            path = _profile_path("cpu", "pstats")
+            profiler.dump_stats(str(path))
+            logger.info("CPU profile written to %s", path)
+            return {"path": str(path), "format": "pstats", "seconds": seconds}
+
+        sampler = StackSampler(threading.get_ident(), DEFAULT_SAMPLE_INTERVAL_SECONDS)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+        path = _profile_path("cpu", "speedscope.json")
+        sample_count = sampler.write_speedscope(path, f"CPU profile ({seconds}s)")
+        logger.info("CPU profile written to %s (%s samples)", path, sample_count)
+        return {
+            "path": str(path),
+            "format": "speedscope",
+            "seconds": seconds,
+            "samples": sample_count,
+        }
+
+
+def start_memory_tracing(frames: int) -> dict[str, Any]:
+    global _last_memory_snapshot
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        _last_memory_snapshot = None
+        logger.info("tracemalloc started with %s frames", frames)
+    return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+
+def stop_memory_tracing() -> dict[str, Any]:
+    global _last_memory_snapshot
+
+    tracemalloc.stop()
+    _last_memory_snapshot = None
+    return {"tracing": False}
+
+
+def take_memory_snapshot(limit: int) -> dict[str, Any]:
+    # Slow with many traced blocks and writes a file, so callers on the
+    # event loop run it with asyncio.to_thread.
+    with _memory_snapshot_lock:
+        return _take_memory_snapshot(limit)
+
+
+def _take_memory_snapshot(limit: int) -> dict[str, Any]:
+    global _last_memory_snapshot
+
+    if not tracemalloc.is_tracing():
+        message = "tracemalloc is not running; start memory tracing first"
+        raise HTTPError(
+            message=message,
+            status_code=409,
+            response_text=json.dumps({"message": message}),
+        )
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )
+    )
+    path = _profile_path("memory", "tracemalloc")
+    snapshot.dump(str(path))
+
+    previous = _last_memory_snapshot
+    _last_memory_snapshot = snapshot
+
+    if previous is None:
+        stats = snapshot.statistics("lineno")[:limit]
+        top = [
+            {
+                "location": str(stat.traceback),
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in stats
+        ]
+    else:
+        diffs = snapshot.compare_to(previous, "lineno")[:limit]
+        top = [
+            {
+                "location": str(diff.traceback),
+                "size_bytes": diff.size,
+                "size_diff_bytes": diff.size_diff,
+                "count": diff.count,
+                "count_diff": diff.count_diff,
+            }
+            for diff in diffs
+        ]
+
+    current, peak = tracemalloc.get_traced_memory()
+    logger.info("Memory snapshot written to %s", path)
+    return {
+        "path": str(path),
+        "compared_to_previous": previous is not None,
+        "traced_bytes": current,
+        "peak_traced_bytes": peak,
+        "top": top,
+    }
+
+
+def start_slow_request_profiling() -> None:
+    global _slow_request_sampler
+
+    if state.profile_slow_ms is None or _slow_request_sampler is not None:
+        return
+
+    max_samples = int(SLOW_REQUEST_WINDOW_SECONDS / SLOW_REQUEST_SAMPLE_INTERVAL_SECONDS)
+    _slow_request_sampler = StackSampler(
+        threading.get_ident(), SLOW_REQUEST_SAMPLE_INTERVAL_SECONDS, max_samples
+    )
+    _slow_request_sampler.start()
+    logger.info(
+        "Profiling requests slower than %sms into %s",
+        state.profile_slow_ms,
+        PROFILES_DIR,
+    )
+
+
+def stop_slow_request_profiling() -> None:
+    global _slow_request_sampler
+
+    if _slow_request_sampler is not None:
+        _slow_request_sampler.stop()
+        _slow_request_sampler = None
+
+
+class SlowRequestProfilerMiddleware:
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict[str, Any], receive: Any, send: Any) -> None:
+        sampler = _slow_request_sampler
+        if sampler is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ended = time.perf_counter()
+            duration_ms = (ended - started) * 1000
+            if state.profile_slow_ms is not None and duration_ms >= state.profile_slow_ms:
+                path = _profile_path("slow-request", "speedscope.json")
+                name = f"{scope['method']} {scope['path']} ({duration_ms:.0f}ms)"
+                # Samples cover the whole event loop, so concurrent requests
+                # show up in the profile as well.
+                sample_count = await asyncio.to_thread(
+                    sampler.write_speedscope, path, name, started, ended
+                )
+                logger.warning(
+                    "Slow request %s took %.0fms; profile written to %s (%s samples)",
+                    f"{scope['method']} {scope['path']}",
+                    duration_ms,
+                    path,
+                    sample_count,
+                )
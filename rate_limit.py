@@ -6,29 +6,53 @@ import math
 import time
 
 from errors import HTTPError
+from metrics import RATE_LIMIT_WAITING, UPSTREAM_TIMEOUTS
 from state import RuntimeState
+from timeouts import deadline_remaining, timeout_error
 
 logger = logging.getLogger(__name__)
 
 
-async def check_rate_limit(state: RuntimeState) -> None:
+def reserve_rate_limit_slot(state: RuntimeState) -> int | None:
+    # Returns None when the request may proceed, otherwise the seconds to wait.
     if state.rate_limit_seconds is None:
-        return
+        return None
 
     now = time.time()
 
     with state.rate_limit_lock:
         if state.last_request_timestamp is None:
             state.last_request_timestamp = now
-            return
+            return None
 
         elapsed_seconds = now - state.last_request_timestamp
 
         if elapsed_seconds > state.rate_limit_seconds:
             state.last_request_timestamp = now
-            return
+            return None
+
+        return math.ceil(state.rate_limit_seconds - elapsed_seconds)
+
+
+def mark_rate_limited_request(state: RuntimeState) -> None:
+    with state.rate_limit_lock:
+        state.last_request_timestamp = time.time()
 
-        wait_time_seconds = math.ceil(state.rate_limit_seconds - elapsed_seconds)
+
+async def check_rate_limit(state: RuntimeState) -> None:
+    if state.rate_limit_seconds is None:
+        return
+
+    if state.coordinator_path:
+        from coordinator import request_coordinator
+
+        reply = await request_coordinator("rate_limit_reserve")
+        wait_time_seconds = reply.get("wait")
+    else:
+        wait_time_seconds = reserve_rate_limit_slot(state)
+
+    if wait_time_seconds is None:
+        return
 
     if not state.rate_limit_wait:
         logger.warning(
@@ -40,14 +64,29 @@ async def check_rate_limit(state: RuntimeState) -> None:
             response_text=json.dumps({"message": "Rate limit exceeded"}),
         )
 
+    remaining = deadline_remaining()
+    if remaining is not None and remaining < wait_time_seconds:
+        # Waiting would only end in a timeout; fail while the client can
+        # still retry elsewhere.
+        UPSTREAM_TIMEOUTS.inc("deadline")
+        raise timeout_error("Request deadline expires before the rate-limit wait ends")
+
     logger.warning(
         "Rate limit reached. Waiting %s seconds before proceeding...",
         wait_time_seconds,
     )
-    await anyio_sleep(wait_time_seconds)
-
-    with state.rate_limit_lock:
-        state.last_request_timestamp = time.time()
+    RATE_LIMIT_WAITING.inc()
+    try:
+        await anyio_sleep(wait_time_seconds)
+    finally:
+        RATE_LIMIT_WAITING.dec()
+
+    if state.coordinator_path:
+        from coordinator import request_coordinator
+
+        await request_coordinator("rate_limit_mark")
+    else:
+        mark_rate_limited_request(state)
 
     logger.info("Rate limit wait completed, proceeding with request")
 
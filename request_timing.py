@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Iterator
+
+logger = logging.getLogger(__name__)
+
+_current_timing: ContextVar[RequestTiming | None] = ContextVar(
+    "copilot_api_request_timing", default=None
+)
+
+# httpcore trace event name -> phase it is accounted to.
+_TRACE_PHASES = {
+    "connect_tcp": "upstream_connect",
+    "start_tls": "upstream_connect",
+}
+
+
+class RequestTiming:
+    def __init__(self, route: str, request_id: str):
+        self.route = route
+        self.request_id = request_id
+        self.upstream_request_id: str | None = None
+        self.phases: dict[str, float] = {}
+        self.started = time.perf_counter()
+        self._trace_starts: dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    async def httpx_trace(self, event_name: str, info: dict[str, Any]) -> None:
+        # Passed as httpx's "trace" request extension; event names look like
+        # "connection.connect_tcp.started" or "http11.receive_response_headers.complete".
+        _, _, event = event_name.partition(".")
+        step, _, stage = event.rpartition(".")
+        now = time.perf_counter()
+
+        if stage == "started":
+            self._trace_starts[step] = now
+            return
+        if stage != "complete":
+            return
+
+        if step in _TRACE_PHASES and step in self._trace_starts:
+            self.add(_TRACE_PHASES[step], now - self._trace_starts.pop(step))
+        elif step == "receive_response_headers" and "send_request_headers" in self._trace_starts:
+            self.add("upstream_ttfb", now - self._trace_starts.pop("send_request_headers"))
+
+    def server_timing_header(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def log(self) -> None:
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        phases_ms = {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+        total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        logger.info(
+            "Request timing route=%s requestId=%s upstreamRequestId=%s total=%.1fms %s",
+            self.route,
+            self.request_id,
+            self.upstream_request_id,
+            total_ms,
+            " ".join(f"{name}={ms:.1f}ms" for name, ms in phases_ms.items()),
+            extra={
+                "route": self.route,
+                "upstream_request_id": self.upstream_request_id,
+                "total_ms": total_ms,
+                "phases_ms": phases_ms,
+            },
+        )
+
+
+async def log_timing_after_stream(
+    stream: AsyncGenerator[str, None],
+    timing: RequestTiming,
+) -> AsyncGenerator[str, None]:
+    # Headers are already sent when a stream starts, so the streamed phases
+    # only reach the log line.
+    start = time.perf_counter()
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        timing.add("stream", time.perf_counter() - start)
+        timing.log()
+
+
+def start_request_timing(route: str, request_id: str) -> RequestTiming:
+    timing = RequestTiming(route, request_id)
+    _current_timing.set(timing)
+    return timing
+
+
+def current_timing() -> RequestTiming | None:
+    return _current_timing.get()
+
+
+@contextmanager
+def timed_phase(name: str) -> Iterator[None]:
+    timing = _current_timing.get()
+    if timing is None:
+        yield
+        return
+    with timing.phase(name):
+        yield
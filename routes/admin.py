@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+
+from debug_capture import clear_captures, get_capture, list_captures
+from forward_error import forward_error
+from profiling import (
+    capture_cpu_profile,
+    start_memory_tracing,
+    stop_memory_tracing,
+    take_memory_snapshot,
+)
+from state import state
+
+
+def require_admin() -> None:
+    if not state.admin_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.post("/profile/cpu")
+async def cpu_profile_route(
+    seconds: float = Query(10.0, gt=0),
+    format: str = Query("speedscope", pattern="^(speedscope|pstats)$"),
+):
+    try:
+        return JSONResponse(content=await capture_cpu_profile(seconds, format))
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.post("/memory/start")
+async def memory_start_route(frames: int = Query(25, ge=1, le=100)):
+    return JSONResponse(content=start_memory_tracing(frames))
+
+
+@router.post("/memory/snapshot")
+async def memory_snapshot_route(limit: int = Query(25, ge=1, le=500)):
+    try:
+        return JSONResponse(content=await asyncio.to_thread(take_memory_snapshot, limit))
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.post("/memory/stop")
+async def memory_stop_route():
+    return JSONResponse(content=stop_memory_tracing())
+
+
+@router.get("/captures")
+async def captures_route():
+    # Newest first; each entry is one worker's, as the buffer is per process.
+    return JSONResponse(content={"data": list_captures()})
+
+
+@router.get("/captures/{capture_id}")
+async def capture_route(capture_id: str):
+    try:
+        return JSONResponse(content=get_capture(capture_id))
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.delete("/captures")
+async def clear_captures_route():
+    return JSONResponse(content={"cleared": clear_captures()})
@@ -1,21 +1,45 @@
 from __future__ import annotations
 
+import asyncio
 import logging
-from uuid import uuid4
+import time
 
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse
 
+from access_log import current_request_id
 from approval import await_approval
+from context_budget import TRIMMED_HEADER, fit_to_context_budget
+from event_stream import ANTHROPIC_HEARTBEAT, EventStreamResponse
 from forward_error import anthropic_error_response
-from is_nullish import is_nullish
+from metrics import route_label, track_stream
 from rate_limit import check_rate_limit
+from request_timing import log_timing_after_stream, start_request_timing
+from semantic_cache import (
+    CACHE_HEADER,
+    lookup_semantic_cache,
+    store_semantic_cache,
+)
+from single_flight import (
+    broadcast_stream,
+    deterministic,
+    single_flight,
+    single_flight_enabled,
+)
 from state import state
+from timeouts import start_request_deadline
 from tokenizer import get_token_count
+from usage import (
+    client_key,
+    estimate_output_tokens,
+    record_usage,
+    request_stream_usage,
+    track_stream_usage,
+    upstream_usage,
+)
 from services.anthropic.converters import (
+    build_openai_payload,
     convert_anthropic_to_openai_messages,
-    convert_anthropic_tool_choice_to_openai,
-    convert_anthropic_tools_to_openai,
     convert_openai_to_anthropic_response,
 )
 from services.anthropic.streaming import convert_openai_stream_to_anthropic
@@ -26,115 +50,51 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-def select_copilot_model(anthropic_model: str) -> str:
-    model_name = anthropic_model.lower()
-
-    if not state.models or not isinstance(state.models.get("data"), list):
-        return "claude-3-5-sonnet-20241022"
-
-    models = [m for m in state.models["data"] if isinstance(m, dict)]
-
-    exact_match = next(
-        (m for m in models if str(m.get("id", "")).lower() == model_name),
-        None,
-    )
-    if exact_match:
-        logger.debug("Found exact model match: %s", exact_match.get("id"))
-        return str(exact_match.get("id"))
-
-    preferred_model = next(
-        (m for m in models if str(m.get("id", "")).lower() == "claude-3.7-sonnet"),
-        None,
-    )
-    if preferred_model:
-        logger.debug("Using preferred model: %s", preferred_model.get("id"))
-        return str(preferred_model.get("id"))
-
-    claude_model = next(
-        (m for m in models if "claude" in str(m.get("id", "")).lower()),
-        None,
-    )
-    if claude_model:
-        logger.debug("Using claude model: %s", claude_model.get("id"))
-        return str(claude_model.get("id"))
-
-    fallback_model = str(models[0].get("id", "claude-3-5-sonnet-20241022"))
-    logger.debug("Using fallback model: %s", fallback_model)
-    return fallback_model
-
-
 @router.post("")
 async def anthropic_messages(request: Request):
-    await check_rate_limit(state)
-
-    request_id = str(uuid4())
+    request_id = current_request_id()
+    timing = start_request_timing(route_label(request.scope), request_id)
 
     try:
-        anthropic_request = await request.json()
+        start_request_deadline("messages", request.headers)
+        client = client_key(request.headers)
+        with timing.phase("rate_limit"):
+            await check_rate_limit(state)
+
+        with timing.phase("parse"):
+            anthropic_request = await request.json()
 
         logger.info(
             "Received Anthropic messages request, requestModel: %s",
             anthropic_request.get("model"),
         )
 
-        if anthropic_request.get("messages"):
-            token_count = get_token_count(
-                convert_anthropic_to_openai_messages(
+        with timing.phase("convert"):
+            if state.image_max_size:
+                # Decoding and resizing new images takes tens of milliseconds,
+                # which must not stall other requests on the event loop.
+                openai_messages = await asyncio.to_thread(
+                    convert_anthropic_to_openai_messages,
                     anthropic_request.get("messages", []),
                     anthropic_request.get("system"),
                 )
-            )
+            else:
+                openai_messages = convert_anthropic_to_openai_messages(
+                    anthropic_request.get("messages", []),
+                    anthropic_request.get("system"),
+                )
+            openai_payload = build_openai_payload(anthropic_request, openai_messages)
+
+        with timing.phase("token_estimate"):
+            token_count = get_token_count(openai_messages)
+        if anthropic_request.get("messages"):
             logger.info("Estimated token count: %s", token_count)
 
         if state.manual_approve:
-            await await_approval()
+            with timing.phase("approval"):
+                await await_approval()
 
-        openai_messages = convert_anthropic_to_openai_messages(
-            anthropic_request.get("messages", []),
-            anthropic_request.get("system"),
-        )
-        openai_tools = convert_anthropic_tools_to_openai(anthropic_request.get("tools"))
-        openai_tool_choice = convert_anthropic_tool_choice_to_openai(
-            anthropic_request.get("tool_choice")
-        )
-
-        openai_payload: dict[str, object] = {
-            "model": select_copilot_model(str(anthropic_request.get("model", ""))),
-            "messages": openai_messages,
-            "stream": bool(anthropic_request.get("stream", False)),
-        }
-
-        if is_nullish(anthropic_request.get("max_tokens")):
-            selected_model = None
-            if state.models and isinstance(state.models.get("data"), list):
-                selected_model = next(
-                    (
-                        model
-                        for model in state.models["data"]
-                        if isinstance(model, dict)
-                        and model.get("id") == openai_payload["model"]
-                    ),
-                    None,
-                )
-            openai_payload["max_tokens"] = (
-                (selected_model or {})
-                .get("capabilities", {})
-                .get("limits", {})
-                .get("max_output_tokens")
-            )
-        else:
-            openai_payload["max_tokens"] = anthropic_request.get("max_tokens")
-
-        if anthropic_request.get("temperature") is not None:
-            openai_payload["temperature"] = anthropic_request.get("temperature")
-        if anthropic_request.get("top_p") is not None:
-            openai_payload["top_p"] = anthropic_request.get("top_p")
-        if anthropic_request.get("stop_sequences"):
-            openai_payload["stop"] = anthropic_request.get("stop_sequences")
-        if openai_tools:
-            openai_payload["tools"] = openai_tools
-        if openai_tool_choice:
-            openai_payload["tool_choice"] = openai_tool_choice
+        request.state.model = openai_payload["model"]
 
         logger.debug(
             "Converted to OpenAI payload model=%s messageCount=%s hasTools=%s requestId=%s",
@@ -144,24 +104,92 @@ async def anthropic_messages(request: Request):
             request_id,
         )
 
-        response = await create_chat_completions(openai_payload)
+        trimmed = None
+        if state.context_fit:
+            with timing.phase("context_fit"):
+                trimmed = fit_to_context_budget(openai_payload)
+            if trimmed is not None:
+                # Reported input tokens and usage estimates are for what
+                # is actually sent.
+                with timing.phase("token_estimate"):
+                    token_count = get_token_count(openai_payload["messages"])
+
+        cache_lookup = None
+        if state.semantic_cache:
+            with timing.phase("semantic_cache"):
+                cache_lookup = await lookup_semantic_cache("messages", openai_payload)
+
+        request_stream_usage(openai_payload)
+        cache_hit = cache_lookup is not None and cache_lookup.response is not None
+        joined = False
+        if cache_hit:
+            response = cache_lookup.response
+        elif single_flight_enabled(request.headers) and (
+            not openai_payload["stream"] or deterministic(openai_payload)
+        ):
+            body = await request.body()
+            if openai_payload["stream"]:
+                response, joined = await broadcast_stream(
+                    "messages_stream",
+                    body,
+                    lambda: create_chat_completions(openai_payload),
+                )
+            else:
+                response, joined = await single_flight(
+                    "messages",
+                    body,
+                    lambda: create_chat_completions(openai_payload),
+                )
+        else:
+            response = await create_chat_completions(openai_payload)
 
         if anthropic_request.get("stream") and not isinstance(response, dict):
-            estimated_input_tokens = get_token_count(openai_messages)["input"]
             sse_stream = convert_openai_stream_to_anthropic(
-                response,
+                track_stream(
+                    track_stream_usage(
+                        response,
+                        client,
+                        openai_payload["model"],
+                        timing.started,
+                        token_count["input"],
+                        shared=joined,
+                    ),
+                    timing.route,
+                    str(openai_payload["model"]),
+                    timing.started,
+                ),
                 str(anthropic_request.get("model", "")),
-                estimated_input_tokens,
+                token_count["input"],
                 request_id,
             )
-            return StreamingResponse(sse_stream, media_type="text/event-stream")
+            headers = {"Server-Timing": timing.server_timing_header()}
+            if trimmed:
+                headers[TRIMMED_HEADER] = trimmed
+            return EventStreamResponse(
+                log_timing_after_stream(sse_stream, timing),
+                ANTHROPIC_HEARTBEAT,
+                headers=headers,
+            )
 
         if isinstance(response, dict):
-            anthropic_response = convert_openai_to_anthropic_response(
-                response,
-                str(anthropic_request.get("model", "")),
-                request_id,
-            )
+            store_semantic_cache(cache_lookup, response)
+            if not cache_hit:
+                record_usage(
+                    client,
+                    openai_payload["model"],
+                    upstream_usage(response),
+                    token_count["input"],
+                    estimate_output_tokens(response),
+                    time.perf_counter() - timing.started,
+                    shared=joined,
+                )
+            with timing.phase("response_convert"):
+                anthropic_response = convert_openai_to_anthropic_response(
+                    response,
+                    str(anthropic_request.get("model", "")),
+                    request_id,
+                    token_count["input"],
+                )
             logger.info(
                 "Anthropic messages request completed model=%s stopReason=%s inputTokens=%s outputTokens=%s requestId=%s",
                 anthropic_response.get("model"),
@@ -170,7 +198,13 @@ async def anthropic_messages(request: Request):
                 anthropic_response.get("usage", {}).get("output_tokens"),
                 request_id,
             )
-            return JSONResponse(content=anthropic_response)
+            headers = {"Server-Timing": timing.server_timing_header()}
+            if cache_lookup is not None:
+                headers[CACHE_HEADER] = cache_lookup.header()
+            if trimmed:
+                headers[TRIMMED_HEADER] = trimmed
+            timing.log()
+            return JSONResponse(content=anthropic_response, headers=headers)
 
         raise RuntimeError("Unexpected response type from OpenAI")
 
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import json
+
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import FileResponse, JSONResponse
+
+from batches import (
+    batch_results_path,
+    cancel_batch,
+    create_batch,
+    get_batch,
+    list_batches,
+)
+from errors import HTTPError
+from forward_error import anthropic_error_response, forward_error
+from usage import client_key
+
+# OpenAI Batch API. Input is the JSONL file itself, sent as the request body,
+# rather than the id of an uploaded file.
+router = APIRouter()
+# Anthropic Message Batches API, served under /v1/messages/batches.
+anthropic_router = APIRouter()
+
+
+def _metadata(request: Request) -> dict[str, str] | None:
+    value = request.headers.get("x-batch-metadata")
+    if value is None:
+        return None
+    try:
+        metadata = json.loads(value)
+    except json.JSONDecodeError:
+        metadata = None
+    if not isinstance(metadata, dict):
+        message = "x-batch-metadata must be a JSON object"
+        raise HTTPError(
+            message=message,
+            status_code=400,
+            response_text=json.dumps({"message": message}),
+        )
+    return metadata
+
+
+@router.post("")
+async def create_batch_route(request: Request):
+    try:
+        batch = await create_batch(
+            "openai",
+            await request.body(),
+            client_key(request.headers),
+            _metadata(request),
+        )
+        return JSONResponse(content=batch.openai_object())
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.get("")
+async def list_batches_route(limit: int = Query(20, ge=1, le=100)):
+    try:
+        batches = list_batches("openai", limit)
+        return JSONResponse(
+            content={
+                "object": "list",
+                "data": [batch.openai_object() for batch in batches],
+                "first_id": batches[0].id if batches else None,
+                "last_id": batches[-1].id if batches else None,
+                "has_more": False,
+            }
+        )
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.get("/{batch_id}")
+async def get_batch_route(batch_id: str):
+    try:
+        return JSONResponse(content=get_batch("openai", batch_id).openai_object())
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.post("/{batch_id}/cancel")
+async def cancel_batch_route(batch_id: str):
+    try:
+        return JSONResponse(content=cancel_batch("openai", batch_id).openai_object())
+    except Exception as error:
+        return forward_error(error)
+
+
+@router.get("/{batch_id}/output")
+async def batch_output_route(batch_id: str):
+    # Results so far, in completion order; poll until the batch is completed.
+    try:
+        return FileResponse(
+            batch_results_path("openai", batch_id), media_type="application/jsonl"
+        )
+    except Exception as error:
+        return forward_error(error)
+
+
+@anthropic_router.post("")
+async def create_message_batch_route(request: Request):
+    try:
+        batch = await create_batch(
+            "anthropic", await request.body(), client_key(request.headers)
+        )
+        return JSONResponse(content=batch.anthropic_object())
+    except Exception as error:
+        return anthropic_error_response(error)
+
+
+@anthropic_router.get("")
+async def list_message_batches_route(limit: int = Query(20, ge=1, le=100)):
+    try:
+        batches = list_batches("anthropic", limit)
+        return JSONResponse(
+            content={
+                "data": [batch.anthropic_object() for batch in batches],
+                "first_id": batches[0].id if batches else None,
+                "last_id": batches[-1].id if batches else None,
+                "has_more": False,
+            }
+        )
+    except Exception as error:
+        return anthropic_error_response(error)
+
+
+@anthropic_router.get("/{batch_id}")
+async def get_message_batch_route(batch_id: str):
+    try:
+        return JSONResponse(content=get_batch("anthropic", batch_id).anthropic_object())
+    except Exception as error:
+        return anthropic_error_response(error)
+
+
+@anthropic_router.post("/{batch_id}/cancel")
+async def cancel_message_batch_route(batch_id: str):
+    try:
+        return JSONResponse(
+            content=cancel_batch("anthropic", batch_id).anthropic_object()
+        )
+    except Exception as error:
+        return anthropic_error_response(error)
+
+
+@anthropic_router.get("/{batch_id}/results")
+async def message_batch_results_route(batch_id: str):
+    try:
+        batch = get_batch("anthropic", batch_id)
+        if not batch.ended:
+            message = f"Batch {batch_id} has not ended yet"
+            raise HTTPError(
+                message=message,
+                status_code=409,
+                response_text=json.dumps({"message": message}),
+            )
+        return FileResponse(batch.results_path, media_type="application/jsonl")
+    except Exception as error:
+        return anthropic_error_response(error)
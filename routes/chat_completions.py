@@ -1,18 +1,46 @@
 from __future__ import annotations
 
+import functools
 import json
 import logging
-from typing import Any
+import time
+from typing import Any, Callable
 
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse
 
+from access_log import current_request_id
 from approval import await_approval
+from context_budget import TRIMMED_HEADER, fit_to_context_budget
+from event_stream import OPENAI_HEARTBEAT, EventStreamResponse
 from forward_error import forward_error
 from is_nullish import is_nullish
+from log_pipeline import Lazy
+from metrics import route_label, track_stream
 from rate_limit import check_rate_limit
+from request_timing import log_timing_after_stream, start_request_timing
+from semantic_cache import (
+    CACHE_HEADER,
+    lookup_semantic_cache,
+    store_semantic_cache,
+)
+from single_flight import (
+    broadcast_stream,
+    deterministic,
+    single_flight,
+    single_flight_enabled,
+)
 from state import state
+from timeouts import start_request_deadline
 from tokenizer import get_token_count
+from usage import (
+    client_key,
+    estimate_output_tokens,
+    record_usage,
+    request_stream_usage,
+    track_stream_usage,
+    upstream_usage,
+)
 from services.copilot.create_chat_completions import create_chat_completions
 
 logger = logging.getLogger(__name__)
@@ -20,17 +48,34 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+def _input_tokens(token_count: Lazy) -> int:
+    return token_count.get()["input"]
+
+
 @router.post("")
 async def completion_route(request: Request):
-    try:
-        await check_rate_limit(state)
-        payload = await request.json()
+    timing = start_request_timing(route_label(request.scope), current_request_id())
 
+    try:
+        start_request_deadline("chat", request.headers)
+        client = client_key(request.headers)
+        with timing.phase("rate_limit"):
+            await check_rate_limit(state)
+        with timing.phase("parse"):
+            payload = await request.json()
+        request.state.model = payload.get("model")
+
+        estimated_input: int | Callable[[], int] = 0
         if isinstance(payload.get("messages"), list):
-            logger.info("Current token count: %s", get_token_count(payload["messages"]))
+            # Tokenizing is only worth it for a debug log or when upstream
+            # reports no usage for the ledger; otherwise it never runs.
+            token_count = Lazy(get_token_count, payload["messages"])
+            logger.debug("Current token count: %s", token_count)
+            estimated_input = functools.partial(_input_tokens, token_count)
 
         if state.manual_approve:
-            await await_approval()
+            with timing.phase("approval"):
+                await await_approval()
 
         if is_nullish(payload.get("max_tokens")):
             selected_model = None
@@ -53,20 +98,96 @@ async def completion_route(request: Request):
             )
             payload["max_tokens"] = max_output
 
-        response = await create_chat_completions(payload)
+        trimmed = None
+        if state.context_fit:
+            with timing.phase("context_fit"):
+                trimmed = fit_to_context_budget(payload)
+
+        cache_lookup = None
+        if state.semantic_cache:
+            with timing.phase("semantic_cache"):
+                cache_lookup = await lookup_semantic_cache("chat", payload)
+
+        wants_usage = request_stream_usage(payload)
+        cache_hit = cache_lookup is not None and cache_lookup.response is not None
+        joined = False
+        if cache_hit:
+            response = cache_lookup.response
+        elif single_flight_enabled(request.headers) and (
+            not payload.get("stream") or deterministic(payload)
+        ):
+            body = await request.body()
+            if payload.get("stream"):
+                response, joined = await broadcast_stream(
+                    "chat_completions_stream",
+                    body,
+                    lambda: create_chat_completions(payload),
+                )
+            else:
+                response, joined = await single_flight(
+                    "chat_completions", body, lambda: create_chat_completions(payload)
+                )
+        else:
+            response = await create_chat_completions(payload)
 
         if isinstance(response, dict):
-            return JSONResponse(content=response)
+            store_semantic_cache(cache_lookup, response)
+            if not cache_hit:
+                record_usage(
+                    client,
+                    payload.get("model"),
+                    upstream_usage(response),
+                    estimated_input,
+                    estimate_output_tokens(response),
+                    time.perf_counter() - timing.started,
+                    shared=joined,
+                )
+            headers = {"Server-Timing": timing.server_timing_header()}
+            if cache_lookup is not None:
+                headers[CACHE_HEADER] = cache_lookup.header()
+            if trimmed:
+                headers[TRIMMED_HEADER] = trimmed
+            timing.log()
+            return JSONResponse(content=response, headers=headers)
+
+        tracked = track_stream(
+            track_stream_usage(
+                response,
+                client,
+                payload.get("model"),
+                timing.started,
+                estimated_input,
+                shared=joined,
+            ),
+            timing.route,
+            str(payload.get("model")),
+            timing.started,
+        )
 
         async def sse_stream():
-            async for chunk in response:
-                if isinstance(chunk, str) and chunk == "[DONE]":
-                    yield "data: [DONE]\n\n"
-                    return
-                if isinstance(chunk, dict):
-                    yield f"data: {json.dumps(chunk)}\n\n"
-
-        return StreamingResponse(sse_stream(), media_type="text/event-stream")
+            try:
+                async for chunk in tracked:
+                    if isinstance(chunk, str) and chunk == "[DONE]":
+                        yield "data: [DONE]\n\n"
+                        return
+                    if isinstance(chunk, dict):
+                        if not wants_usage and not chunk.get("choices") and chunk.get("usage"):
+                            continue
+                        yield f"data: {json.dumps(chunk)}\n\n"
+            except Exception as error:
+                # Headers are already sent; end the stream with an error
+                # event the way OpenAI does.
+                logger.exception("Error in chat completion stream", exc_info=error)
+                yield f"data: {json.dumps({'error': {'message': str(error), 'type': 'error'}})}\n\n"
+
+        headers = {"Server-Timing": timing.server_timing_header()}
+        if trimmed:
+            headers[TRIMMED_HEADER] = trimmed
+        return EventStreamResponse(
+            log_timing_after_stream(sse_stream(), timing),
+            OPENAI_HEARTBEAT,
+            headers=headers,
+        )
 
     except Exception as error:
         return forward_error(error)
@@ -1,19 +1,46 @@
 from __future__ import annotations
 
+import json
+import time
+
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
 
+from embedding_encoding import encode_embeddings, pop_embedding_options
 from forward_error import forward_error
 from services.copilot.create_embeddings import create_embeddings
+from single_flight import single_flight, single_flight_enabled
+from timeouts import start_request_deadline
+from usage import client_key, record_usage, upstream_usage
 
 router = APIRouter()
 
 
 @router.post("")
 async def embeddings_route(request: Request):
+    started = time.perf_counter()
     try:
+        start_request_deadline("embeddings", request.headers)
         payload = await request.json()
-        response = await create_embeddings(payload)
-        return JSONResponse(content=response)
+        encoding_format, dimensions = pop_embedding_options(payload)
+        joined = False
+        if single_flight_enabled(request.headers):
+            response, joined = await single_flight(
+                "embeddings", await request.body(), lambda: create_embeddings(payload)
+            )
+        else:
+            response = await create_embeddings(payload)
+        record_usage(
+            client_key(request.headers),
+            payload.get("model"),
+            upstream_usage(response),
+            len(json.dumps(payload.get("input"))) // 4,
+            0,
+            time.perf_counter() - started,
+            shared=joined,
+        )
+        return JSONResponse(
+            content=encode_embeddings(response, encoding_format, dimensions)
+        )
     except Exception as error:
         return forward_error(error)
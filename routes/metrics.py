@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from metrics import render_metrics
+
+router = APIRouter()
+
+
+@router.get("")
+async def metrics_route() -> PlainTextResponse:
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse
+
+from forward_error import forward_error
+from usage import query_usage
+
+router = APIRouter()
+
+
+@router.get("")
+async def usage_route(
+    since: str | None = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    client: str | None = None,
+    model: str | None = None,
+):
+    try:
+        return JSONResponse(content=await query_usage(since, client, model))
+    except Exception as error:
+        return forward_error(error)
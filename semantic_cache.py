@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import copy
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from metrics import SEMANTIC_CACHE_ENTRIES, SEMANTIC_CACHE_LOOKUPS
+from services.copilot.create_embeddings import create_embeddings
+from state import state
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ROUTES = ("chat", "messages")
+EVICTION_POLICIES = ("lru", "fifo")
+CACHE_HEADER = "x-copilot-api-cache"
+
+
+@dataclass
+class CacheLookup:
+    route: str
+    namespace: int
+    embedding: Any
+    response: dict[str, Any] | None = None
+    similarity: float | None = None
+
+    def header(self) -> str:
+        if self.response is None:
+            return "miss"
+        return f"hit; similarity={self.similarity:.4f}"
+
+
+def _text(content: Any) -> str:
+    if isinstance(content, str):
+        return content
+    if not isinstance(content, list):
+        return ""
+    return "\n".join(
+        part.get("text", "")
+        for part in content
+        if isinstance(part, dict) and part.get("type") in {"text", "input_text"}
+    )
+
+
+def _prompt_parts(payload: dict[str, Any]) -> tuple[str, int] | None:
+    # Only the final user turn is embedded. Everything else in the payload
+    # must match exactly: earlier turns, so a short follow-up like "yes"
+    # never hits across unrelated conversations, and every parameter
+    # (n, stop, response_format, seed, ...), so no request gets an answer
+    # shaped for another.
+    messages = payload.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return None
+    last = messages[-1]
+    if not isinstance(last, dict) or last.get("role") != "user":
+        return None
+    text = _text(last.get("content")).strip()
+    if not text:
+        return None
+
+    # Streaming only changes how an answer is delivered.
+    context = {
+        key: value
+        for key, value in payload.items()
+        if key not in {"messages", "stream", "stream_options"}
+    }
+    context["messages"] = [
+        *messages[:-1],
+        {key: value for key, value in last.items() if key != "content"},
+    ]
+    encoded = json.dumps(context, sort_keys=True, default=str).encode("utf-8")
+    namespace = int.from_bytes(hashlib.sha256(encoded).digest()[:8], "little", signed=True)
+    return text, namespace
+
+
+class SemanticCache:
+    # Embeddings of cached prompts are kept L2-normalized in one float32
+    # matrix, so a lookup is a single matrix-vector product over all rows
+    # followed by a mask for the request's namespace.
+
+    def __init__(self, capacity: int, eviction: str):
+        self.capacity = capacity
+        self.eviction = eviction
+        self._matrix: Any = None
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._responses: list[dict[str, Any] | None] = [None] * capacity
+        self._last_used = np.zeros(capacity, dtype=np.float64)
+        self._inserted = np.zeros(capacity, dtype=np.float64)
+        self._used = np.zeros(capacity, dtype=bool)
+
+    def __len__(self) -> int:
+        return int(self._used.sum())
+
+    def search(self, namespace: int, embedding: Any) -> tuple[int, float] | None:
+        if self._matrix is None or self._matrix.shape[1] != embedding.shape[0]:
+            return None
+        candidates = self._used & (self._namespaces == namespace)
+        if not candidates.any():
+            return None
+        similarities = self._matrix @ embedding
+        similarities[~candidates] = -np.inf
+        index = int(np.argmax(similarities))
+        self._last_used[index] = time.monotonic()
+        return index, float(similarities[index])
+
+    def response(self, index: int) -> dict[str, Any] | None:
+        return self._responses[index]
+
+    def insert(self, namespace: int, embedding: Any, response: dict[str, Any]) -> None:
+        if self._matrix is None or self._matrix.shape[1] != embedding.shape[0]:
+            # First entry (or a different embedding model): start over.
+            self._matrix = np.zeros((self.capacity, embedding.shape[0]), dtype=np.float32)
+            self._used[:] = False
+            self._responses = [None] * self.capacity
+
+        free = np.flatnonzero(~self._used)
+        if free.size:
+            index = int(free[0])
+        else:
+            order = self._last_used if self.eviction == "lru" else self._inserted
+            index = int(np.argmin(order))
+
+        now = time.monotonic()
+        self._matrix[index] = embedding
+        self._namespaces[index] = namespace
+        self._responses[index] = response
+        self._last_used[index] = now
+        self._inserted[index] = now
+        self._used[index] = True
+
+
+_cache: SemanticCache | None = None
+
+
+def _get_cache() -> SemanticCache:
+    global _cache
+
+    if _cache is None:
+        _cache = SemanticCache(state.semantic_cache_size, state.semantic_cache_eviction)
+    return _cache
+
+
+def parse_semantic_cache_thresholds(values: list[str]) -> dict[str, float]:
+    # "ROUTE=THRESHOLD" entries, e.g. ["chat=0.95", "messages=0.97"].
+    thresholds: dict[str, float] = {}
+    for value in values:
+        route, _, threshold = value.partition("=")
+        route = route.strip()
+        if route not in SEMANTIC_CACHE_ROUTES:
+            raise ValueError(
+                f"Unknown route {route!r}; expected one of {', '.join(SEMANTIC_CACHE_ROUTES)}"
+            )
+        try:
+            parsed = float(threshold)
+        except ValueError:
+            raise ValueError(f"Invalid threshold in {value!r}") from None
+        if not 0 < parsed <= 1:
+            raise ValueError(f"Threshold in {value!r} must be in (0, 1]")
+        thresholds[route] = parsed
+    return thresholds
+
+
+def semantic_cache_available() -> bool:
+    return np is not None
+
+
+async def lookup_semantic_cache(
+    route: str,
+    payload: dict[str, Any],
+) -> CacheLookup | None:
+    # Returns None when the request is not eligible, otherwise a lookup that
+    # either carries a cached response or is passed on to store_semantic_cache.
+    threshold = state.semantic_cache.get(route)
+    if threshold is None or np is None or payload.get("stream"):
+        return None
+    parts = _prompt_parts(payload)
+    if parts is None:
+        SEMANTIC_CACHE_LOOKUPS.inc(route, "skipped")
+        return None
+    text, namespace = parts
+
+    try:
+        response = await create_embeddings(
+            {"model": state.semantic_cache_model, "input": [text]}
+        )
+        vector = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+    except Exception:
+        logger.warning("Semantic cache embedding failed; skipping cache", exc_info=True)
+        SEMANTIC_CACHE_LOOKUPS.inc(route, "error")
+        return None
+
+    norm = float(np.linalg.norm(vector))
+    if norm == 0:
+        SEMANTIC_CACHE_LOOKUPS.inc(route, "skipped")
+        return None
+    vector /= norm
+
+    result = CacheLookup(route=route, namespace=namespace, embedding=vector)
+    found = _get_cache().search(namespace, vector)
+    if found is not None and found[1] >= threshold:
+        index, similarity = found
+        result.response = copy.deepcopy(_get_cache().response(index))
+        result.similarity = similarity
+        SEMANTIC_CACHE_LOOKUPS.inc(route, "hit")
+        logger.info("Semantic cache hit on %s (similarity %.4f)", route, similarity)
+    else:
+        SEMANTIC_CACHE_LOOKUPS.inc(route, "miss")
+    return result
+
+
+def store_semantic_cache(
+    cache_lookup: CacheLookup | None,
+    response: dict[str, Any],
+) -> None:
+    if cache_lookup is None or cache_lookup.response is not None:
+        return
+    # Truncated answers and tool calls depend on more than the prompt text.
+    choices = response.get("choices") or []
+    if not choices or any(choice.get("finish_reason") != "stop" for choice in choices):
+        return
+
+    cache = _get_cache()
+    cache.insert(cache_lookup.namespace, cache_lookup.embedding, copy.deepcopy(response))
+    SEMANTIC_CACHE_ENTRIES.set(len(cache))
@@ -1,20 +1,49 @@
 from __future__ import annotations
 
-import logging
-import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import PlainTextResponse
 
+from access_log import REQUEST_ID_HEADER, AccessLogMiddleware
+from batches import resume_batches, stop_batches
+from coordinator import start_worker_sync, stop_worker_sync
+from debug_capture import DebugCaptureMiddleware
+from metrics import MetricsMiddleware
+from profiling import (
+    SlowRequestProfilerMiddleware,
+    start_slow_request_profiling,
+    stop_slow_request_profiling,
+)
+from routes.admin import router as admin_router
 from routes.anthropic import router as anthropic_router
+from routes.batches import anthropic_router as message_batches_router
+from routes.batches import router as batches_router
 from routes.chat_completions import router as completion_router
 from routes.embeddings import router as embeddings_router
+from routes.metrics import router as metrics_router
 from routes.models import router as models_router
+from routes.usage import router as usage_router
+from usage import start_usage_ledger, stop_usage_ledger
+
 
-logger = logging.getLogger(__name__)
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await start_worker_sync()
+    start_slow_request_profiling()
+    start_usage_ledger()
+    resume_batches()
+    try:
+        yield
+    finally:
+        await stop_batches()
+        await stop_usage_ledger()
+        stop_slow_request_profiling()
+        await stop_worker_sync()
 
-server = FastAPI()
+
+server = FastAPI(lifespan=lifespan)
 
 server.add_middleware(
     CORSMiddleware,
@@ -22,22 +51,13 @@ server.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[REQUEST_ID_HEADER, "Server-Timing"],
 )
-
-
-@server.middleware("http")
-async def request_logger(request: Request, call_next):
-    start = time.time()
-    response = await call_next(request)
-    duration_ms = int((time.time() - start) * 1000)
-    logger.info(
-        "%s %s -> %s (%sms)",
-        request.method,
-        request.url.path,
-        response.status_code,
-        duration_ms,
-    )
-    return response
+server.add_middleware(MetricsMiddleware)
+server.add_middleware(SlowRequestProfilerMiddleware)
+server.add_middleware(DebugCaptureMiddleware)
+# Outermost, so the request id is set before anything else runs.
+server.add_middleware(AccessLogMiddleware)
 
 
 @server.get("/")
@@ -49,11 +69,23 @@ async def health() -> PlainTextResponse:
 server.include_router(completion_router, prefix="/chat/completions")
 server.include_router(models_router, prefix="/models")
 server.include_router(embeddings_router, prefix="/embeddings")
+server.include_router(batches_router, prefix="/batches")
 
 # Compatibility with tools that expect v1/ prefix
 server.include_router(completion_router, prefix="/v1/chat/completions")
 server.include_router(models_router, prefix="/v1/models")
 server.include_router(embeddings_router, prefix="/v1/embeddings")
+server.include_router(batches_router, prefix="/v1/batches")
 
 # Anthropic-compatible endpoints
+server.include_router(message_batches_router, prefix="/v1/messages/batches")
 server.include_router(anthropic_router, prefix="/v1/messages")
+
+# Prometheus metrics
+server.include_router(metrics_router, prefix="/metrics")
+
+# Token and latency totals from the usage ledger
+server.include_router(usage_router, prefix="/usage")
+
+# Operational endpoints, only served when started with --admin
+server.include_router(admin_router, prefix="/admin")
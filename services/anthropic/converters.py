@@ -2,11 +2,202 @@ from __future__ import annotations
 
 import json
 import logging
+import marshal
+from collections import OrderedDict
+from threading import Lock
 from typing import Any
 from uuid import uuid4
 
+from images import preprocess_image
+from is_nullish import is_nullish
+from metrics import CONVERSION_CACHE_MESSAGES
+from state import state
+from usage import estimate_output_tokens, upstream_usage
+
 logger = logging.getLogger(__name__)
 
+TOOL_CACHE_SIZE = 32
+CONVERSION_CACHE_SIZE = 16
+
+# marshal bytes of the incoming Anthropic tools -> converted OpenAI tools.
+_tool_cache: OrderedDict[bytes, SerializedTools] = OrderedDict()
+_tool_cache_lock = Lock()
+
+
+class SerializedTools(list):
+    # A converted tool list that also carries its JSON encoding, so the
+    # upstream request body can splice it in instead of re-encoding large
+    # schemas every turn. Instances are shared between requests and must
+    # not be mutated.
+
+    json_bytes: bytes
+
+    def __init__(self, tools: list[dict[str, Any]]):
+        super().__init__(tools)
+        self.json_bytes = json.dumps(
+            tools, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+        ).encode("utf-8")
+
+
+def _message_fingerprint(message: dict[str, Any]) -> tuple[Any, ...]:
+    # A cheap summary of a message: the role plus type, length and leading
+    # characters of its first blocks. It only selects the cache entry;
+    # reuse is decided by comparing the messages themselves.
+    role = message.get("role")
+    content = message.get("content")
+    if isinstance(content, str):
+        return (role, len(content), content[:256])
+    if not isinstance(content, list):
+        return (role, repr(content)[:256])
+
+    blocks = []
+    for block in content[:8]:
+        if not isinstance(block, dict):
+            continue
+        text = block.get("text") or (block.get("source") or {}).get("data") or block.get("id")
+        if not isinstance(text, str):
+            text = ""
+        blocks.append((block.get("type"), len(text), text[:256]))
+    return (role, len(content), tuple(blocks))
+
+
+class ConversationCache:
+    # Agent loops resend the previous history plus one or two new messages.
+    # Each entry remembers one conversation's messages and their converted
+    # output; a request reuses the longest prefix that compares equal and
+    # converts only what follows. == on parsed JSON is a C-level walk over
+    # the strings, far cheaper than hashing or re-serializing each message.
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: OrderedDict[
+            tuple[Any, ...], tuple[list[dict[str, Any]], list[list[dict[str, Any]]]]
+        ] = OrderedDict()
+        self._lock = Lock()
+
+    def convert(self, messages: list[dict[str, Any]]) -> list[list[dict[str, Any]]]:
+        if not messages:
+            return []
+        # Image settings change the converted output of the same input.
+        key = (
+            _message_fingerprint(messages[0]),
+            state.image_max_size,
+            state.image_quality,
+        )
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        reused = 0
+        outputs: list[list[dict[str, Any]]] = []
+        if entry is not None:
+            previous_messages, previous_outputs = entry
+            limit = min(len(messages), len(previous_messages))
+            while reused < limit and messages[reused] == previous_messages[reused]:
+                reused += 1
+            outputs = previous_outputs[:reused]
+
+        outputs.extend(_convert_message(message) for message in messages[reused:])
+        CONVERSION_CACHE_MESSAGES.inc("hit", amount=reused)
+        CONVERSION_CACHE_MESSAGES.inc("miss", amount=len(messages) - reused)
+
+        with self._lock:
+            self._entries[key] = (list(messages), outputs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return outputs
+
+
+_conversion_cache = ConversationCache(CONVERSION_CACHE_SIZE)
+
+
+def select_copilot_model(anthropic_model: str) -> str:
+    model_name = anthropic_model.lower()
+
+    if not state.models or not isinstance(state.models.get("data"), list):
+        return "claude-3-5-sonnet-20241022"
+
+    models = [m for m in state.models["data"] if isinstance(m, dict)]
+
+    exact_match = next(
+        (m for m in models if str(m.get("id", "")).lower() == model_name),
+        None,
+    )
+    if exact_match:
+        logger.debug("Found exact model match: %s", exact_match.get("id"))
+        return str(exact_match.get("id"))
+
+    preferred_model = next(
+        (m for m in models if str(m.get("id", "")).lower() == "claude-3.7-sonnet"),
+        None,
+    )
+    if preferred_model:
+        logger.debug("Using preferred model: %s", preferred_model.get("id"))
+        return str(preferred_model.get("id"))
+
+    claude_model = next(
+        (m for m in models if "claude" in str(m.get("id", "")).lower()),
+        None,
+    )
+    if claude_model:
+        logger.debug("Using claude model: %s", claude_model.get("id"))
+        return str(claude_model.get("id"))
+
+    fallback_model = str(models[0].get("id", "claude-3-5-sonnet-20241022"))
+    logger.debug("Using fallback model: %s", fallback_model)
+    return fallback_model
+
+
+def build_openai_payload(
+    anthropic_request: dict[str, Any],
+    openai_messages: list[dict[str, Any]],
+) -> dict[str, Any]:
+    openai_payload: dict[str, Any] = {
+        "model": select_copilot_model(str(anthropic_request.get("model", ""))),
+        "messages": openai_messages,
+        "stream": bool(anthropic_request.get("stream", False)),
+    }
+
+    if is_nullish(anthropic_request.get("max_tokens")):
+        selected_model = None
+        if state.models and isinstance(state.models.get("data"), list):
+            selected_model = next(
+                (
+                    model
+                    for model in state.models["data"]
+                    if isinstance(model, dict)
+                    and model.get("id") == openai_payload["model"]
+                ),
+                None,
+            )
+        openai_payload["max_tokens"] = (
+            (selected_model or {})
+            .get("capabilities", {})
+            .get("limits", {})
+            .get("max_output_tokens")
+        )
+    else:
+        openai_payload["max_tokens"] = anthropic_request.get("max_tokens")
+
+    if anthropic_request.get("temperature") is not None:
+        openai_payload["temperature"] = anthropic_request.get("temperature")
+    if anthropic_request.get("top_p") is not None:
+        openai_payload["top_p"] = anthropic_request.get("top_p")
+    if anthropic_request.get("stop_sequences"):
+        openai_payload["stop"] = anthropic_request.get("stop_sequences")
+
+    openai_tools = convert_anthropic_tools_to_openai(anthropic_request.get("tools"))
+    if openai_tools:
+        openai_payload["tools"] = openai_tools
+    openai_tool_choice = convert_anthropic_tool_choice_to_openai(
+        anthropic_request.get("tool_choice")
+    )
+    if openai_tool_choice:
+        openai_payload["tool_choice"] = openai_tool_choice
+
+    return openai_payload
+
 
 def convert_anthropic_to_openai_messages(
     anthropic_messages: list[dict[str, Any]],
@@ -27,119 +218,129 @@ def convert_anthropic_to_openai_messages(
     if system_text_content:
         openai_messages.append({"role": "system", "content": system_text_content})
 
-    for msg in anthropic_messages:
-        role = msg.get("role")
-        content = msg.get("content")
+    # Converted messages are shared with later requests through the cache
+    # and must not be mutated; replace them instead.
+    for converted in _conversion_cache.convert(anthropic_messages):
+        openai_messages.extend(converted)
 
-        if isinstance(content, str):
-            openai_messages.append({"role": role, "content": content})
-            continue
+    return openai_messages
 
-        if not isinstance(content, list):
-            continue
 
-        openai_parts_for_user_message: list[dict[str, Any]] = []
-        assistant_tool_calls: list[dict[str, Any]] = []
-        text_content_for_assistant: list[str] = []
+def _convert_message(msg: dict[str, Any]) -> list[dict[str, Any]]:
+    converted: list[dict[str, Any]] = []
+    role = msg.get("role")
+    content = msg.get("content")
 
-        if not content:
-            openai_messages.append({"role": role, "content": ""})
-            continue
+    if isinstance(content, str):
+        converted.append({"role": role, "content": content})
+        return converted
 
-        for block in content:
-            if not isinstance(block, dict):
-                continue
+    if not isinstance(content, list):
+        return converted
 
-            btype = block.get("type")
-
-            if btype == "text":
-                if role == "user":
-                    openai_parts_for_user_message.append(
-                        {"type": "text", "text": block.get("text", "")}
-                    )
-                elif role == "assistant":
-                    text_content_for_assistant.append(str(block.get("text", "")))
-
-            elif btype == "image" and role == "user":
-                source = block.get("source") or {}
-                if source.get("type") == "base64":
-                    openai_parts_for_user_message.append(
-                        {
-                            "type": "image_url",
-                            "image_url": (
-                                f"data:{source.get('media_type')};base64,{source.get('data')}"
-                            ),
-                        }
-                    )
-
-            elif btype == "tool_use" and role == "assistant":
-                try:
-                    args_str = json.dumps(block.get("input", {}))
-                except Exception:
-                    logger.warning("Failed to serialize tool input for %s", block.get("name"))
-                    args_str = "{}"
+    openai_parts_for_user_message: list[dict[str, Any]] = []
+    assistant_tool_calls: list[dict[str, Any]] = []
+    text_content_for_assistant: list[str] = []
 
-                assistant_tool_calls.append(
-                    {
-                        "id": block.get("id"),
-                        "type": "function",
-                        "function": {
-                            "name": block.get("name"),
-                            "arguments": args_str,
-                        },
-                    }
-                )
+    if not content:
+        converted.append({"role": role, "content": ""})
+        return converted
 
-            elif btype == "tool_result" and role == "user":
-                serialized_content = serialize_tool_result_content(block.get("content"))
-                openai_messages.append(
-                    {
-                        "role": "tool",
-                        "content": serialized_content,
-                        "tool_call_id": block.get("tool_use_id"),
-                    }
-                )
+    for block in content:
+        if not isinstance(block, dict):
+            continue
 
-        if role == "user" and openai_parts_for_user_message:
-            is_multimodal = any(
-                part.get("type") == "image_url" for part in openai_parts_for_user_message
-            )
-            if is_multimodal or len(openai_parts_for_user_message) > 1:
-                openai_messages.append(
-                    {"role": "user", "content": openai_parts_for_user_message}
+        btype = block.get("type")
+
+        if btype == "text":
+            if role == "user":
+                openai_parts_for_user_message.append(
+                    {"type": "text", "text": block.get("text", "")}
                 )
-            elif len(openai_parts_for_user_message) == 1:
-                one = openai_parts_for_user_message[0]
-                if one.get("type") == "text":
-                    openai_messages.append(
-                        {"role": "user", "content": one.get("text", "")}
-                    )
-
-        if role == "assistant":
-            assistant_text = "\n".join(t for t in text_content_for_assistant if t)
-            if assistant_text and assistant_tool_calls:
-                openai_messages.append({"role": "assistant", "content": assistant_text})
-                openai_messages.append(
-                    {
-                        "role": "assistant",
-                        "content": None,
-                        "tool_calls": assistant_tool_calls,
-                    }
+            elif role == "assistant":
+                text_content_for_assistant.append(str(block.get("text", "")))
+
+        elif btype == "image" and role == "user":
+            source = block.get("source") or {}
+            if source.get("type") == "base64":
+                media_type, data = preprocess_image(
+                    source.get("media_type"), source.get("data")
                 )
-            elif assistant_text:
-                openai_messages.append({"role": "assistant", "content": assistant_text})
-            elif assistant_tool_calls:
-                openai_messages.append(
+                openai_parts_for_user_message.append(
                     {
-                        "role": "assistant",
-                        "content": None,
-                        "tool_calls": assistant_tool_calls,
+                        "type": "image_url",
+                        "image_url": f"data:{media_type};base64,{data}",
                     }
                 )
-            else:
-                openai_messages.append({"role": "assistant", "content": ""})
 
-    return openai_messages
+        elif btype == "tool_use" and role == "assistant":
+            try:
+                args_str = json.dumps(block.get("input", {}))
+            except Exception:
+                logger.warning("Failed to serialize tool input for %s", block.get("name"))
+                args_str = "{}"
+
+            assistant_tool_calls.append(
+                {
+                    "id": block.get("id"),
+                    "type": "function",
+                    "function": {
+                        "name": block.get("name"),
+                        "arguments": args_str,
+                    },
+                }
+            )
+
+        elif btype == "tool_result" and role == "user":
+            serialized_content = serialize_tool_result_content(block.get("content"))
+            converted.append(
+                {
+                    "role": "tool",
+                    "content": serialized_content,
+                    "tool_call_id": block.get("tool_use_id"),
+                }
+            )
+
+    if role == "user" and openai_parts_for_user_message:
+        is_multimodal = any(
+            part.get("type") == "image_url" for part in openai_parts_for_user_message
+        )
+        if is_multimodal or len(openai_parts_for_user_message) > 1:
+            converted.append(
+                {"role": "user", "content": openai_parts_for_user_message}
+            )
+        elif len(openai_parts_for_user_message) == 1:
+            one = openai_parts_for_user_message[0]
+            if one.get("type") == "text":
+                converted.append(
+                    {"role": "user", "content": one.get("text", "")}
+                )
+
+    if role == "assistant":
+        assistant_text = "\n".join(t for t in text_content_for_assistant if t)
+        if assistant_text and assistant_tool_calls:
+            converted.append({"role": "assistant", "content": assistant_text})
+            converted.append(
+                {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": assistant_tool_calls,
+                }
+            )
+        elif assistant_text:
+            converted.append({"role": "assistant", "content": assistant_text})
+        elif assistant_tool_calls:
+            converted.append(
+                {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": assistant_tool_calls,
+                }
+            )
+        else:
+            converted.append({"role": "assistant", "content": ""})
+
+    return converted
 
 
 def convert_anthropic_tools_to_openai(
@@ -148,6 +349,33 @@ def convert_anthropic_tools_to_openai(
     if not anthropic_tools:
         return None
 
+    # marshal is the cheapest exact fingerprint of parsed JSON, several
+    # times faster than json.dumps for large schemas. Equal bytes imply
+    # equal tools; anything it cannot encode just skips the cache.
+    try:
+        key = marshal.dumps(anthropic_tools)
+    except ValueError:
+        return _convert_tools(anthropic_tools)
+
+    with _tool_cache_lock:
+        cached = _tool_cache.get(key)
+        if cached is not None:
+            _tool_cache.move_to_end(key)
+            return cached
+
+    try:
+        converted = SerializedTools(_convert_tools(anthropic_tools))
+    except (TypeError, ValueError):
+        return _convert_tools(anthropic_tools)
+
+    with _tool_cache_lock:
+        _tool_cache[key] = converted
+        while len(_tool_cache) > TOOL_CACHE_SIZE:
+            _tool_cache.popitem(last=False)
+    return converted
+
+
+def _convert_tools(anthropic_tools: list[dict[str, Any]]) -> list[dict[str, Any]]:
     converted = []
     for tool in anthropic_tools:
         converted.append(
@@ -186,6 +414,7 @@ def convert_openai_to_anthropic_response(
     openai_response: dict[str, Any],
     original_anthropic_model: str,
     request_id: str | None = None,
+    estimated_input_tokens: int = 0,
 ) -> dict[str, Any]:
     anthropic_content: list[dict[str, Any]] = []
     anthropic_stop_reason = "end_turn"
@@ -248,6 +477,12 @@ def convert_openai_to_anthropic_response(
         else f"msg_{request_id or uuid4()}_completed"
     )
 
+    # Upstream usage when reported, otherwise the same estimates as streams.
+    usage = upstream_usage(openai_response) or (
+        estimated_input_tokens,
+        estimate_output_tokens(openai_response),
+    )
+
     return {
         "id": response_id,
         "type": "message",
@@ -256,8 +491,8 @@ def convert_openai_to_anthropic_response(
         "content": anthropic_content,
         "stop_reason": anthropic_stop_reason,
         "usage": {
-            "input_tokens": 0,
-            "output_tokens": 0,
+            "input_tokens": usage[0],
+            "output_tokens": usage[1],
         },
     }
 
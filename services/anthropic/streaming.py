@@ -5,6 +5,9 @@ import logging
 from typing import Any, AsyncGenerator
 from uuid import uuid4
 
+from errors import HTTPError
+from usage import upstream_usage
+
 logger = logging.getLogger(__name__)
 
 
@@ -27,6 +30,8 @@ async def convert_openai_stream_to_anthropic(
     sent_tool_block_starts: set[int] = set()
 
     output_token_count = 0
+    reported_usage: tuple[int, int] | None = None
+    finished = False
     final_anthropic_stop_reason = "end_turn"
 
     stop_reason_map = {
@@ -65,8 +70,12 @@ async def convert_openai_stream_to_anthropic(
                     break
                 continue
 
+            # The usage chunk (stream_options.include_usage) follows the one
+            # with finish_reason, so the stream is read up to [DONE].
+            if parsed_chunk.get("usage"):
+                reported_usage = upstream_usage(parsed_chunk) or reported_usage
             choices = parsed_chunk.get("choices") or []
-            if not choices:
+            if finished or not choices:
                 continue
 
             delta = choices[0].get("delta") or {}
@@ -169,7 +178,7 @@ async def convert_openai_stream_to_anthropic(
                 )
                 if openai_finish_reason == "tool_calls":
                     final_anthropic_stop_reason = "tool_use"
-                break
+                finished = True
 
         if text_block_anthropic_idx is not None:
             stop_event = {
@@ -195,6 +204,11 @@ async def convert_openai_stream_to_anthropic(
                 "output_tokens": output_token_count,
             },
         }
+        if reported_usage is not None:
+            message_delta_event["usage"] = {
+                "input_tokens": reported_usage[0],
+                "output_tokens": reported_usage[1],
+            }
         yield f"event: message_delta\ndata: {json.dumps(message_delta_event)}\n\n"
 
         message_stop_event = {"type": "message_stop"}
@@ -202,10 +216,11 @@ async def convert_openai_stream_to_anthropic(
 
     except Exception as error:
         logger.exception("Error in stream conversion", exc_info=error)
+        timed_out = isinstance(error, HTTPError) and error.status_code == 504
         error_event = {
             "type": "error",
             "error": {
-                "type": "api_error",
+                "type": "timeout_error" if timed_out else "api_error",
                 "message": str(error),
             },
         }
@@ -6,8 +6,13 @@ from typing import Any, AsyncGenerator
 import httpx
 
 from api_config import copilot_base_url, copilot_headers
+from cassette import upstream_transport
+from concurrency import upstream_slot
 from errors import HTTPError
+from metrics import UPSTREAM_RESPONSES
+from request_timing import current_timing, timed_phase
 from state import state
+from timeouts import UpstreamTimeouts, upstream_timeouts
 
 
 def _into_copilot_message(message: dict[str, Any]) -> None:
@@ -38,20 +43,67 @@ def _has_vision(messages: list[dict[str, Any]]) -> bool:
     return False
 
 
+def _encode_json(value: Any) -> bytes:
+    # Same encoding httpx applies to json= bodies.
+    return json.dumps(
+        value, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+
+
+def _encode_payload(payload: dict[str, Any]) -> bytes:
+    tools = payload.get("tools")
+    tools_json = getattr(tools, "json_bytes", None)
+    if tools_json is None:
+        return _encode_json(payload)
+
+    # Tool lists from the converter cache arrive already encoded.
+    rest = _encode_json({key: value for key, value in payload.items() if key != "tools"})
+    separator = b"," if rest != b"{}" else b""
+    return b"".join((rest[:-1], separator, b'"tools":', tools_json, b"}"))
+
+
+def _upstream_request_options(
+    vision_enabled: bool,
+) -> tuple[dict[str, str], dict[str, Any]]:
+    headers = copilot_headers(state, vision=vision_enabled)
+    timing = current_timing()
+    if timing is None:
+        return headers, {}
+
+    timing.upstream_request_id = headers["x-request-id"]
+    return headers, {"trace": timing.httpx_trace}
+
+
 async def _stream_openai_sse(
     payload: dict[str, Any],
     vision_enabled: bool,
     tools_enabled: bool,
+    timeouts: UpstreamTimeouts,
 ) -> AsyncGenerator[dict[str, Any] | str, None]:
-    async with httpx.AsyncClient(timeout=None) as client:
-        async with client.stream(
+    headers, extensions = _upstream_request_options(vision_enabled)
+
+    async with upstream_slot(payload.get("model")) as slot, httpx.AsyncClient(
+        timeout=timeouts.httpx_timeout(), transport=upstream_transport()
+    ) as client:
+        request = client.build_request(
             "POST",
             f"{copilot_base_url(state)}/chat/completions",
-            headers=copilot_headers(state, vision=vision_enabled),
-            json=payload,
-        ) as response:
+            headers=headers,
+            content=_encode_payload(payload),
+            extensions=extensions,
+        )
+        try:
+            async with timeouts.limit("ttfb"):
+                response = await client.send(request, stream=True)
+        except HTTPError:
+            slot.timed_out()
+            raise
+        slot.response("stream", response)
+        try:
+            UPSTREAM_RESPONSES.inc("chat_completions", str(response.status_code))
             if not response.is_success:
-                error_text = await response.aread()
+                async with timeouts.limit("idle"):
+                    error_text = await response.aread()
                 decoded_error = error_text.decode("utf-8", errors="replace")
                 if tools_enabled and response.status_code == 400:
                     raise HTTPError(
@@ -68,7 +120,16 @@ async def _stream_openai_sse(
                     response_text=decoded_error,
                 )
 
-            async for line in response.aiter_lines():
+            lines = response.aiter_lines()
+            # Headers can arrive before the model starts generating, so the
+            # first line is still bounded by the time-to-first-byte timeout.
+            wait = "ttfb"
+            while True:
+                async with timeouts.limit(wait):
+                    line = await anext(lines, None)
+                wait = "idle"
+                if line is None:
+                    return
                 if not line:
                     continue
                 if not line.startswith("data:"):
@@ -83,6 +144,8 @@ async def _stream_openai_sse(
                     yield json.loads(data)
                 except json.JSONDecodeError:
                     continue
+        finally:
+            await response.aclose()
 
 
 async def create_chat_completions(
@@ -100,16 +163,31 @@ async def create_chat_completions(
     vision_enabled = _has_vision(messages)
     tools_enabled = bool(payload.get("tools"))
 
+    timeouts = upstream_timeouts(payload.get("model"))
     if payload.get("stream"):
-        return _stream_openai_sse(payload, vision_enabled, tools_enabled)
+        return _stream_openai_sse(payload, vision_enabled, tools_enabled, timeouts)
 
-    async with httpx.AsyncClient(timeout=None) as client:
-        response = await client.post(
-            f"{copilot_base_url(state)}/chat/completions",
-            headers=copilot_headers(state, vision=vision_enabled),
-            json=payload,
-        )
+    headers, extensions = _upstream_request_options(vision_enabled)
 
+    async with upstream_slot(payload.get("model")) as slot:
+        with timed_phase("upstream"):
+            async with httpx.AsyncClient(
+                timeout=timeouts.httpx_timeout(), transport=upstream_transport()
+            ) as client:
+                try:
+                    async with timeouts.limit("ttfb"):
+                        response = await client.post(
+                            f"{copilot_base_url(state)}/chat/completions",
+                            headers=headers,
+                            content=_encode_payload(payload),
+                            extensions=extensions,
+                        )
+                except HTTPError:
+                    slot.timed_out()
+                    raise
+        slot.response("complete", response)
+
+    UPSTREAM_RESPONSES.inc("chat_completions", str(response.status_code))
     if not response.is_success:
         error_text = response.text
         if tools_enabled and response.status_code == 400:
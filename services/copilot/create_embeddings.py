@@ -5,21 +5,35 @@ from typing import Any
 import httpx
 
 from api_config import copilot_base_url, copilot_headers
+from cassette import upstream_transport
+from concurrency import upstream_slot
 from errors import HTTPError
+from metrics import UPSTREAM_RESPONSES
 from state import state
+from timeouts import upstream_timeouts
 
 
 async def create_embeddings(payload: dict[str, Any]) -> dict[str, Any]:
     if not state.copilot_token:
         raise RuntimeError("Copilot token not found")
 
-    async with httpx.AsyncClient(timeout=90) as client:
-        response = await client.post(
-            f"{copilot_base_url(state)}/embeddings",
-            headers=copilot_headers(state),
-            json=payload,
-        )
-
+    timeouts = upstream_timeouts(payload.get("model"))
+    async with upstream_slot(payload.get("model")) as slot, httpx.AsyncClient(
+        timeout=timeouts.httpx_timeout(), transport=upstream_transport()
+    ) as client:
+        try:
+            async with timeouts.limit("ttfb"):
+                response = await client.post(
+                    f"{copilot_base_url(state)}/embeddings",
+                    headers=copilot_headers(state),
+                    json=payload,
+                )
+        except HTTPError:
+            slot.timed_out()
+            raise
+        slot.response("complete", response)
+
+    UPSTREAM_RESPONSES.inc("embeddings", str(response.status_code))
     if not response.is_success:
         raise HTTPError(
             message="Failed to create embeddings",
@@ -5,17 +5,20 @@ from typing import Any
 import httpx
 
 from api_config import copilot_base_url, copilot_headers
+from cassette import upstream_transport
 from errors import HTTPError
+from metrics import UPSTREAM_RESPONSES
 from state import state
 
 
 async def get_models() -> dict[str, Any]:
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with httpx.AsyncClient(timeout=30, transport=upstream_transport()) as client:
         response = await client.get(
             f"{copilot_base_url(state)}/models",
             headers=copilot_headers(state),
         )
 
+    UPSTREAM_RESPONSES.inc("models", str(response.status_code))
     if not response.is_success:
         raise HTTPError(
             message="Failed to get models",
@@ -4,18 +4,21 @@ from typing import Any
 
 import httpx
 
-from api_config import GITHUB_API_BASE_URL, github_headers
+from api_config import copilot_token_url, github_headers
+from cassette import upstream_transport
 from errors import HTTPError
+from metrics import UPSTREAM_RESPONSES
 from state import state
 
 
 async def get_copilot_token() -> dict[str, Any]:
-    async with httpx.AsyncClient(timeout=30) as client:
+    async with httpx.AsyncClient(timeout=30, transport=upstream_transport()) as client:
         response = await client.get(
-            f"{GITHUB_API_BASE_URL}/copilot_internal/v2/token",
+            copilot_token_url(state),
             headers=github_headers(state),
         )
 
+    UPSTREAM_RESPONSES.inc("copilot_token", str(response.status_code))
     if not response.is_success:
         raise HTTPError(
             message="Failed to get Copilot token",
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import logging
+import math
+from dataclasses import dataclass
+from typing import Any
+
+SERVERS = ("uvicorn", "hypercorn")
+LOOPS = ("auto", "asyncio", "uvloop")
+HTTP_PARSERS = ("auto", "h11", "httptools")
+
+# Choices that need an optional package, with the option that selects them.
+_REQUIREMENTS = {
+    "hypercorn": "--server",
+    "uvloop": "--loop",
+    "httptools": "--http",
+}
+
+
+@dataclass
+class ServeOptions:
+    server: str = "uvicorn"
+    host: str = "0.0.0.0"
+    port: int = 4141
+    # Listen on this unix domain socket instead of host and port.
+    uds: str | None = None
+    # "auto" uses uvloop and httptools when they are installed.
+    loop: str = "auto"
+    http: str = "auto"
+    backlog: int = 2048
+    keepalive: float = 5.0
+
+    def missing_requirement(self) -> tuple[str, str] | None:
+        # (package, option) for a choice whose package is not installed.
+        for choice in (self.server, self.loop, self.http):
+            option = _REQUIREMENTS.get(choice)
+            if option is not None and importlib.util.find_spec(choice) is None:
+                return choice, option
+        return None
+
+    def address(self) -> str:
+        if self.uds:
+            return f"unix:{self.uds}"
+        host = "localhost" if self.host == "0.0.0.0" else self.host
+        return f"http://{host}:{self.port}"
+
+    def uvicorn_config(self) -> dict[str, Any]:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "uds": self.uds,
+            "loop": self.loop,
+            "http": self.http,
+            "backlog": self.backlog,
+            # Whole seconds for uvicorn; rounded up so that 0.5 does not
+            # turn into 0 and disable keep-alive.
+            "timeout_keep_alive": math.ceil(self.keepalive),
+            # Leave uvicorn's loggers to the app's logging setup, which
+            # writes from a background thread.
+            "log_config": None,
+        }
+
+    def hypercorn_config(self, workers: int) -> Any:
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"unix:{self.uds}" if self.uds else f"{self.host}:{self.port}"]
+        config.backlog = self.backlog
+        config.keep_alive_timeout = self.keepalive
+        config.worker_class = "uvloop" if self.use_uvloop() else "asyncio"
+        config.workers = workers
+        config.application_path = "server:server"
+        # Through the app's logging setup rather than a second handler.
+        config.errorlog = logging.getLogger("hypercorn.error")
+        return config
+
+    def use_uvloop(self) -> bool:
+        if self.loop == "auto":
+            return importlib.util.find_spec("uvloop") is not None
+        return self.loop == "uvloop"
+
+
+def serve(options: ServeOptions, workers: int) -> None:
+    import uvicorn
+
+    if options.server == "hypercorn":
+        _serve_hypercorn(options, workers)
+    elif workers > 1:
+        uvicorn.run(
+            "server:server",
+            workers=workers,
+            log_level="info",
+            **options.uvicorn_config(),
+        )
+    else:
+        from server import server
+
+        uvicorn.run(server, log_level="info", **options.uvicorn_config())
+
+
+def _serve_hypercorn(options: ServeOptions, workers: int) -> None:
+    config = options.hypercorn_config(workers)
+    if workers > 1:
+        from hypercorn.run import run
+
+        run(config)
+        return
+
+    from hypercorn.asyncio import serve as hypercorn_serve
+
+    from server import server
+
+    if config.worker_class == "uvloop":
+        import uvloop
+
+        uvloop.run(hypercorn_serve(server, config))
+    else:
+        asyncio.run(hypercorn_serve(server, config))
@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import logging
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Mapping
+
+from metrics import SINGLE_FLIGHT_DEDUPED
+from state import state
+from timeouts import DEADLINE_HEADER
+
+logger = logging.getLogger(__name__)
+
+NO_DEDUPE_HEADER = "x-copilot-api-no-dedupe"
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task[Any]):
+        self.task = task
+        self.waiters = 0
+        self.shared = False
+
+
+# (endpoint, request body) -> upstream call in progress. The key is the
+# body exactly as the client sent it: it is already in memory, hashing it
+# is far cheaper than encoding the payload again, and the route derives the
+# upstream payload from it the same way every time. Keys only live while
+# the call runs, so keeping the full bytes is cheap and makes collisions
+# impossible.
+_flights: dict[tuple[str, bytes], _Flight] = {}
+
+
+def single_flight_enabled(headers: Mapping[str, str]) -> bool:
+    # The shared upstream call runs under the deadline of the request that
+    # started it, so requests with their own deadline are never shared.
+    return (
+        state.single_flight
+        and NO_DEDUPE_HEADER not in headers
+        and DEADLINE_HEADER not in headers
+    )
+
+
+async def single_flight(
+    endpoint: str,
+    body: bytes,
+    call: Callable[[], Awaitable[dict[str, Any]]],
+) -> tuple[dict[str, Any], bool]:
+    # Identical concurrent requests await one upstream call. It runs in its
+    # own task so a disconnecting caller does not fail the others; it is
+    # only cancelled once nobody is waiting for it. Also returns whether
+    # this request joined another one's call, so its usage is not counted
+    # twice.
+    key = (endpoint, body)
+    flight = _flights.get(key)
+    joined = flight is not None
+    if flight is None:
+        flight = _Flight(asyncio.create_task(call()))
+        _flights[key] = flight
+        # Registered before any waiter, so the key is gone before anyone
+        # resumes and nobody can join a finished call.
+        flight.task.add_done_callback(lambda _: _flights.pop(key, None))
+    else:
+        flight.shared = True
+        SINGLE_FLIGHT_DEDUPED.inc(endpoint)
+        logger.debug("Joined in-flight %s request", endpoint)
+
+    flight.waiters += 1
+    try:
+        result = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if flight.waiters == 1 and not flight.task.done():
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+
+    # Callers post-process responses in place, so a shared result is copied.
+    return (copy.deepcopy(result) if flight.shared else result), joined
+
+
+# Chunks kept for late joiners. Once a stream outgrows it, the broadcast
+# stops accepting joiners and only keeps what its slowest subscriber has not
+# read yet; the upstream read waits while that is still more than this.
+STREAM_REPLAY_LIMIT = 4096
+# How often (in chunks read) a subscriber trims the shared buffer.
+_TRIM_INTERVAL = 256
+
+
+class _Broadcast:
+    # One upstream stream read by a pump task into a shared buffer. Each
+    # subscriber keeps its own cursor into the buffer, so clients read at
+    # their own pace while they are within STREAM_REPLAY_LIMIT chunks of the
+    # upstream read. Past that, the slowest subscriber holds back the
+    # upstream read, and with it everyone else.
+
+    def __init__(self, key: tuple[str, bytes], stream: AsyncGenerator[Any, None]):
+        self.key = key
+        self.chunks: list[Any] = []
+        # Number of chunks trimmed from the front of self.chunks.
+        self.offset = 0
+        self.finished = False
+        self.error: BaseException | None = None
+        self.cursors: dict[int, int] = {}
+        # Subscribers whose first read has not happened yet. Until then
+        # they neither hold back trimming nor apply backpressure.
+        self.unstarted: set[int] = set()
+        self._next_id = 0
+        self._changed = asyncio.Event()
+        self._advanced = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(stream))
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _close_to_joiners(self) -> None:
+        if _broadcasts.get(self.key) is self:
+            del _broadcasts[self.key]
+
+    async def _pump(self, stream: AsyncGenerator[Any, None]) -> None:
+        try:
+            async for chunk in stream:
+                self.chunks.append(chunk)
+                if len(self.chunks) > STREAM_REPLAY_LIMIT:
+                    self._close_to_joiners()
+                    self._trim()
+                    while len(self.chunks) > STREAM_REPLAY_LIMIT and self._reading():
+                        # The slowest subscriber applies backpressure.
+                        self._notify()
+                        self._advanced.clear()
+                        await self._advanced.wait()
+                        self._trim()
+                self._notify()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.finished = True
+            self._close_to_joiners()
+            self._notify()
+            await stream.aclose()
+
+    def _reading(self) -> list[int]:
+        return [
+            cursor
+            for subscriber, cursor in self.cursors.items()
+            if subscriber not in self.unstarted
+        ]
+
+    def _trim(self) -> None:
+        cursors = self._reading()
+        if _broadcasts.get(self.key) is self or not cursors:
+            return
+        low = min(cursors)
+        if low > self.offset:
+            del self.chunks[: low - self.offset]
+            self.offset = low
+
+    def subscribe(self) -> _Subscription:
+        # Registered before the first read, so another subscriber leaving
+        # in between does not stop the upstream read.
+        subscriber = self._next_id
+        self._next_id += 1
+        self.cursors[subscriber] = self.offset
+        self.unstarted.add(subscriber)
+        return _Subscription(self, subscriber)
+
+    def unsubscribe(self, subscriber: int) -> None:
+        if self.cursors.pop(subscriber, None) is None:
+            return
+        self.unstarted.discard(subscriber)
+        self._advanced.set()
+        # The last client to leave stops the upstream read.
+        if not self.cursors and not self.task.done():
+            self._close_to_joiners()
+            self.task.cancel()
+
+    async def _read(self, subscriber: int) -> AsyncGenerator[Any, None]:
+        self.unstarted.discard(subscriber)
+        cursor = self.cursors[subscriber]
+        try:
+            if cursor < self.offset:
+                raise RuntimeError(
+                    "Shared stream moved on before this client started reading it"
+                )
+            while True:
+                index = cursor - self.offset
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    cursor += 1
+                    self.cursors[subscriber] = cursor
+                    self._advanced.set()
+                    if cursor % _TRIM_INTERVAL == 0:
+                        self._trim()
+                    yield chunk
+                    continue
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class _Subscription:
+    # Drops its cursor when closed or garbage collected. A generator that
+    # was never started does not run its finally, which happens when a
+    # client disconnects before the response body starts; its cursor would
+    # otherwise pin the buffer and keep the upstream read going for good.
+
+    def __init__(self, broadcast: _Broadcast, subscriber: int):
+        self._broadcast = broadcast
+        self._subscriber = subscriber
+        self._reader = broadcast._read(subscriber)
+
+    def __aiter__(self) -> _Subscription:
+        return self
+
+    async def __anext__(self) -> Any:
+        return await self._reader.__anext__()
+
+    async def aclose(self) -> None:
+        try:
+            await self._reader.aclose()
+        finally:
+            self._broadcast.unsubscribe(self._subscriber)
+
+    def __del__(self) -> None:
+        self._broadcast.unsubscribe(self._subscriber)
+
+
+_broadcasts: dict[tuple[str, bytes], _Broadcast] = {}
+
+
+def deterministic(payload: Mapping[str, Any]) -> bool:
+    # Only streams that would come out the same for every caller are shared.
+    # With sampling (temperature defaults to 1) or several choices, clients
+    # sending the same request expect different answers.
+    choices = payload.get("n")
+    return payload.get("temperature") == 0 and (choices is None or choices == 1)
+
+
+async def broadcast_stream(
+    endpoint: str,
+    body: bytes,
+    call: Callable[[], Awaitable[AsyncGenerator[Any, None]]],
+) -> tuple[AsyncIterator[Any], bool]:
+    # Streaming counterpart of single_flight: identical concurrent streams
+    # share one upstream stream. Callers only use it for deterministic()
+    # payloads. A late joiner replays the chunks produced so
+    # far and then follows live; each caller converts the chunks itself, so
+    # they are shared read-only.
+    key = (endpoint, body)
+    broadcast = _broadcasts.get(key)
+    if broadcast is None:
+        # call() returns the stream without starting it: the upstream request
+        # is sent by the pump, so an upstream error reaches every subscriber
+        # as a mid-stream error event, as it does for unshared streams.
+        # Starting it here would turn that into an HTTP status, but identical
+        # requests arriving before the first byte would no longer join.
+        stream = await call()
+        broadcast = _broadcasts.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast(key, stream)
+            _broadcasts[key] = broadcast
+            return broadcast.subscribe(), False
+        await stream.aclose()
+
+    SINGLE_FLIGHT_DEDUPED.inc(endpoint)
+    logger.debug("Joined in-flight %s stream at chunk %s", endpoint, len(broadcast.chunks))
+    return broadcast.subscribe(), True
@@ -11,6 +11,8 @@ class RuntimeState:
     copilot_token: str | None = None
 
     account_type: str = "business"
+    # Replaces the Copilot API and token endpoint host, e.g. for the mock upstream.
+    upstream_url: str | None = None
     models: dict[str, Any] | None = None
     vscode_version: str | None = None
 
@@ -19,7 +21,71 @@ class RuntimeState:
     rate_limit_seconds: int | None = None
     last_request_timestamp: float | None = None
 
+    # Set in worker processes started with --workers; shared state then lives
+    # in the coordinator running in the parent process.
+    coordinator_path: str | None = None
+
     rate_limit_lock: Lock = field(default_factory=Lock)
 
+    admin_enabled: bool = False
+    profile_slow_ms: int | None = None
+
+    # Cassette directories for --record / --replay; replay_timing is
+    # "original" or "fast".
+    record_dir: str | None = None
+    replay_dir: str | None = None
+    replay_timing: str = "original"
+
+    # Longest image side in pixels before upload; None sends images as-is.
+    image_max_size: int | None = None
+    image_quality: int = 85
+
+    # Route ("chat" or "messages") -> minimum cosine similarity for a
+    # semantic cache hit; empty disables the cache.
+    semantic_cache: dict[str, float] = field(default_factory=dict)
+    semantic_cache_size: int = 1000
+    semantic_cache_eviction: str = "lru"
+    semantic_cache_model: str = "text-embedding-3-small"
+
+    # Strategies applied in order when a prompt exceeds the model's limit;
+    # empty sends requests unchanged.
+    context_fit: list[str] = field(default_factory=list)
+    context_keep_recent: int = 10
+
+    # Identical concurrent requests share one upstream call or stream.
+    single_flight: bool = True
+
+    # Chunks buffered between the upstream reader and a slow client, and
+    # seconds of silence before a stream sends a heartbeat (0 disables).
+    stream_buffer: int = 64
+    stream_heartbeat: float = 15.0
+
+    # --timeout settings layered over timeouts.DEFAULT_TIMEOUTS: scope ("",
+    # a route or a model id) -> kind -> seconds, 0 disabling that timeout.
+    upstream_timeouts: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    # Per-client, per-model token totals; usage_db None keeps them in memory.
+    usage_ledger: bool = True
+    usage_db: str | None = None
+
+    # Batch requests sent upstream at once, across all running batches.
+    batch_concurrency: int = 4
+
+    # Per-model AIMD limit on concurrent upstream requests, and how long a
+    # request waits for room under it before failing with 429.
+    adaptive_concurrency: bool = True
+    max_concurrency: int = 128
+    concurrency_queue_timeout: float = 30.0
+
+    # Recent requests kept for /admin/captures (0 disables), and the bytes
+    # kept of each request and response body in them.
+    debug_captures: int = 0
+    debug_capture_bytes: int = 65536
+
+    # Log output ("text" or "json") and logger name -> fraction of its INFO
+    # and DEBUG records kept.
+    log_format: str = "text"
+    log_sample: dict[str, float] = field(default_factory=dict)
+
 
 state = RuntimeState()
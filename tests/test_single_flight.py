@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import asyncio
+
+import single_flight
+
+
+async def _upstream(count: int):
+    for index in range(count):
+        yield index
+        await asyncio.sleep(0)
+
+
+async def _read_all(stream, timeout: float = 5.0) -> list[int]:
+    async def read() -> list[int]:
+        return [chunk async for chunk in stream]
+
+    return await asyncio.wait_for(read(), timeout)
+
+
+def test_unstarted_subscriber_does_not_stall_stream(monkeypatch):
+    # A client that disconnects before its body starts leaves a subscription
+    # that is never iterated; the other subscriber must still get the whole
+    # stream once it outgrows the replay buffer.
+    monkeypatch.setattr(single_flight, "STREAM_REPLAY_LIMIT", 64)
+
+    async def scenario() -> None:
+        broadcast = single_flight._Broadcast(("test", b"stall"), _upstream(1000))
+        single_flight._broadcasts[broadcast.key] = broadcast
+        active = broadcast.subscribe()
+        abandoned = broadcast.subscribe()
+
+        assert await _read_all(active) == list(range(1000))
+        del abandoned
+
+    asyncio.run(scenario())
+
+
+def test_dropped_unstarted_subscriber_releases_upstream():
+    async def scenario() -> None:
+        broadcast = single_flight._Broadcast(("test", b"release"), _upstream(1000))
+        single_flight._broadcasts[broadcast.key] = broadcast
+        first = broadcast.subscribe()
+        second = broadcast.subscribe()
+
+        await first.aclose()
+        del second
+        await asyncio.sleep(0)
+        assert broadcast.task.cancelled() or broadcast.task.done()
+        assert broadcast.key not in single_flight._broadcasts
+
+    asyncio.run(scenario())
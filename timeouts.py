@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Mapping
+
+import httpx
+
+from errors import HTTPError
+from metrics import UPSTREAM_TIMEOUTS
+from state import state
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_KINDS = ("connect", "ttfb", "idle", "total")
+# Seconds the client is willing to wait for the whole request, including
+# the rate-limit wait and the end of a stream.
+DEADLINE_HEADER = "x-copilot-api-timeout"
+
+# Scope ("" for all requests, a route name or a model id) -> kind -> seconds.
+# Settings from --timeout are layered on top; a model overrides its route.
+DEFAULT_TIMEOUTS: dict[str, dict[str, float]] = {
+    "": {"connect": 10, "ttfb": 300, "idle": 120},
+    "embeddings": {"ttfb": 90},
+}
+
+# (route, monotonic deadline or None) of the request being handled.
+_current_request: ContextVar[tuple[str, float | None] | None] = ContextVar(
+    "copilot_api_request_deadline", default=None
+)
+
+
+def timeout_error(message: str) -> HTTPError:
+    return HTTPError(
+        message=message,
+        status_code=504,
+        response_text=json.dumps({"message": message}),
+    )
+
+
+def parse_timeouts(values: list[str]) -> dict[str, dict[str, float]]:
+    # "KIND=SECONDS" or "KIND@SCOPE=SECONDS", where SCOPE is a route or a
+    # model id, e.g. ["idle=60", "ttfb@messages=600", "total@gpt-4o=120"].
+    # 0 disables that timeout.
+    timeouts: dict[str, dict[str, float]] = {}
+    for value in values:
+        target, _, seconds = value.partition("=")
+        kind, _, scope = target.strip().partition("@")
+        if kind not in TIMEOUT_KINDS:
+            raise ValueError(
+                f"Unknown timeout {kind!r}; expected one of {', '.join(TIMEOUT_KINDS)}"
+            )
+        try:
+            parsed = float(seconds)
+        except ValueError:
+            raise ValueError(f"Invalid seconds in {value!r}") from None
+        if parsed < 0:
+            raise ValueError(f"Seconds in {value!r} must not be negative")
+        timeouts.setdefault(scope, {})[kind] = parsed
+    return timeouts
+
+
+def start_request_deadline(route: str, headers: Mapping[str, str]) -> None:
+    deadline = None
+    value = headers.get(DEADLINE_HEADER)
+    if value is not None:
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = -1.0
+        if not seconds > 0:
+            message = f"{DEADLINE_HEADER} must be a positive number of seconds"
+            raise HTTPError(
+                message=message,
+                status_code=400,
+                response_text=json.dumps({"message": message}),
+            )
+        deadline = time.monotonic() + seconds
+    _current_request.set((route, deadline))
+
+
+def deadline_remaining() -> float | None:
+    current = _current_request.get()
+    if current is None or current[1] is None:
+        return None
+    return current[1] - time.monotonic()
+
+
+def check_deadline(waiting_for: str) -> None:
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        UPSTREAM_TIMEOUTS.inc("deadline")
+        raise timeout_error(f"Request deadline expired before {waiting_for}")
+
+
+@dataclass
+class UpstreamTimeouts:
+    connect: float | None = None
+    ttfb: float | None = None
+    idle: float | None = None
+    total: float | None = None
+    # Which limit `total` came from: the configured timeout or the client's
+    # deadline, for the error message.
+    total_source: str = "total"
+    started: float = field(default_factory=time.monotonic)
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        # httpx only bounds connecting; reads are bounded by limit() so that
+        # time-to-first-byte and the gap between chunks can differ.
+        return httpx.Timeout(connect=self.connect, read=None, write=None, pool=self.connect)
+
+    @asynccontextmanager
+    async def limit(self, kind: str) -> AsyncIterator[None]:
+        # Bounds one upstream wait by the `kind` timeout or whatever is left
+        # of the total, whichever ends first.
+        seconds = getattr(self, kind)
+        reason = kind
+        if self.total is not None:
+            remaining = self.total - (time.monotonic() - self.started)
+            if seconds is None or remaining < seconds:
+                seconds = max(0.0, remaining)
+                reason = self.total_source
+
+        try:
+            async with asyncio.timeout(seconds):
+                yield
+        except (TimeoutError, httpx.TimeoutException) as error:
+            if isinstance(error, httpx.ConnectTimeout):
+                reason = "connect"
+            UPSTREAM_TIMEOUTS.inc(reason)
+            if reason == "deadline":
+                message = "Request deadline expired while waiting for upstream"
+            else:
+                message = f"Upstream {reason} timeout exceeded"
+            logger.warning("%s (%s)", message, kind)
+            raise timeout_error(message) from None
+
+
+def upstream_timeouts(model: object) -> UpstreamTimeouts:
+    current = _current_request.get()
+    route = current[0] if current is not None else ""
+
+    settings: dict[str, float] = {}
+    for scope in ("", route, str(model)):
+        settings.update(DEFAULT_TIMEOUTS.get(scope, {}))
+        settings.update(state.upstream_timeouts.get(scope, {}))
+
+    timeouts = UpstreamTimeouts(
+        **{kind: settings.get(kind) or None for kind in TIMEOUT_KINDS}
+    )
+    check_deadline("the upstream call")
+    remaining = deadline_remaining()
+    if remaining is not None:
+        if timeouts.total is None or remaining < timeouts.total:
+            timeouts.total = remaining
+            timeouts.total_source = "deadline"
+    return timeouts
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+from dataclasses import asdict, dataclass
+from datetime import date
+from typing import Any, AsyncGenerator, Callable, Mapping
+
+from metrics import chunk_text_length
+from state import state
+
+logger = logging.getLogger(__name__)
+
+# Names the client in the ledger; without it, a hash of the API key does.
+CLIENT_HEADER = "x-copilot-api-client"
+USAGE_FLUSH_INTERVAL_SECONDS = 10
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    client TEXT NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    estimated_requests INTEGER NOT NULL,
+    latency_seconds REAL NOT NULL,
+    PRIMARY KEY (day, client, model)
+)
+"""
+_UPSERT = """
+INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (day, client, model) DO UPDATE SET
+    requests = requests + excluded.requests,
+    input_tokens = input_tokens + excluded.input_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    estimated_requests = estimated_requests + excluded.estimated_requests,
+    latency_seconds = latency_seconds + excluded.latency_seconds
+"""
+
+
+@dataclass
+class UsageTotals:
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    # Requests whose upstream response carried no usage, so the token
+    # counts are ~4 characters per token estimates.
+    estimated_requests: int = 0
+    latency_seconds: float = 0.0
+
+    def add(self, other: UsageTotals) -> None:
+        self.requests += other.requests
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        self.estimated_requests += other.estimated_requests
+        self.latency_seconds += other.latency_seconds
+
+    def as_dict(self) -> dict[str, Any]:
+        result = asdict(self)
+        result["latency_seconds"] = round(self.latency_seconds, 3)
+        result["average_latency_ms"] = (
+            round(self.latency_seconds * 1000 / self.requests, 1) if self.requests else None
+        )
+        return result
+
+
+# (day, client, model) -> totals not yet written to the database.
+_pending: dict[tuple[str, str, str], UsageTotals] = {}
+_flush_task: asyncio.Task[None] | None = None
+_flush_lock = asyncio.Lock()
+
+
+def client_key(headers: Mapping[str, str]) -> str:
+    name = headers.get(CLIENT_HEADER)
+    if name:
+        return name[:64]
+    key = headers.get("x-api-key")
+    authorization = headers.get("authorization") or ""
+    if not key and authorization.lower().startswith("bearer "):
+        key = authorization[7:].strip()
+    if key:
+        return "key-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+    return "anonymous"
+
+
+def upstream_usage(response: Mapping[str, Any]) -> tuple[int, int] | None:
+    # (input, output) tokens from an OpenAI-style usage object.
+    usage = response.get("usage")
+    if not isinstance(usage, dict) or "prompt_tokens" not in usage:
+        return None
+    return int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0)
+
+
+def record_usage(
+    client: str,
+    model: Any,
+    usage: tuple[int, int] | None,
+    estimated_input: int | Callable[[], int],
+    estimated_output: int,
+    latency_seconds: float,
+    shared: bool = False,
+) -> None:
+    # estimated_input may be a callable, so the estimate is only computed
+    # when upstream reports no usage. A shared request joined another
+    # request's upstream call (see single_flight) and counts as a request
+    # without tokens, since upstream only billed the call once.
+    if not state.usage_ledger:
+        return
+    key = (date.today().isoformat(), client, str(model))
+    totals = _pending.get(key)
+    if totals is None:
+        totals = _pending[key] = UsageTotals()
+    totals.requests += 1
+    totals.latency_seconds += latency_seconds
+    if shared:
+        return
+    if usage is None:
+        totals.estimated_requests += 1
+        if callable(estimated_input):
+            estimated_input = estimated_input()
+        usage = (estimated_input, estimated_output)
+    totals.input_tokens += usage[0]
+    totals.output_tokens += usage[1]
+
+
+def request_stream_usage(payload: dict[str, Any]) -> bool:
+    # Asks upstream for a final usage chunk; returns whether the client had
+    # asked for it too, since clients that did not may choke on a chunk
+    # without choices.
+    options = payload.get("stream_options")
+    requested = isinstance(options, dict) and bool(options.get("include_usage"))
+    if payload.get("stream"):
+        payload["stream_options"] = {**(options or {}), "include_usage": True}
+    return requested
+
+
+def estimate_output_tokens(response: Mapping[str, Any]) -> int:
+    # Same ~4 characters per token estimate as tokenizer.py.
+    chars = 0
+    for choice in response.get("choices") or []:
+        message = choice.get("message") or {}
+        chars += len(message.get("content") or "")
+        for call in message.get("tool_calls") or []:
+            chars += len((call.get("function") or {}).get("arguments") or "")
+    return (chars + 3) // 4
+
+
+async def track_stream_usage(
+    stream: AsyncGenerator[dict[str, Any] | str, None],
+    client: str,
+    model: Any,
+    started: float,
+    estimated_input: int | Callable[[], int],
+    shared: bool = False,
+) -> AsyncGenerator[dict[str, Any] | str, None]:
+    # Passes chunks through and records the usage chunk upstream sends last
+    # (requested with stream_options.include_usage), or an estimate from the
+    # streamed text when the stream ends without one.
+    usage = None
+    output_chars = 0
+    try:
+        async for chunk in stream:
+            if isinstance(chunk, dict):
+                if chunk.get("usage"):
+                    usage = upstream_usage(chunk)
+                output_chars += chunk_text_length(chunk)
+            yield chunk
+    finally:
+        record_usage(
+            client,
+            model,
+            usage,
+            estimated_input,
+            (output_chars + 3) // 4,
+            time.perf_counter() - started,
+            shared,
+        )
+
+
+def _write_rows(path: str, rows: list[tuple[Any, ...]]) -> None:
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        with connection:
+            connection.execute(_SCHEMA)
+            connection.executemany(_UPSERT, rows)
+    finally:
+        connection.close()
+
+
+async def flush_usage() -> None:
+    global _pending
+
+    async with _flush_lock:
+        if not _pending or not state.usage_db:
+            return
+        batch, _pending = _pending, {}
+        rows = [
+            (
+                day,
+                client,
+                model,
+                totals.requests,
+                totals.input_tokens,
+                totals.output_tokens,
+                totals.estimated_requests,
+                totals.latency_seconds,
+            )
+            for (day, client, model), totals in batch.items()
+        ]
+        try:
+            await asyncio.to_thread(_write_rows, state.usage_db, rows)
+        except Exception:
+            logger.exception("Failed to write usage ledger; keeping %s rows for retry", len(rows))
+            for key, totals in batch.items():
+                _pending.setdefault(key, UsageTotals()).add(totals)
+
+
+def _read_rows(
+    path: str, since: str | None, client: str | None, model: str | None
+) -> list[tuple[Any, ...]]:
+    query = (
+        "SELECT day, client, model, requests, input_tokens, output_tokens, "
+        "estimated_requests, latency_seconds FROM usage WHERE 1 = 1"
+    )
+    params: list[str] = []
+    filters = (("day >= ?", since), ("client = ?", client), ("model = ?", model))
+    for condition, value in filters:
+        if value is not None:
+            query += f" AND {condition}"
+            params.append(value)
+
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        connection.execute(_SCHEMA)
+        return connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+
+
+async def query_usage(
+    since: str | None = None,
+    client: str | None = None,
+    model: str | None = None,
+) -> dict[str, Any]:
+    # Totals per client and model: flushed rows plus what is still pending.
+    rows: list[tuple[Any, ...]] = []
+    # Held so a batch being written is counted exactly once.
+    async with _flush_lock:
+        if state.usage_db:
+            rows = await asyncio.to_thread(_read_rows, state.usage_db, since, client, model)
+        for (day, row_client, row_model), totals in _pending.items():
+            if (
+                (since is None or day >= since)
+                and (client is None or row_client == client)
+                and (model is None or row_model == model)
+            ):
+                rows.append((day, row_client, row_model, *asdict(totals).values()))
+
+    grouped: dict[tuple[str, str], UsageTotals] = {}
+    overall = UsageTotals()
+    for _, row_client, row_model, *values in rows:
+        totals = UsageTotals(*values)
+        grouped.setdefault((row_client, row_model), UsageTotals()).add(totals)
+        overall.add(totals)
+
+    return {
+        "usage": [
+            {"client": row_client, "model": row_model, **totals.as_dict()}
+            for (row_client, row_model), totals in sorted(grouped.items())
+        ],
+        "total": overall.as_dict(),
+    }
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL_SECONDS)
+        await flush_usage()
+
+
+def start_usage_ledger() -> None:
+    global _flush_task
+
+    if not state.usage_ledger or not state.usage_db or _flush_task is not None:
+        return
+    _flush_task = asyncio.create_task(_flush_loop())
+    logger.info("Recording usage to %s", state.usage_db)
+
+
+async def stop_usage_ledger() -> None:
+    global _flush_task
+
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        _flush_task = None
+    await flush_usage()